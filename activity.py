@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from datetime import datetime
+
+
+class ActivityBuffer:
+    """
+    Write-behind buffer for users' last_activity_timestamp.
+    touch() only records the latest activity time per user in memory; the buffered touches are
+    written as one unordered bulk_write (see Repository.touch_activity) every `flush_interval`
+    seconds, or as soon as `max_pending` users are waiting. A user who is active many times
+    between flushes therefore costs a single update. The purchase cycle calls flush() before
+    querying the queue so FIFO order reflects every activity up to the cycle start.
+    """
+
+    def __init__(self, repo, flush_interval: float = 5.0, max_pending: int = 1000):
+        self.repo = repo
+        self.flush_interval = flush_interval
+        self.max_pending = max(1, max_pending)
+        self._pending = {} # user_id -> latest activity datetime
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._size_flush = None
+        self.touches = 0
+        self.written = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        """Starts the periodic flush task."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the periodic flush and writes whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def touch(self, user_id: int, at: datetime = None):
+        """Records activity for `user_id` (now, unless `at` is given)."""
+        if not user_id:
+            return
+        at = at or datetime.utcnow()
+        known = self._pending.get(user_id)
+        if known is None or at > known:
+            self._pending[user_id] = at
+        self.touches += 1
+        if len(self._pending) >= self.max_pending and (self._size_flush is None or self._size_flush.done()):
+            self._size_flush = asyncio.create_task(self.flush())
+
+    async def flush(self) -> int:
+        """Writes all buffered touches. Returns the number of users written."""
+        async with self._lock:
+            if not self._pending:
+                return 0
+            touches, self._pending = self._pending, {}
+            try:
+                await self.repo.touch_activity(touches)
+            except Exception as e:
+                # Put the touches back (keeping any newer ones) so the next flush retries them.
+                for user_id, at in touches.items():
+                    known = self._pending.get(user_id)
+                    if known is None or at > known:
+                        self._pending[user_id] = at
+                logging.error(f"ActivityBuffer: Failed to write {len(touches)} activity touch(es), will retry: {e}")
+                return 0
+            self.written += len(touches)
+            logging.debug(f"ActivityBuffer: Wrote activity for {len(touches)} user(s).")
+            return len(touches)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"ActivityBuffer: Flush loop error: {e}", exc_info=True)
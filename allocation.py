@@ -0,0 +1,90 @@
+import logging
+from dataclasses import dataclass
+
+from discovery import GiftOption
+
+# Reasons shown to the user in purchase notifications.
+REASON_PREFERRED = "your preferred gift"
+REASON_FALLBACK = "an available limited gift"
+
+
+@dataclass
+class Assignment:
+    """The gift chosen for one queued user in a purchase cycle."""
+    user_id: int
+    star_balance: int
+    gift: GiftOption # Shared with the catalog; never copied
+    reason: str
+    access_hash: int = None # Stored Telegram access_hash, if known
+    reservation_id: object = None # purchase_journal entry holding the Stars (see journal.PurchaseJournal)
+
+
+class GiftCatalog:
+    """
+    Index over the gifts discovered in one polling cycle.
+    Built once per option list (see bot.catalog_snapshot) and only read afterwards, so the same
+    instance serves every purchase task of every cycle until the options change: a dict by gift ID for
+    preference lookups and the gifts sorted by price, whose first entry is the only fallback candidate,
+    so choosing a gift for a user costs O(preferences) no matter how large the catalog or the queue grows.
+    """
+
+    def __init__(self, gifts):
+        self.gifts = tuple(gifts) # GiftOptions in discovery order
+        self.by_id = {}
+        for gift in self.gifts:
+            self.by_id.setdefault(gift.id, gift) # First listing wins, like the old linear scan
+        # sorted() is stable, so equally priced gifts keep their discovery order.
+        self._by_price = tuple(sorted(self.gifts, key=lambda g: g.stars))
+
+    def __len__(self):
+        return len(self._by_price)
+
+    @property
+    def cheapest_price(self):
+        """Price of the cheapest gift, or None if the catalog is empty."""
+        return self._by_price[0].stars if self._by_price else None
+
+    def cheapest_affordable(self, star_balance: int):
+        """Returns the cheapest gift costing at most `star_balance`, or None."""
+        return self._by_price[0] if self._by_price and self._by_price[0].stars <= star_balance else None
+
+    def choose(self, star_balance: int, preferred_gift_ids: list):
+        """
+        Picks a gift for a user: the first affordable preferred gift, falling back to
+        the cheapest affordable gift. Returns (gift, reason) or (None, None).
+        """
+        for pref_id in preferred_gift_ids or ():
+            gift = self.by_id.get(pref_id)
+            if gift and star_balance >= gift.stars:
+                return gift, REASON_PREFERRED
+        gift = self.cheapest_affordable(star_balance)
+        if gift:
+            return gift, REASON_FALLBACK
+        return None, None
+
+    def allocate(self, user_docs: list) -> list:
+        """
+        Assigns gifts to a batch of projected user documents in one pass.
+        Returns the Assignments in input order; users who cannot afford anything are left out.
+        """
+        assignments = []
+        for user_doc in user_docs:
+            user_id = user_doc['user_id']
+            star_balance = user_doc.get('star_balance', 0)
+            gift, reason = self.choose(star_balance, user_doc.get('preferred_gift_ids'))
+            if gift is None:
+                logging.debug(f"GiftCatalog: User {user_id} (balance: {star_balance}) - no affordable gift found (neither preferred nor fallback).")
+                continue
+            assignments.append(Assignment(user_id, star_balance, gift, reason, user_doc.get('access_hash')))
+        return assignments
+
+    async def allocate_batches(self, user_docs, batch_size: int):
+        """Consumes an async iterable of user documents and yields a list of Assignments per batch."""
+        batch = []
+        async for user_doc in user_docs:
+            batch.append(user_doc)
+            if len(batch) >= batch_size:
+                yield self.allocate(batch)
+                batch = []
+        if batch:
+            yield self.allocate(batch)
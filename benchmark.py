@@ -0,0 +1,343 @@
+"""
+Offline benchmark of the bot's hot paths.
+
+The handlers and purchase cycle in bot.py run unchanged against a local mongod seeded with
+synthetic users, with fake_telegram.FakeTelegramClient standing in for Telegram (configurable
+latency, FloodWait injection and sold-out races). No Telegram account is needed.
+
+    python benchmark.py --users 100000                # every scenario
+    python benchmark.py --scenario drop --users 1000000 --latency 0.1 --flood-wait-rate 0.01
+
+Scenarios:
+    drop      a limited gift appears: discovery poll + process_gift_purchases over the whole queue
+    payments  concurrent Star payments through handle_star_reception
+    commands  a mix of user commands through the router
+
+Reported: throughput, time to first purchase after the drop, p50/p99 handler latency and the
+peak RSS of the process (each scenario runs in its own process). Results are appended to
+benchmark_results.jsonl and compared with the previous run of the same scenario and size, so
+regressions show up; --check exits non-zero on one. Telegram rate limits and the other bot
+settings are read from the environment as usual (e.g. TELEGRAM_GLOBAL_RATE=1000).
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient
+
+from fake_telegram import FakeEvent, FakeTelegramClient, fake_access_hash, fake_option, payment_action
+
+SCENARIOS = ('drop', 'payments', 'commands')
+
+# Gifts on offer before the drop (id, stars) and the gift that drops
+BASE_GIFTS = [(1001, 50), (1002, 100), (1003, 250), (1004, 500)]
+DROP_GIFT = (2001, 100)
+
+# A throughput drop or p99 rise beyond these fractions, against the previous run, is a regression
+THROUGHPUT_TOLERANCE = 0.10
+LATENCY_TOLERANCE = 0.20
+
+SEED_BATCH_SIZE = 10000
+
+
+def percentile(samples: list, q: float) -> float:
+    """Nearest-rank percentile of `samples` (0 < q <= 100), or 0.0 when empty."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def latency_summary(samples: list) -> dict:
+    return {'count': len(samples), 'p50_ms': percentile(samples, 50) * 1000, 'p99_ms': percentile(samples, 99) * 1000}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def seed_users(mongo_url: str, database: str, count: int, seed: int):
+    """Replaces `database` with `count` synthetic users, most of them queued with a balance."""
+    rng = random.Random(seed)
+    client = MongoClient(mongo_url)
+    client.drop_database(database)
+    users = client[database].users
+    gift_ids = [gift_id for gift_id, _ in BASE_GIFTS] + [DROP_GIFT[0]]
+    now = datetime.utcnow()
+    started = time.monotonic()
+    batch = []
+    for user_id in range(1, count + 1):
+        user = {
+            'user_id': user_id,
+            'star_balance': rng.choice((0, 25, 50, 100, 150, 300, 600, 1200)),
+            'last_activity_timestamp': now - timedelta(seconds=rng.uniform(60, 30 * 86400)),
+            'preferred_gift_ids': rng.sample(gift_ids, rng.choice((0, 0, 1, 2))),
+            'in_gift_queue': rng.random() < 0.8,
+        }
+        if rng.random() < 0.9: # The rest are resolved through get_input_entity
+            user['access_hash'] = fake_access_hash(user_id)
+        batch.append(user)
+        if len(batch) >= SEED_BATCH_SIZE:
+            users.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        users.insert_many(batch, ordered=False)
+    client.close()
+    logging.warning(f"Seeded {count} users into {database} in {time.monotonic() - started:.1f}s.")
+
+
+def import_bot(mongo_url: str, database: str, log_level: str, balance_trigger_mode: str = 'off'):
+    """Imports bot.py configured for an offline run against `database`; no Telegram session is used."""
+    os.environ['MONGO_CONNECTION_STRING'] = mongo_url
+    os.environ['MONGO_DATABASE_NAME'] = database
+    os.environ['SESSION_NAME'] = os.path.join(tempfile.gettempdir(), 'giftbot_benchmark')
+    os.environ['WORKER_MODE'] = 'single'
+    os.environ['BALANCE_TRIGGER_MODE'] = balance_trigger_mode
+    os.environ['INDEX_PLAN_CHECK'] = 'fail' # Indexes are complete before anything is timed
+    os.environ['METRICS_PORT'] = '0'
+    os.environ['RECORD_UPDATES_PATH'] = ''
+    os.environ.setdefault('API_ID', '1')
+    os.environ.setdefault('API_HASH', 'benchmark')
+    bot = importlib.import_module('bot')
+    logging.getLogger().setLevel(log_level)
+    return bot
+
+
+def use_client(bot, fake: FakeTelegramClient):
+    """Routes every Telegram call of the imported bot to `fake`."""
+    bot.client = fake
+    bot.gateway.client = fake
+
+
+def load_bot(args):
+    """Imports bot.py configured for the benchmark database, with the fake client swapped in."""
+    # Balance triggers are off so each scenario is measured on its own.
+    bot = import_bot(args.mongo, args.database, args.log_level)
+
+    fake = FakeTelegramClient(
+        [fake_option(gift_id, stars) for gift_id, stars in BASE_GIFTS],
+        latency=args.latency,
+        jitter=args.jitter,
+        flood_wait_rate=args.flood_wait_rate,
+        flood_wait_seconds=args.flood_wait_seconds,
+        sold_out_race_rate=args.sold_out_race_rate,
+        stock={DROP_GIFT[0]: args.drop_stock} if args.drop_stock else None,
+        seed=args.seed,
+    )
+    use_client(bot, fake)
+    return bot, fake
+
+
+def timed(func, samples: list):
+    """Wraps coroutine function `func` to append the duration of every call to `samples`."""
+    async def wrapper(*call_args, **call_kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*call_args, **call_kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+    return wrapper
+
+
+async def run_bounded(coroutines, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            await coroutine
+
+    await asyncio.gather(*(run(c) for c in coroutines))
+
+
+async def scenario_drop(bot, fake, args) -> dict:
+    samples = []
+    bot.purchase_gift_for_user = timed(bot.purchase_gift_for_user, samples)
+    fake.set_options(fake.options + [fake_option(*DROP_GIFT)])
+
+    dropped_at = time.monotonic()
+    options = await bot.fetch_gift_options()
+    catalog = bot.GiftCatalog(bot.limited_gifts_from_options(options))
+    await bot.process_gift_purchases(catalog, {DROP_GIFT[0]})
+    elapsed = time.monotonic() - dropped_at
+
+    purchases = len(fake.purchases)
+    return {
+        'purchases': purchases,
+        'elapsed_seconds': elapsed,
+        'purchases_per_second': purchases / elapsed if elapsed > 0 else 0.0,
+        'time_to_first_purchase_ms': (fake.purchases[0][0] - dropped_at) * 1000 if purchases else None,
+        'handler_latency': {'purchase_gift_for_user': latency_summary(samples)},
+        'flood_waits': fake.flood_waits,
+        'sold_out': fake.sold_out,
+    }
+
+
+async def scenario_payments(bot, fake, args) -> dict:
+    samples = []
+    handler = timed(bot.handle_star_reception, samples)
+    rng = random.Random(args.seed)
+    events = [
+        FakeEvent(fake, rng.randint(1, args.users), action=payment_action(rng.choice((25, 50, 100)), f"bench-{i}"), message_id=i)
+        for i in range(args.operations)
+    ]
+    started = time.monotonic()
+    await run_bounded((handler(event) for event in events), args.concurrency)
+    elapsed = time.monotonic() - started
+    return {
+        'payments': len(events),
+        'elapsed_seconds': elapsed,
+        'payments_per_second': len(events) / elapsed if elapsed > 0 else 0.0,
+        'handler_latency': {'handle_star_reception': latency_summary(samples)},
+        'flood_waits': fake.flood_waits,
+    }
+
+
+async def scenario_commands(bot, fake, args) -> dict:
+    samples = {}
+    rng = random.Random(args.seed)
+    gift_ids = [gift_id for gift_id, _ in BASE_GIFTS]
+    commands = ['/mystars', '/join_queue', '/my_preferences', '/leave_queue', '/clear_my_preferences']
+
+    async def send(event, command):
+        started = time.perf_counter()
+        try:
+            await bot.dispatch_update(event)
+        finally:
+            samples.setdefault(command, []).append(time.perf_counter() - started)
+
+    calls = []
+    for i in range(args.operations):
+        command = rng.choice(commands + ['/set_preferred_gift'])
+        text = f"{command} {rng.choice(gift_ids)}" if command == '/set_preferred_gift' else command
+        calls.append(send(FakeEvent(fake, rng.randint(1, args.users), text=text, message_id=i), command))
+    started = time.monotonic()
+    await run_bounded(calls, args.concurrency)
+    elapsed = time.monotonic() - started
+    return {
+        'commands': args.operations,
+        'elapsed_seconds': elapsed,
+        'commands_per_second': args.operations / elapsed if elapsed > 0 else 0.0,
+        'handler_latency': {command: latency_summary(s) for command, s in sorted(samples.items())},
+        'flood_waits': fake.flood_waits,
+    }
+
+
+async def run_scenario(args) -> dict:
+    if not args.no_seed:
+        seed_users(args.mongo, args.database, args.users, args.seed)
+    bot, fake = load_bot(args)
+    await bot.start_services()
+    try:
+        results = await globals()[f"scenario_{args.scenario}"](bot, fake, args)
+    finally:
+        await bot.stop_services()
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def compare(previous: dict, current: dict) -> list:
+    """Regressions of `current` against `previous` results of the same scenario."""
+    regressions = []
+    for key, value in current.items():
+        if key.endswith('_per_second') and previous.get(key):
+            if value < previous[key] * (1 - THROUGHPUT_TOLERANCE):
+                regressions.append(f"{key}: {previous[key]:.1f} -> {value:.1f}")
+    before, after = previous.get('time_to_first_purchase_ms'), current.get('time_to_first_purchase_ms')
+    if before and after and after > before * (1 + LATENCY_TOLERANCE):
+        regressions.append(f"time_to_first_purchase_ms: {before:.1f} -> {after:.1f}")
+    for handler, summary in current.get('handler_latency', {}).items():
+        before = previous.get('handler_latency', {}).get(handler, {}).get('p99_ms')
+        if before and summary['p99_ms'] > before * (1 + LATENCY_TOLERANCE):
+            regressions.append(f"{handler} p99: {before:.1f}ms -> {summary['p99_ms']:.1f}ms")
+    return regressions
+
+
+def record_result(args, results: dict) -> list:
+    """Appends the run to the results file and returns its regressions against the previous comparable run."""
+    params = {key: getattr(args, key) for key in ('users', 'operations', 'concurrency', 'latency', 'jitter',
+                                                  'flood_wait_rate', 'sold_out_race_rate', 'drop_stock')}
+    previous = None
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['scenario'] == args.scenario and entry['params'] == params:
+                    previous = entry
+    entry = {
+        'scenario': args.scenario,
+        'recorded_at': datetime.utcnow().isoformat(),
+        'commit': git_commit(),
+        'params': params,
+        'results': results,
+    }
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return compare(previous['results'], results) if previous else []
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the bot against a local mongod and a fake Telegram client.")
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--users', type=int, default=10000, help="Synthetic users to seed (default: 10000)")
+    parser.add_argument('--operations', type=int, default=10000, help="Payments or commands sent in those scenarios")
+    parser.add_argument('--concurrency', type=int, default=100, help="Payments or commands in flight at once")
+    parser.add_argument('--latency', type=float, default=0.05, help="Fake Telegram call latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.5, help="+/- fraction applied to the latency")
+    parser.add_argument('--flood-wait-rate', type=float, default=0.0, help="Share of Telegram calls failing with a FloodWait")
+    parser.add_argument('--flood-wait-seconds', type=int, default=1)
+    parser.add_argument('--sold-out-race-rate', type=float, default=0.0, help="Share of purchases failing as sold out")
+    parser.add_argument('--drop-stock', type=int, default=0, help="Purchases the dropped gift allows (0: unlimited)")
+    parser.add_argument('--mongo', default=os.getenv('BENCHMARK_MONGO_URL', 'mongodb://localhost:27017'))
+    parser.add_argument('--database', default='giftbot_benchmark', help="Dropped and re-seeded on every run")
+    parser.add_argument('--no-seed', action='store_true', help="Reuse the users already in --database")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--results', default='benchmark_results.jsonl')
+    parser.add_argument('--check', action='store_true', help="Exit with status 1 if a regression is found")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    if args.database == os.getenv('MONGO_DATABASE_NAME', 'telegram_gift_bot'):
+        parser.error(f"--database {args.database} is the bot's own database; the benchmark drops it.")
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.scenario == 'all':
+        # One process per scenario, so peak RSS and module state are per scenario.
+        argv = list(sys.argv[1:] if argv is None else argv)
+        status = 0
+        for scenario in SCENARIOS:
+            status |= subprocess.run([sys.executable, os.path.abspath(__file__), *argv, '--scenario', scenario]).returncode
+        return status
+
+    results = asyncio.run(run_scenario(args))
+    regressions = record_result(args, results)
+    print(json.dumps({'scenario': args.scenario, **results}, indent=2))
+    for regression in regressions:
+        print(f"REGRESSION ({args.scenario}): {regression}")
+    return 1 if regressions and args.check else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,39 @@
 import asyncio
 import os
-import re
-from datetime import datetime
+import socket
+import time
+import uuid
+from dataclasses import asdict
+from datetime import datetime, timedelta
 import logging
 
 from dotenv import load_dotenv
-from pymongo import MongoClient, UpdateOne
 from telethon import TelegramClient, events
-from telethon.tl.types import MessageService, MessageActionPaymentSent, InputPeerSelf, InputUser, InputStorePaymentPremiumGiftCode
+from telethon.tl.types import MessageActionPaymentSent, MessageActionPaymentSentMe, InputPeerSelf, InputPeerUser, InputUser, InputStorePaymentPremiumGiftCode
 # DataJSON might not be directly needed if we pass structured data that Telethon serializes.
 # from telethon.tl.types import DataJSON
 from telethon.tl.functions.payments import GetPremiumGiftCodeOptionsRequest, PurchasePremiumGiftCodeRequest
 from telethon.errors import RPCError
 
+from activity import ActivityBuffer
+from allocation import REASON_PREFERRED, Assignment, GiftCatalog
+from cache import UserCache
+from cluster import LeaseManager
+from discovery import DiscoveryScheduler, GiftOption, is_live_limited
+from entities import EntityCache
+from gateway import PRIORITY_DISCOVERY, PRIORITY_NOTIFICATION, PRIORITY_PURCHASE, PRIORITY_REPLY, TelegramGateway, parse_rate_limits
+import indexes
+from journal import PurchaseJournal
+from ledger import Payment, PaymentLedger
+from metrics import Metrics, MetricsServer, MongoCommandMetrics
+from outbox import NotificationOutbox
+from purchasing import PendingDebit, PurchaseExecutor, Settlement
+from recording import UpdateRecorder
+from router import CommandRouter
+from stats import QueueStats, format_stats
+from storage import Repository
+from triggers import BalanceTrigger
+
 # Load environment variables
 load_dotenv()
 
@@ -20,568 +41,947 @@ load_dotenv()
 API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-SESSION_NAME = "stars_bot_session"
+WORKER_MODE = os.getenv("WORKER_MODE", "single").lower() # single, or cluster to run several bot processes against one database
+WORKER_ID = os.getenv("WORKER_ID") or os.getenv("DYNO") or socket.gethostname() # Must be unique and stable per process in cluster mode
+SESSION_NAME = os.getenv("SESSION_NAME") or ("stars_bot_session" if WORKER_MODE != "cluster" else f"stars_bot_session_{WORKER_ID}")
 MONGO_CONNECTION_STRING = os.getenv("MONGO_CONNECTION_STRING")
 MONGO_DATABASE_NAME = os.getenv("MONGO_DATABASE_NAME", "telegram_gift_bot")
-POLLING_INTERVAL_SECONDS = int(os.getenv("POLLING_INTERVAL_SECONDS", 300)) # Default to 5 minutes
+POLLING_INTERVAL_SECONDS = int(os.getenv("POLLING_INTERVAL_SECONDS", 300)) # Default to 5 minutes; used while no limited gift is on offer
+DISCOVERY_FAST_INTERVAL_SECONDS = float(os.getenv("DISCOVERY_FAST_INTERVAL_SECONDS", 10)) # Poll interval while limited stock is live
+DISCOVERY_JITTER = float(os.getenv("DISCOVERY_JITTER", 0.2)) # +/- fraction applied to every poll delay
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30)) # Outbound Telegram calls per second, all methods combined
+TELEGRAM_DEFAULT_METHOD_RATE = float(os.getenv("TELEGRAM_DEFAULT_METHOD_RATE", 20)) # Calls per second for any single method without its own limit
+TELEGRAM_METHOD_RATES = os.getenv("TELEGRAM_METHOD_RATES", "SendMessage=25/25,GetPremiumGiftCodeOptionsRequest=1/3") # Per-method "Method=rate/burst" overrides
+TELEGRAM_MAX_FLOOD_WAIT_SECONDS = float(os.getenv("TELEGRAM_MAX_FLOOD_WAIT_SECONDS", 300)) # Longer FloodWaits are raised instead of deferred
+PAYMENT_BATCH_SIZE = int(os.getenv("PAYMENT_BATCH_SIZE", 100)) # Star payments credited in one bulk write
+PAYMENT_BATCH_MAX_DELAY_SECONDS = float(os.getenv("PAYMENT_BATCH_MAX_DELAY_SECONDS", 0.05)) # Max time a payment waits for its batch to fill
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4)) # Concurrent notification deliveries
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5)) # Delivery attempts before a notification is marked failed
+OUTBOX_RETRY_DELAY_SECONDS = float(os.getenv("OUTBOX_RETRY_DELAY_SECONDS", 5)) # First retry delay, doubled on each attempt
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000)) # User documents kept in memory for /mystars, /my_preferences, ...
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 60)) # Max age of a cached user document
+ACTIVITY_FLUSH_INTERVAL_SECONDS = float(os.getenv("ACTIVITY_FLUSH_INTERVAL_SECONDS", 5)) # How often buffered last_activity_timestamp touches are written
+ACTIVITY_FLUSH_MAX_PENDING = int(os.getenv("ACTIVITY_FLUSH_MAX_PENDING", 1000)) # Buffered users that trigger an early flush
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", 100000)) # Users whose access_hash is kept in memory
+BALANCE_TRIGGER_MODE = os.getenv("BALANCE_TRIGGER_MODE", "off").lower() # off, event (in-process) or change_stream (needs a replica set)
+BALANCE_TRIGGER_CONCURRENCY = int(os.getenv("BALANCE_TRIGGER_CONCURRENCY", 4)) # Balance-triggered purchases running at once
+PURCHASE_CYCLE_MAX_INTERVAL_SECONDS = float(os.getenv("PURCHASE_CYCLE_MAX_INTERVAL_SECONDS", POLLING_INTERVAL_SECONDS)) # Re-run purchases this often while stock is live, even without changes
+PURCHASE_CONCURRENCY = int(os.getenv("PURCHASE_CONCURRENCY", 8)) # Users processed in parallel per purchase cycle
+PURCHASE_CURSOR_BATCH_SIZE = int(os.getenv("PURCHASE_CURSOR_BATCH_SIZE", 500)) # Queued users fetched per Mongo round trip
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", 100)) # Purchase debits grouped into one bulk write
+PURCHASE_SHARDS = int(os.getenv("PURCHASE_SHARDS", 16)) # Cluster mode: user-ID shards purchase work is split into (same value on every worker)
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", 15)) # Cluster mode: a crashed worker's leader and shard leases fail over after this long
+CLUSTER_POLL_INTERVAL_SECONDS = float(os.getenv("CLUSTER_POLL_INTERVAL_SECONDS", 1)) # Cluster mode: how often workers check for a new purchase cycle
+ORPHAN_RECOVERY_INTERVAL_SECONDS = float(os.getenv("ORPHAN_RECOVERY_INTERVAL_SECONDS", 60)) # Cluster mode: how often the leader settles work left by stopped workers
+INDEX_PLAN_CHECK = os.getenv("INDEX_PLAN_CHECK", "warn").lower() # warn, fail (refuse to start) or off when a hot query is not index-backed
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1") # Interface the Prometheus metrics endpoint listens on
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0)) # Port of the metrics endpoint (GET /metrics); 0 disables it
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()} # Telegram user IDs allowed to use /stats
+STATS_RECONCILE_INTERVAL_SECONDS = float(os.getenv("STATS_RECONCILE_INTERVAL_SECONDS", 3600)) # How often the /stats counters are recomputed from the users collection; 0 disables
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH", "") # Record incoming updates and gift option polls to this .jsonl.gz file for replay.py; empty disables
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 10000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 20000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)) # Max wait for a free pooled connection
 
 # Initialize TelegramClient
 client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
 
-# MongoDB database instance
-db = None
+# Counters and latency histograms of the hot paths (see metrics.Metrics)
+metrics = Metrics()
+
+# Serves `metrics` over HTTP when METRICS_PORT is set, created in main()
+metrics_server = None
+
+# Pre-computed queue and balance statistics for /stats (see stats.QueueStats), created in main()
+queue_stats = None
+
+# Records input traffic for replay.py when RECORD_UPDATES_PATH is set (see recording.UpdateRecorder), created in main()
+recorder = None
+
+# MongoDB data layer (see storage.Repository)
+repo = None
+
+# Incoming messages are dispatched by command token / service action type
+router = CommandRouter(metrics=metrics)
+
+# Idempotent, batched crediting of Star payments (see ledger.PaymentLedger), created in main()
+payment_ledger = None
+
+# Two-phase Star reservations around every purchase (see journal.PurchaseJournal), created in main()
+purchase_journal = None
+
+# Durable notification queue (see outbox.NotificationOutbox), created in main()
+outbox = None
+
+# Write-behind buffer of users' last_activity_timestamp (see activity.ActivityBuffer), created in main()
+activity = None
+
+# Every outbound Telegram call is paced through the gateway
+gateway = TelegramGateway(
+    client,
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    default_rate=TELEGRAM_DEFAULT_METHOD_RATE,
+    method_rates=parse_rate_limits(TELEGRAM_METHOD_RATES),
+    max_flood_wait=TELEGRAM_MAX_FLOOD_WAIT_SECONDS,
+    metrics=metrics
+)
+
+# user_id -> access_hash, so purchases and notifications skip entity-resolution RPCs
+entity_cache = EntityCache(ENTITY_CACHE_SIZE)
+
+# Starts single-user purchases as soon as a credited balance covers a live gift
+balance_trigger = BalanceTrigger(lambda user_doc, catalog: purchase_for_single_user(user_doc, catalog),
+                                 max_concurrency=BALANCE_TRIGGER_CONCURRENCY)
+
+# (options fingerprint, GiftCatalog) of the last poll; see catalog_snapshot()
+_catalog_snapshot = (None, GiftCatalog(()))
+
+# Leader and shard leases (see cluster.LeaseManager), created in main() in cluster mode only
+leases = None
+
+# Users with a purchase currently in progress, shared by polling cycles and balance triggers
+purchases_in_flight = set()
+
+# app_config key holding the last observed gift option fingerprint (see DiscoveryScheduler.state)
+GIFT_OPTIONS_STATE_KEY = "gift_options_state"
+
+# app_config key of the latest purchase cycle published by the leader in cluster mode
+PURCHASE_CYCLE_KEY = "purchase_cycle"
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Collections conceptual definition:
-# users: {
-# 'user_id': int, # Telegram User ID, Primary Key
-# 'star_balance': int, # Current number of stars the user has
-# 'last_activity_timestamp': datetime, # Timestamp of the last user activity
-# 'preferred_gift_ids': list, # List of gift IDs the user prefers
-# 'in_gift_queue': bool # Whether the user is currently in the gift queue
-# }
-# app_config: {
-# 'key': str, # Configuration key, e.g., "last_checked_gift_timestamp"
-# 'value': any # Configuration value
-# }
-
-def get_mongo_db():
-    """Initializes a MongoClient and returns the database instance."""
-    mongo_client = MongoClient(MONGO_CONNECTION_STRING)
-    return mongo_client[MONGO_DATABASE_NAME]
-
-@client.on(events.NewMessage(pattern='/start'))
-async def start_handler(event):
+def remember_sender(event):
+    """
+    Captures the sender's access_hash from an incoming update (no RPC) in the entity cache and
+    returns it, or None. Handlers that write the user record store it in that same write, so later
+    purchases and notifications need no entity lookups; handlers that only read it use store_access_hash.
+    """
+    input_sender = event.input_sender
+    if not isinstance(input_sender, InputPeerUser):
+        return None
+    entity_cache.remember(input_sender.user_id, input_sender.access_hash)
+    return input_sender.access_hash
+
+async def store_access_hash(user_id: int, access_hash: int, user_doc: dict):
+    """Stores `access_hash` on the user's existing record, read as `user_doc`, unless it is already there."""
+    if access_hash is None or not user_doc or user_doc.get('access_hash') == access_hash:
+        return
+    try:
+        await repo.set_access_hash(user_id, access_hash)
+    except Exception as e:
+        logging.warning(f"Could not store access_hash for user {user_id}: {e}")
+
+async def claim_update(event) -> bool:
+    """Cluster mode: whether this worker should handle `event`, i.e. no other worker claimed it first."""
+    try:
+        return await repo.claim_update(f"{event.chat_id}:{event.message.id}", WORKER_ID)
+    except Exception as e:
+        # Answering twice is better than not at all.
+        logging.warning(f"Could not claim update {event.message.id} from chat {event.chat_id}: {e}")
+        return True
+
+async def reply(event, text):
+    """Replies to a user's command through the gateway."""
+    return await gateway.call('SendMessage', PRIORITY_REPLY, event.reply, text)
+
+async def respond(event, text):
+    """Responds in the event's chat through the gateway."""
+    return await gateway.call('SendMessage', PRIORITY_REPLY, event.respond, text)
+
+async def send_notification(user_id: int, text):
+    """Sends an unsolicited message (e.g. purchase results) to a user through the gateway."""
+    return await gateway.call('SendMessage', PRIORITY_NOTIFICATION, client.send_message, entity_cache.input_peer(user_id), text)
+
+def get_repository():
+    """Initializes the pooled async MongoDB client and returns the data layer."""
+    return Repository.connect(
+        MONGO_CONNECTION_STRING,
+        MONGO_DATABASE_NAME,
+        max_pool_size=MONGO_MAX_POOL_SIZE,
+        min_pool_size=MONGO_MIN_POOL_SIZE,
+        server_selection_timeout_ms=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        connect_timeout_ms=MONGO_CONNECT_TIMEOUT_MS,
+        socket_timeout_ms=MONGO_SOCKET_TIMEOUT_MS,
+        wait_queue_timeout_ms=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        user_cache=UserCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS),
+        event_listeners=[MongoCommandMetrics(metrics)],
+    )
+
+@router.command('/start')
+async def start_handler(event, args: str):
     """Handles the /start command."""
+    remember_sender(event)
     # Example of how to interact with the database (optional here, can be expanded later)
     # user_id = event.sender_id
-    # users_collection = db.users
-    # user_data = await users_collection.find_one({'user_id': user_id})
+    # user_data = await repo.get_user(user_id)
     # if not user_data:
-    #     await users_collection.insert_one({
-    #         'user_id': user_id,
-    #         'star_balance': 0,
-    #         'last_activity_timestamp': datetime.utcnow(),
-    #         'preferred_gift_ids': [],
-    #         'in_gift_queue': True
-    #     })
-    await event.reply("Welcome to the Stars Bot! Here's how to get started:\n"
-                      "- Use /mystars to check your star balance.\n"
-                      "- Use /help to see all available commands.")
-
-@client.on(events.NewMessage(pattern='/help'))
-async def help_handler(event):
+    #     await repo.join_queue(user_id)
+    await reply(event, "Welcome to the Stars Bot! Here's how to get started:\n"
+                       "- Use /mystars to check your star balance.\n"
+                       "- Use /help to see all available commands.")
+
+@router.command('/help')
+async def help_handler(event, args: str):
     """Handles the /help command."""
-    await event.reply("Available commands:\n"
-                      "- /start: Show welcome message and basic instructions.\n"
-                      "- /help: Show this help message.\n"
-                      "- /mystars: Check your current star balance.\n"
-                      "- /set_preferred_gift <gift_id>: Add a gift ID to your preferences.\n"
-                      "- /my_preferences: Show your current gift preferences.\n"
-                      "- /clear_my_preferences: Clear all your gift preferences.\n"
-                      "- /join_queue: Opt-in to be considered for automatic gift purchases.\n"
-                      "- /leave_queue: Opt-out from being considered for automatic gift purchases.")
-
-@client.on(events.NewMessage(pattern='/mystars'))
-async def mystars_handler(event):
+    remember_sender(event)
+    await reply(event, "Available commands:\n"
+                       "- /start: Show welcome message and basic instructions.\n"
+                       "- /help: Show this help message.\n"
+                       "- /mystars: Check your current star balance.\n"
+                       "- /set_preferred_gift <gift_id>: Add a gift ID to your preferences.\n"
+                       "- /my_preferences: Show your current gift preferences.\n"
+                       "- /clear_my_preferences: Clear all your gift preferences.\n"
+                       "- /join_queue: Opt-in to be considered for automatic gift purchases.\n"
+                       "- /leave_queue: Opt-out from being considered for automatic gift purchases.")
+
+@router.command('/mystars')
+async def mystars_handler(event, args: str):
     """Handles the /mystars command to check star balance."""
+    access_hash = remember_sender(event)
     user_id = event.sender_id
     try:
-        user_doc = await db.users.find_one({'user_id': user_id})
+        user_doc = await repo.get_user(user_id)
         if user_doc:
+            await store_access_hash(user_id, access_hash, user_doc)
             star_balance = user_doc.get('star_balance', 0)
-            await event.reply(f"Your current star balance is: {star_balance} Stars.")
+            await reply(event, f"Your current star balance is: {star_balance} Stars.")
         else:
-            await event.reply("I don't have a record of your star balance yet. Try sending some Stars to the bot first, or use /join_queue to create a record!")
+            await reply(event, "I don't have a record of your star balance yet. Try sending some Stars to the bot first, or use /join_queue to create a record!")
     except Exception as e:
         logging.error(f"Error in /mystars for user {user_id}: {e}", exc_info=True)
-        await event.reply("Sorry, I couldn't retrieve your star balance at this time.")
+        await reply(event, "Sorry, I couldn't retrieve your star balance at this time.")
 
-@client.on(events.NewMessage(pattern='/join_queue'))
-async def join_queue_handler(event):
+@router.command('/join_queue')
+async def join_queue_handler(event, args: str):
     """Handles the /join_queue command."""
+    access_hash = remember_sender(event)
     user_id = event.sender_id
     try:
-        update_result = await db.users.update_one(
-            {'user_id': user_id},
-            {
-                '$set': {'in_gift_queue': True, 'last_activity_timestamp': datetime.utcnow()},
-                '$setOnInsert': {'star_balance': 0, 'preferred_gift_ids': [], 'user_id': user_id}
-            },
-            upsert=True
-        )
-        if update_result.acknowledged:
-            if update_result.upserted_id:
-                logging.info(f"User {user_id} joined queue (new user created).")
-                await event.reply("You are now in the queue and will be considered for gifts! Since you're new, your star balance is 0.")
-            else:
-                logging.info(f"User {user_id} re-joined or confirmed in queue.")
-                await event.reply("You are now in the queue and will be considered for gifts.")
+        previous = await repo.join_queue(user_id, access_hash=access_hash)
+        activity.touch(user_id)
+        if previous is None:
+            logging.info(f"User {user_id} joined queue (new user created).")
+            await reply(event, "You are now in the queue and will be considered for gifts! Since you're new, your star balance is 0.")
         else:
-            logging.error(f"Failed to acknowledge /join_queue for user {user_id}")
-            await event.reply("Sorry, there was an issue processing your request. Please try again.")
+            logging.info(f"User {user_id} re-joined or confirmed in queue.")
+            await reply(event, "You are now in the queue and will be considered for gifts.")
     except Exception as e:
         logging.error(f"Error in /join_queue for user {user_id}: {e}", exc_info=True)
-        await event.reply("An error occurred while trying to join the queue. Please try again later.")
+        await reply(event, "An error occurred while trying to join the queue. Please try again later.")
 
-@client.on(events.NewMessage(pattern='/leave_queue'))
-async def leave_queue_handler(event):
+@router.command('/leave_queue')
+async def leave_queue_handler(event, args: str):
     """Handles the /leave_queue command."""
+    access_hash = remember_sender(event)
     user_id = event.sender_id
     try:
-        update_result = await db.users.update_one(
-            {'user_id': user_id},
-            {
-                '$set': {'in_gift_queue': False, 'last_activity_timestamp': datetime.utcnow()}
-            },
-            upsert=False # Do not create a user if they don't exist
-        )
-        if update_result.acknowledged:
-            if update_result.matched_count > 0:
-                logging.info(f"User {user_id} left queue.")
-                await event.reply("You have been removed from the gift queue.")
-            else:
-                logging.info(f"User {user_id} tried to leave queue, but was not found or not in queue initially.")
-                await event.reply("You were not in the queue, or I don't have a record for you.")
+        previous = await repo.leave_queue(user_id, access_hash=access_hash)
+        activity.touch(user_id)
+        if previous is not None:
+            logging.info(f"User {user_id} left queue.")
+            await reply(event, "You have been removed from the gift queue.")
         else:
-            logging.error(f"Failed to acknowledge /leave_queue for user {user_id}")
-            await event.reply("Sorry, there was an issue processing your request. Please try again.")
+            logging.info(f"User {user_id} tried to leave queue, but was not found or not in queue initially.")
+            await reply(event, "You were not in the queue, or I don't have a record for you.")
     except Exception as e:
         logging.error(f"Error in /leave_queue for user {user_id}: {e}", exc_info=True)
-        await event.reply("An error occurred while trying to leave the queue. Please try again later.")
+        await reply(event, "An error occurred while trying to leave the queue. Please try again later.")
 
-@client.on(events.NewMessage(pattern=r'/set_preferred_gift(?: |$)(.*)'))
-async def set_preference_handler(event):
+@router.command('/set_preferred_gift')
+async def set_preference_handler(event, args: str):
     """Handles the /set_preferred_gift <gift_identifier> command."""
+    access_hash = remember_sender(event)
     user_id = event.sender_id
-    gift_identifier_str = event.pattern_match.group(1).strip()
+    gift_identifier_str = args
 
     if not gift_identifier_str:
-        await event.reply("Please provide a gift identifier. Usage: /set_preferred_gift <gift_id>")
+        await reply(event, "Please provide a gift identifier. Usage: /set_preferred_gift <gift_id>")
         return
 
     try:
         # Assuming gift_identifier is a numerical ID. Telegram PremiumGiftOption IDs are long.
         gift_identifier_long = int(gift_identifier_str)
     except ValueError:
-        await event.reply("Invalid gift identifier. It must be a number.")
+        await reply(event, "Invalid gift identifier. It must be a number.")
         return
 
     try:
-        users_collection = db.users
-        update_result = await users_collection.update_one(
-            {'user_id': user_id},
-            {
-                '$addToSet': {'preferred_gift_ids': gift_identifier_long},
-                '$set': {'last_activity_timestamp': datetime.utcnow()},
-                '$setOnInsert': {
-                    'star_balance': 0,
-                    'in_gift_queue': True,
-                    'user_id': user_id, # Ensure user_id is set on insert
-                    # preferred_gift_ids will be handled by $addToSet
-                }
-            },
-            upsert=True
-        )
-
-        if update_result.acknowledged:
-            logging.info(f"User {user_id} added/updated gift preference: {gift_identifier_long}. Upserted: {update_result.upserted_id is not None}")
-            await event.reply(f"Preference for gift ID {gift_identifier_long} has been saved.")
-        else:
-            logging.error(f"Failed to update preferences for user {user_id}.")
-            await event.reply("Sorry, there was an issue saving your preference. Please try again.")
+        previous = await repo.add_preferred_gift(user_id, gift_identifier_long, access_hash=access_hash)
+        activity.touch(user_id)
+        logging.info(f"User {user_id} added/updated gift preference: {gift_identifier_long}. Upserted: {previous is None}")
+        await reply(event, f"Preference for gift ID {gift_identifier_long} has been saved.")
 
     except Exception as e:
         logging.error(f"Error in /set_preferred_gift for user {user_id}: {e}", exc_info=True)
-        await event.reply("An error occurred while saving your preference. Please try again later.")
+        await reply(event, "An error occurred while saving your preference. Please try again later.")
 
-@client.on(events.NewMessage(pattern='/my_preferences'))
-async def my_preferences_handler(event):
+@router.command('/my_preferences')
+async def my_preferences_handler(event, args: str):
     """Handles the /my_preferences command."""
+    access_hash = remember_sender(event)
     user_id = event.sender_id
     try:
-        users_collection = db.users
-        user_data = await users_collection.find_one({'user_id': user_id})
+        user_data = await repo.get_user(user_id)
+        await store_access_hash(user_id, access_hash, user_data)
 
         if user_data and user_data.get('preferred_gift_ids'):
             preferences = user_data['preferred_gift_ids']
             if preferences:
                 pref_list_str = "\n".join(f"- {gid}" for gid in preferences)
-                await event.reply(f"Your current gift preferences are:\n{pref_list_str}")
+                await reply(event, f"Your current gift preferences are:\n{pref_list_str}")
             else:
-                await event.reply("You have no gift preferences set. Use /set_preferred_gift <gift_id> to add one.")
+                await reply(event, "You have no gift preferences set. Use /set_preferred_gift <gift_id> to add one.")
         else:
-            await event.reply("You have no gift preferences set, or no record found. Use /set_preferred_gift <gift_id> to add one.")
+            await reply(event, "You have no gift preferences set, or no record found. Use /set_preferred_gift <gift_id> to add one.")
             # Optionally, create a basic user record if none found, though /set_preferred_gift would also do this.
-            # await users_collection.update_one(
-            #     {'user_id': user_id},
-            #     {'$setOnInsert': {'star_balance': 0, 'last_activity_timestamp': datetime.utcnow(), 'preferred_gift_ids': [], 'in_gift_queue': True, 'user_id': user_id}},
-            #     upsert=True
-            # )
+            # await repo.join_queue(user_id)
 
     except Exception as e:
         logging.error(f"Error in /my_preferences for user {user_id}: {e}", exc_info=True)
-        await event.reply("An error occurred while fetching your preferences. Please try again later.")
+        await reply(event, "An error occurred while fetching your preferences. Please try again later.")
 
-@client.on(events.NewMessage(pattern='/clear_my_preferences'))
-async def clear_preferences_handler(event):
+@router.command('/clear_my_preferences')
+async def clear_preferences_handler(event, args: str):
     """Handles the /clear_my_preferences command."""
+    access_hash = remember_sender(event)
     user_id = event.sender_id
     try:
-        users_collection = db.users
-        update_result = await users_collection.update_one(
-            {'user_id': user_id},
-            {
-                '$set': {'preferred_gift_ids': [], 'last_activity_timestamp': datetime.utcnow()}
-            }
-            # No upsert needed; if the user doesn't exist, there's nothing to clear.
-        )
-
-        if update_result.acknowledged:
-            if update_result.matched_count > 0:
-                logging.info(f"Cleared gift preferences for user {user_id}.")
-                await event.reply("Your gift preferences have been cleared.")
-            else:
-                logging.info(f"User {user_id} had no preferences to clear or no record found.")
-                await event.reply("You had no preferences set, or no record was found.")
+        previous = await repo.clear_preferences(user_id, access_hash=access_hash)
+        activity.touch(user_id)
+        if previous is not None:
+            logging.info(f"Cleared gift preferences for user {user_id}.")
+            await reply(event, "Your gift preferences have been cleared.")
         else:
-            logging.error(f"Failed to clear preferences for user {user_id}.")
-            await event.reply("Sorry, there was an issue clearing your preferences. Please try again.")
+            logging.info(f"User {user_id} had no preferences to clear or no record found.")
+            await reply(event, "You had no preferences set, or no record was found.")
 
     except Exception as e:
         logging.error(f"Error in /clear_my_preferences for user {user_id}: {e}", exc_info=True)
-        await event.reply("An error occurred while clearing your preferences. Please try again later.")
+        await reply(event, "An error occurred while clearing your preferences. Please try again later.")
 
-@client.on(events.NewMessage(incoming=True))
-async def handle_star_reception(event):
-    """Handles incoming messages, specifically looking for Star payments."""
-    if event.message and isinstance(event.message, MessageService) and isinstance(event.message.action, MessageActionPaymentSent):
-        try:
-            payment_action = event.message.action
-            currency = payment_action.currency
-            stars_received_amount = payment_action.total_amount
-
-            if currency == 'XTR': # XTR is the currency code for Telegram Stars
-                user_id = event.message.peer_id.user_id if event.message.peer_id else event.sender_id
-                if not user_id:
-                    logging.error("Could not extract user_id from star payment event.")
-                    return
-
-                logging.info(f"Received {stars_received_amount} Stars from user_id: {user_id}")
-
-                users_collection = db.users
-                update_result = await users_collection.update_one(
-                    {'user_id': user_id},
-                    {
-                        '$inc': {'star_balance': stars_received_amount},
-                        '$set': {'last_activity_timestamp': datetime.utcnow()},
-                        '$setOnInsert': {
-                            'preferred_gift_ids': [],
-                            'in_gift_queue': True,
-                            'user_id': user_id  # Ensure user_id is set on insert
-                        }
-                    },
-                    upsert=True
-                )
-
-                if update_result.acknowledged:
-                    logging.info(f"Database updated for user_id: {user_id}. Matched: {update_result.matched_count}, Modified: {update_result.modified_count}, UpsertedId: {update_result.upserted_id}")
-
-                    # Fetch the user's new balance
-                    user_data = await users_collection.find_one({'user_id': user_id})
-                    new_balance = user_data.get('star_balance', 0) if user_data else 0
-
-                    await event.respond(f"Thank you! Received {stars_received_amount} Stars. Your new balance is {new_balance} Stars.")
-                    logging.info(f"Sent acknowledgement to user_id: {user_id}. New balance: {new_balance}")
-                else:
-                    logging.error(f"Database update failed for user_id: {user_id}")
-                    await event.respond("Sorry, there was an issue processing your Stars. Please contact support.")
+@router.command('/stats')
+async def stats_handler(event, args: str):
+    """Handles the admin /stats command: queue and balance statistics, read from the pre-computed counters."""
+    user_id = event.sender_id
+    if user_id not in ADMIN_USER_IDS:
+        logging.info(f"User {user_id} tried /stats without being an admin.")
+        await reply(event, "Sorry, /stats is only available to administrators.")
+        return
+    try:
+        await reply(event, format_stats(await queue_stats.read()))
+    except Exception as e:
+        logging.error(f"Error in /stats for user {user_id}: {e}", exc_info=True)
+        await reply(event, "An error occurred while fetching the statistics. Please try again later.")
 
+@router.action(MessageActionPaymentSent)
+@router.action(MessageActionPaymentSentMe)
+async def handle_star_reception(event):
+    """Handles Star payment service messages (routed by action type, see CommandRouter)."""
+    try:
+        payment_action = event.message.action
+        currency = payment_action.currency
+        stars_received_amount = payment_action.total_amount
+        # The charge ID makes redelivered payments idempotent; without one, the message identifies the payment.
+        charge = getattr(payment_action, 'charge', None)
+        charge_id = charge.id if charge else f"message:{event.chat_id}:{event.message.id}"
+
+        if currency == 'XTR': # XTR is the currency code for Telegram Stars
+            user_id = event.message.peer_id.user_id if event.message.peer_id else event.sender_id
+            if not user_id:
+                logging.error("Could not extract user_id from star payment event.")
+                return
+
+            logging.info(f"Received {stars_received_amount} Stars from user_id: {user_id}")
+            access_hash = remember_sender(event)
+
+            # Recorded in the payments ledger and credited in a batch with other concurrent payments
+            user_data = await payment_ledger.record(Payment(
+                charge_id=charge_id,
+                user_id=user_id,
+                amount=stars_received_amount,
+                currency=currency,
+                provider_charge_id=charge.provider_charge_id if charge else None
+            ))
+
+            if user_data is None:
+                logging.warning(f"Payment {charge_id} from user_id: {user_id} was already credited. Ignoring redelivery.")
             else:
-                logging.info(f"Received payment in currency {currency}, not XTR. Ignoring.")
+                activity.touch(user_id)
+                # The credit created the record if needed; the hash is stored once.
+                await store_access_hash(user_id, access_hash, user_data)
+                new_balance = user_data.get('star_balance', 0)
+                logging.info(f"Database updated for user_id: {user_id}. New balance: {new_balance}")
+                if BALANCE_TRIGGER_MODE == "event":
+                    balance_trigger.notify(user_data)
 
-        except Exception as e:
-            logging.error(f"Error processing star payment: {e}", exc_info=True)
-            try:
-                await event.respond("An error occurred while processing your payment. Please try again later or contact support.")
-            except Exception as resp_e:
-                logging.error(f"Error sending error response to user: {resp_e}")
+                await respond(event, f"Thank you! Received {stars_received_amount} Stars. Your new balance is {new_balance} Stars.")
+                logging.info(f"Sent acknowledgement to user_id: {user_id}. New balance: {new_balance}")
 
+        else:
+            logging.info(f"Received payment in currency {currency}, not XTR. Ignoring.")
+
+    except Exception as e:
+        logging.error(f"Error processing star payment: {e}", exc_info=True)
+        try:
+            await respond(event, "An error occurred while processing your payment. Please try again later or contact support.")
+        except Exception as resp_e:
+            logging.error(f"Error sending error response to user: {resp_e}")
+
+@client.on(events.NewMessage(incoming=True))
+async def dispatch_update(event):
+    """Single entry point for incoming messages; see CommandRouter."""
+    if recorder is not None:
+        recorder.record_update(event)
+    # In cluster mode every worker receives the bot's updates. Payments are credited once by the
+    # ledger whichever workers handle them; other messages are answered by the first worker to claim them.
+    if leases is not None and event.message.action is None and not await claim_update(event):
+        return
+    await router.dispatch(event)
 
-async def main():
-    """Main function to initialize the database and run the bot."""
-    global db
-    db = get_mongo_db()
 
-    # Create indexes
-    # For users collection, ensure user_id is unique and indexed for fast lookups
-    # Make sure this is awaited if your pymongo version returns an awaitable
-    if hasattr(db.users, 'create_index'): # For synchronous pymongo
-        db.users.create_index('user_id', unique=True)
-    else: # For motor or other async pymongo wrappers
-        await db.users.create_index('user_id', unique=True)
+async def start_services():
+    """
+    Connects the data layer and starts every background component the handlers rely on.
+    Used by main() and by tools that drive the handlers with a stand-in client (see benchmark.py).
+    Returns the background index build task, or None.
+    """
+    global repo
+    repo = get_repository()
+
+    # Unique indexes now; query indexes are built and their plans checked in the background (see indexes.py)
+    index_task = await indexes.ensure_indexes(repo, plan_check=INDEX_PLAN_CHECK,
+                                              shard_count=PURCHASE_SHARDS if WORKER_MODE == "cluster" else None)
+
+    # Credit payments that were recorded but not applied before the last shutdown
+    global payment_ledger
+    payment_ledger = PaymentLedger(repo, batch_size=PAYMENT_BATCH_SIZE, max_delay=PAYMENT_BATCH_MAX_DELAY_SECONDS)
+    await payment_ledger.recover()
+
+    # Load stored access hashes so purchases and notifications can address users directly
+    await entity_cache.warm(repo)
+
+    # Notifications are delivered in the background; replay anything left over from the last run
+    global outbox
+    outbox = NotificationOutbox(repo, send_notification, workers=OUTBOX_WORKERS,
+                                max_attempts=OUTBOX_MAX_ATTEMPTS, retry_delay=OUTBOX_RETRY_DELAY_SECONDS,
+                                owner=WORKER_ID if WORKER_MODE == "cluster" else None)
+    await outbox.start()
+
+    # Activity timestamps are written behind, in bulk
+    global activity
+    activity = ActivityBuffer(repo, flush_interval=ACTIVITY_FLUSH_INTERVAL_SECONDS, max_pending=ACTIVITY_FLUSH_MAX_PENDING)
+    activity.start()
+
+    # Settle purchases a crash left half done: commit the ones that went through, refund the rest
+    global purchase_journal
+    purchase_journal = PurchaseJournal(repo, owner=WORKER_ID if WORKER_MODE == "cluster" else None)
+    await purchase_journal.recover()
+
+    # Cluster mode: join the other workers; leadership and shards are settled by the lease heartbeat
+    global leases
+    if WORKER_MODE == "cluster":
+        leases = LeaseManager(repo, WORKER_ID, shard_count=PURCHASE_SHARDS, ttl=LEASE_TTL_SECONDS)
+        await leases.heartbeat()
+        leases.start()
+        logging.info(f"Worker {WORKER_ID} started in cluster mode (leader: {leases.is_leader}, shards: {leases.shards}).")
+
+    # Expose the components' own counters next to the hot-path timings
+    metrics.collect('cache_lookups_total', lambda: entity_cache.hits, cache='entity', result='hit')
+    metrics.collect('cache_lookups_total', lambda: entity_cache.misses, cache='entity', result='miss')
+    metrics.collect('cache_lookups_total', lambda: repo.user_cache.hits, cache='user', result='hit')
+    metrics.collect('cache_lookups_total', lambda: repo.user_cache.misses, cache='user', result='miss')
+    metrics.collect('payments_total', lambda: payment_ledger.recorded, result='credited')
+    metrics.collect('payments_total', lambda: payment_ledger.duplicates, result='duplicate')
+    metrics.collect('outbox_depth', outbox.depth, kind='gauge')
+    global metrics_server
+    if METRICS_PORT:
+        metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT)
+        await metrics_server.start()
+
+    # /stats counters are kept current by the repository; the reconcile corrects drift (leader only in cluster mode)
+    global queue_stats
+    queue_stats = QueueStats(repo, interval=STATS_RECONCILE_INTERVAL_SECONDS,
+                             is_active=lambda: leases is None or leases.is_leader)
+    queue_stats.start()
+
+    global recorder
+    if RECORD_UPDATES_PATH:
+        recorder = UpdateRecorder(RECORD_UPDATES_PATH)
+        logging.info(f"Recording updates and gift option polls to {RECORD_UPDATES_PATH}.")
+    return index_task
+
+async def stop_services():
+    """Stops the components started by start_services(), flushing what they buffer."""
+    if leases is not None:
+        await leases.stop()
+    await activity.stop()
+    await queue_stats.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    if recorder is not None:
+        recorder.close()
+    await repo.close()
 
-    # For app_config collection, ensure key is unique (optional, depends on usage)
-    # if hasattr(db.app_config, 'create_index'):
-    #     db.app_config.create_index('key', unique=True)
-    # else:
-    #     await db.app_config.create_index('key', unique=True)
 
+async def main():
+    """Main function to initialize the database and run the bot."""
+    index_task = await start_services()
 
     await client.start(bot_token=BOT_TOKEN)
-    print(f"Bot started successfully! Connected as: {await client.get_me()}")
-
-    # --- Placeholder for testing discover_limited_gifts (now handled by polling_loop) ---
-    # DEBUG_MODE = False # Or load from env
-    # if DEBUG_MODE:
-    #     logging.info("DEBUG_MODE: Attempting to discover limited gifts on startup...")
-    #     try:
-    #         limited_gifts = await discover_limited_gifts()
-    #         if limited_gifts:
-    #             logging.info(f"DEBUG_MODE: Found {len(limited_gifts)} limited and available gifts:")
-    #             for gift in limited_gifts:
-    #                 logging.info(f"  - ID: {gift['id']}, Stars: {gift['stars']}, Months: {gift['months']}, Product: {gift.get('store_product', 'N/A')}, Desc: {gift.get('description', 'N/A')}")
-    #         else:
-    #             logging.info("DEBUG_MODE: No limited and available gifts found or an error occurred.")
-    #     except Exception as e:
-    #         logging.error(f"DEBUG_MODE: Error calling discover_limited_gifts on startup: {e}", exc_info=True)
-    # --- End of placeholder ---
+    me = await client.get_me()
+    router.username = me.username
+    print(f"Bot started successfully! Connected as: {me}")
 
     # Start the polling loop as a concurrent task
-    logging.info(f"Creating polling loop task with interval: {POLLING_INTERVAL_SECONDS} seconds.")
+    logging.info(f"Creating polling loop task (fast interval: {DISCOVERY_FAST_INTERVAL_SECONDS}s, slow interval: {POLLING_INTERVAL_SECONDS}s).")
     polling_task = asyncio.create_task(polling_loop())
     logging.info("Polling task created.")
+    if leases is not None:
+        cluster_task = asyncio.create_task(cluster_purchase_loop())
+        orphan_task = asyncio.create_task(orphan_recovery_loop())
+        logging.info("Cluster purchase and orphan recovery tasks created.")
+    if BALANCE_TRIGGER_MODE == "change_stream":
+        trigger_task = asyncio.create_task(balance_trigger.watch(repo))
+        logging.info("Balance trigger change stream task created.")
 
     await client.run_until_disconnected()
     logging.info("Client disconnected. Waiting for polling task to complete...")
     await polling_task # Ensure polling task is awaited on graceful exit if it's not a daemon
     logging.info("Polling task finished.")
+    await stop_services()
 
 
+def discovery_scheduler() -> DiscoveryScheduler:
+    """A DiscoveryScheduler with the configured poll intervals."""
+    return DiscoveryScheduler(
+        fast_interval=DISCOVERY_FAST_INTERVAL_SECONDS,
+        slow_interval=POLLING_INTERVAL_SECONDS,
+        max_cycle_interval=PURCHASE_CYCLE_MAX_INTERVAL_SECONDS,
+        jitter=DISCOVERY_JITTER
+    )
+
 async def polling_loop():
-    """Periodically discovers limited gifts and processes purchases."""
+    """
+    Polls the gift option list and runs purchase cycles when it changes.
+    Pacing and change detection are handled by DiscoveryScheduler; the last seen
+    option fingerprint is kept in app_config so restarts do not re-trigger old drops.
+    In cluster mode only the leader polls, and its purchase cycles are published to all
+    workers (see publish_purchase_cycle) instead of being run here.
+    """
+    scheduler = discovery_scheduler()
+    restored = False
+
     while True:
-        logging.info("Polling loop started a new cycle.")
-        try:
-            available_gifts = await discover_limited_gifts()
-            if available_gifts:
-                logging.info(f"Discovered {len(available_gifts)} limited gifts. Processing purchases...")
-                await process_gift_purchases(available_gifts)
-            else:
-                logging.info("No limited gifts discovered in this cycle.")
+        if leases is not None and not leases.is_leader:
+            # Followers only run the cycles the leader publishes; restore again if leadership moves here.
+            restored = False
+            await asyncio.sleep(CLUSTER_POLL_INTERVAL_SECONDS)
+            continue
+        if not restored:
+            try:
+                scheduler.restore(await repo.get_config(GIFT_OPTIONS_STATE_KEY))
+            except Exception as e:
+                logging.error(f"Polling loop could not restore the last gift option fingerprint: {e}", exc_info=True)
+            restored = True
 
+        logging.debug("Polling loop started a new cycle.")
+        try:
+            await poll_once(scheduler)
         except Exception as e:
             logging.error(f"Polling loop encountered an error in its cycle: {e}", exc_info=True)
 
-        logging.info(f"Polling cycle finished. Waiting for {POLLING_INTERVAL_SECONDS} seconds...")
-        await asyncio.sleep(POLLING_INTERVAL_SECONDS)
+        delay = scheduler.next_delay()
+        logging.debug(f"Polling cycle finished. Waiting for {delay:.1f} seconds...")
+        await asyncio.sleep(delay)
+
+async def poll_once(scheduler: DiscoveryScheduler):
+    """One iteration of polling_loop: polls the gift options and runs (or publishes) a purchase cycle if one is due."""
+    options = await fetch_gift_options()
+    if recorder is not None:
+        recorder.record_options(options)
+    if options is None:
+        scheduler.record_error()
+        return
 
-async def discover_limited_gifts():
+    change = scheduler.observe(options)
+    if change.changed:
+        await repo.set_config(GIFT_OPTIONS_STATE_KEY, scheduler.state())
+    catalog = catalog_snapshot(options, scheduler.fingerprint)
+    balance_trigger.update_catalog(catalog)
+
+    if scheduler.cycle_due(change):
+        logging.info(f"Discovered {len(catalog)} limited gifts ({len(change.new_limited_ids)} new). Processing purchases...")
+        scheduler.record_cycle()
+        if leases is not None:
+            await publish_purchase_cycle(catalog, change.new_limited_ids)
+        else:
+            await process_gift_purchases(catalog, change.new_limited_ids)
+    elif not change.limited_live:
+        logging.debug("No limited gifts discovered in this cycle.")
+    else:
+        logging.debug("Gift options unchanged. Skipping purchase cycle.")
+
+async def publish_purchase_cycle(catalog: GiftCatalog, new_gift_ids: set = None):
+    """Cluster mode: hands a purchase cycle to every worker, each of which runs it for its own shards."""
+    # Write buffered activity first so the queue's FIFO order includes everything seen so far.
+    await activity.flush()
+    cycle = {
+        'cycle_id': uuid.uuid4().hex,
+        'started_at': datetime.utcnow(),
+        'gifts': [asdict(gift) for gift in catalog.gifts],
+        'new_gift_ids': list(new_gift_ids or ()),
+    }
+    await repo.set_config(PURCHASE_CYCLE_KEY, cycle)
+    logging.info(f"Published purchase cycle {cycle['cycle_id']} with {len(catalog)} gift(s).")
+
+async def cluster_purchase_loop():
     """
-    Discovers available limited (not sold out) Telegram Premium gift options.
-    Returns a list of dictionaries, each representing an available limited gift.
+    Cluster mode: runs each purchase cycle published by the leader for the shards this worker holds,
+    including shards taken over from a failed worker before it finished the cycle.
+    """
+    last_cycle_id = None
+    catalog = GiftCatalog(())
+    while True:
+        await asyncio.sleep(CLUSTER_POLL_INTERVAL_SECONDS)
+        try:
+            cycle = await repo.get_config(PURCHASE_CYCLE_KEY)
+            if not cycle:
+                continue
+            if cycle['cycle_id'] != last_cycle_id:
+                last_cycle_id = cycle['cycle_id']
+                # Rebuilt once per published cycle, then shared by every purchase of it.
+                catalog = GiftCatalog(GiftOption(**gift) for gift in cycle['gifts'])
+                balance_trigger.update_catalog(catalog)
+            # The leader publishes at least this often while stock is live; older cycles are not replayed.
+            if datetime.utcnow() - cycle['started_at'] > timedelta(seconds=PURCHASE_CYCLE_MAX_INTERVAL_SECONDS):
+                continue
+            shards = leases.shards_behind(cycle['cycle_id'])
+            if shards:
+                logging.info(f"Running purchase cycle {cycle['cycle_id']} for shards {shards}.")
+                await process_gift_purchases(catalog, set(cycle['new_gift_ids']),
+                                             shards=shards, cycle_started_at=cycle['started_at'])
+                await leases.mark_done(shards, cycle['cycle_id'])
+        except Exception as e:
+            logging.error(f"Cluster purchase loop encountered an error: {e}", exc_info=True)
+
+async def orphan_recovery_loop():
+    """
+    Cluster mode: the leader settles purchase journal entries and delivers notifications left by
+    workers whose heartbeat lease has expired, e.g. after a scale-down or when a worker restarted
+    under another WORKER_ID.
+    """
+    while True:
+        await asyncio.sleep(ORPHAN_RECOVERY_INTERVAL_SECONDS)
+        if not leases.is_leader:
+            continue
+        try:
+            live_workers = await leases.live_workers()
+            await purchase_journal.recover_orphans(live_workers)
+            await outbox.adopt_orphans(live_workers)
+        except Exception as e:
+            logging.error(f"Orphan recovery loop encountered an error: {e}", exc_info=True)
+
+@metrics.timed('discovery_seconds')
+async def fetch_gift_options():
+    """
+    Requests the current Telegram Premium gift options.
+    Returns the list of raw options, or None if the request failed.
     """
-    available_limited_gifts = []
     try:
         # Construct the request. Using InputPeerSelf() to see general options.
         # If this needs a specific user context for limited gifts, this might need adjustment.
         request = GetPremiumGiftCodeOptionsRequest(peer=InputPeerSelf())
-        result = await client(request)
-
-        if not result or not hasattr(result, 'options'):
-            logging.warning("discover_limited_gifts: No options found or unexpected result structure.")
-            return []
-
-        logging.info(f"discover_limited_gifts: Received {len(result.options)} total gift options from API.")
-
-        for option in result.options:
-            # Flags: option.flags
-            # Bit 0 (0x1) seems to be 'limited'
-            # Bit 1 (0x2) seems to be 'sold_out'
-            is_limited = bool(option.flags & (1 << 0)) # Check if the 'limited' flag (bit 0) is set
-            is_sold_out = bool(option.flags & (1 << 1)) # Check if the 'sold_out' flag (bit 1) is set
-
-            # We are interested in gifts that are limited AND NOT sold_out
-            if is_limited and not is_sold_out:
-                gift_details = {
-                    'id': option.id,
-                    'stars': option.stars,
-                    'months': option.months,
-                    'currency': option.currency,
-                    'amount': option.amount,
-                    'store_product': option.store_product,
-                    'description': option.description, # This might be a generic description
-                    # 'sticker': option.sticker, # Could be useful for display
-                    # 'video': option.video, # Could be useful for display
-                    # 'video_mime_type': option.video_mime_type,
-                    # 'video_duration': option.video_duration,
-                    'raw_option': option # Store the raw option for any further details if needed
-                }
-                available_limited_gifts.append(gift_details)
-                logging.info(f"discover_limited_gifts: Found available limited gift: ID={option.id}, Stars={option.stars}, Months={option.months}")
-            # else:
-            #     logging.debug(f"discover_limited_gifts: Skipping option ID={option.id}, limited={is_limited}, sold_out={is_sold_out}")
-
-
-        logging.info(f"discover_limited_gifts: Found {len(available_limited_gifts)} limited and available gifts.")
-
+        result = await gateway.request(request, PRIORITY_DISCOVERY)
     except RPCError as e:
-        logging.error(f"discover_limited_gifts: Telegram API RPCError: {e.code} - {e.message}", exc_info=True)
+        logging.error(f"fetch_gift_options: Telegram API RPCError: {e.code} - {e.message}", exc_info=True)
+        return None
     except Exception as e:
-        logging.error(f"discover_limited_gifts: An unexpected error occurred: {e}", exc_info=True)
+        logging.error(f"fetch_gift_options: An unexpected error occurred: {e}", exc_info=True)
+        return None
+
+    if not result or not hasattr(result, 'options'):
+        logging.warning("fetch_gift_options: No options found or unexpected result structure.")
+        return []
+
+    logging.debug(f"fetch_gift_options: Received {len(result.options)} total gift options from API.")
+    return result.options
+
+def limited_gifts_from_options(options) -> tuple:
+    """
+    Filters raw gift options down to available limited (not sold out) gifts.
+    Returns a tuple of GiftOptions, each representing an available limited gift.
+    """
+    available_limited_gifts = []
+    for option in options:
+        # We are interested in gifts that are limited AND NOT sold_out
+        if is_live_limited(option.flags):
+            available_limited_gifts.append(GiftOption.from_option(option))
+            logging.debug(f"limited_gifts_from_options: Found available limited gift: ID={option.id}, Stars={option.stars}, Months={option.months}")
 
-    return available_limited_gifts
+    logging.debug(f"limited_gifts_from_options: Found {len(available_limited_gifts)} limited and available gifts.")
+    return tuple(available_limited_gifts)
 
-async def process_gift_purchases(available_gifts: list):
+def catalog_snapshot(options, fingerprint: str) -> GiftCatalog:
+    """
+    Returns the catalog for the polled `options`. It is rebuilt only when their fingerprint changes;
+    otherwise the previous cycle's catalog, and the GiftOptions in it, are reused as they are.
     """
-    Processes gift purchases for users based on their star balance, preferences, and available gifts.
+    global _catalog_snapshot
+    cached_fingerprint, catalog = _catalog_snapshot
+    if fingerprint is None or fingerprint != cached_fingerprint:
+        catalog = GiftCatalog(limited_gifts_from_options(options))
+        _catalog_snapshot = (fingerprint, catalog)
+    return catalog
+
+async def process_gift_purchases(catalog: GiftCatalog, new_gift_ids: set = None, shards: list = None,
+                                 cycle_started_at: datetime = None):
     """
-    if not available_gifts:
+    Processes gift purchases for users based on their star balance, preferences, and the gifts in `catalog`.
+    Up to PURCHASE_CONCURRENCY users are processed at once, dispatched in queue (FIFO) order.
+    If `new_gift_ids` names gifts that just appeared, the users who asked for them are served first.
+    In cluster mode, `shards` limits the cycle to this worker's users and `cycle_started_at` is the
+    leader's cycle start.
+    Each stage is timed, and the cycle ends with a summary of everything the metrics recorded meanwhile.
+    """
+    if not catalog:
         logging.info("process_gift_purchases: No available gifts to process.")
         return
 
-    try:
-        # Fetch users who have star_balance > 0 and are in the gift queue
-        # Sort by last_activity_timestamp (ascending) for FIFO, or by star_balance (descending) to prioritize high-balance users.
-        # For now, let's do FIFO for users in queue.
-        users_to_process_cursor = db.users.find({
-            'star_balance': {'$gt': 0},
-            'in_gift_queue': True
-        }).sort('last_activity_timestamp', 1) # 1 for ascending
-
-        users_processed_count = 0
-        for user_doc_summary in await users_to_process_cursor.to_list(length=None): # Process all eligible users in one cycle for now
-            user_id = user_doc_summary['user_id']
-
-            # Get fresh user data, especially star balance, within the loop for atomicity
-            user_doc = await db.users.find_one({'user_id': user_id})
-            if not user_doc or not user_doc.get('in_gift_queue') or user_doc.get('star_balance', 0) <= 0:
-                logging.info(f"process_gift_purchases: Skipping user {user_id}, no longer eligible (no balance, not in queue, or no doc).")
-                continue
+    metrics_before = metrics.snapshot()
+    cycle_clock = time.monotonic()
 
-            current_star_balance = user_doc.get('star_balance', 0)
-            preferred_gift_ids = user_doc.get('preferred_gift_ids', [])
-
-            gift_to_purchase = None
-            purchase_reason = ""
-            selected_gift_details = None
-
-            # A. Check Preferred Gifts
-            if preferred_gift_ids:
-                for pref_id in preferred_gift_ids:
-                    gift_option = next((g for g in available_gifts if g['id'] == pref_id), None)
-                    if gift_option and current_star_balance >= gift_option['stars']:
-                        gift_to_purchase = gift_option['id'] # Store the ID
-                        selected_gift_details = gift_option # Store full details
-                        purchase_reason = "your preferred gift"
-                        logging.info(f"process_gift_purchases: User {user_id} has enough stars for preferred gift ID {gift_to_purchase} (Cost: {selected_gift_details['stars']}).")
-                        break
-
-            # B. Fallback (If No Preferred Match or No Preferences)
-            if not gift_to_purchase:
-                # Find the cheapest gift in available_gifts that current_star_balance >= gift['stars']
-                # Sort available_gifts by stars ascending to find the cheapest
-                affordable_gifts = [g for g in available_gifts if current_star_balance >= g['stars']]
-                if affordable_gifts:
-                    cheapest_affordable_gift = min(affordable_gifts, key=lambda g: g['stars'])
-                    gift_to_purchase = cheapest_affordable_gift['id']
-                    selected_gift_details = cheapest_affordable_gift
-                    purchase_reason = "an available limited gift"
-                    logging.info(f"process_gift_purchases: User {user_id} - no preferred match. Found cheapest affordable gift ID {gift_to_purchase} (Cost: {selected_gift_details['stars']}).")
-
-            # C. Attempt Purchase (if gift_to_purchase is set)
-            if gift_to_purchase and selected_gift_details:
-                try:
-                    target_input_user = await client.get_input_entity(user_id)
-
-                    # Construct the purpose object for the purchase request
-                    # The 'amount' here is the cost in the smallest unit of the currency (e.g., cents for USD).
-                    # For Stars (XTR), it's directly the number of stars.
-                    payment_purpose = InputStorePaymentPremiumGiftCode(
-                        users=[target_input_user], # The user(s) to receive the gift
-                        currency='XTR',
-                        amount=selected_gift_details['stars']
-                        # gift_option_id=selected_gift_details['id'] # Not a direct param here, seems implied by amount or needs other method
-                    )
+    async def purchase_and_time(assignment: Assignment, settlement: Settlement) -> bool:
+        purchased = await purchase_gift_for_user(assignment, settlement)
+        if purchased:
+            metrics.observe('cycle_time_to_purchase_seconds', time.monotonic() - cycle_clock)
+        return purchased
 
-                    # The `user_id` in PurchasePremiumGiftCodeRequest is the buyer (the bot itself)
-                    # The `gift_id` parameter in PurchasePremiumGiftCodeRequest is the ID of the PremiumGiftOption
-                    purchase_request = PurchasePremiumGiftCodeRequest(
-                        user_id=InputPeerSelf(), # Bot buys for the user
-                        gift_id=selected_gift_details['id'], # The specific gift option ID
-                        purpose=payment_purpose
+    try:
+        # Write buffered activity first so the queue's FIFO order includes everything seen so far.
+        with metrics.timer('cycle_stage_seconds', stage='activity flush'):
+            await activity.flush()
+        # Users touched after this point (including everyone settled in this cycle) wait for the next cycle.
+        cycle_started_at = cycle_started_at or datetime.utcnow()
+
+        stages = []
+        new_gifts = [catalog.by_id[gift_id] for gift_id in (new_gift_ids or ()) if gift_id in catalog.by_id]
+        if new_gifts:
+            # Fresh drop: fetch only the users who want one of the new gifts, in priority order,
+            # with one query on the multikey preference index.
+            stages.append(("new gift preferences", repo.find_queued_users(
+                min_balance=min(g.stars for g in new_gifts),
+                batch_size=PURCHASE_CURSOR_BATCH_SIZE,
+                active_before=cycle_started_at,
+                preferred_gift_ids=[g.id for g in new_gifts],
+                shards=shards,
+                shard_count=PURCHASE_SHARDS
+            )))
+        # Stream users who are in the gift queue and can afford at least the cheapest available gift.
+        # Sort by last_activity_timestamp (ascending) for FIFO.
+        # The cursor is consumed batch by batch, so memory stays flat regardless of queue length.
+        stages.append(("queue", repo.find_queued_users(
+            min_balance=catalog.cheapest_price,
+            batch_size=PURCHASE_CURSOR_BATCH_SIZE,
+            active_before=cycle_started_at,
+            shards=shards,
+            shard_count=PURCHASE_SHARDS
+        )))
+
+        settlement = Settlement(repo, notify_settled_purchase, batch_size=SETTLEMENT_BATCH_SIZE)
+        executor = PurchaseExecutor(PURCHASE_CONCURRENCY)
+        stats = None
+        for stage_name, users_to_process_cursor in stages:
+            issued = [] # Reservations handed out in this stage
+            try:
+                # Each cursor batch is assigned gifts in one pass and its Stars reserved in one bulk
+                # write before its users are dispatched.
+                with metrics.timer('cycle_stage_seconds', stage=stage_name):
+                    stats = await executor.run(
+                        purchase_journal.reserve_stream(catalog.allocate_batches(users_to_process_cursor, PURCHASE_CURSOR_BATCH_SIZE), issued),
+                        lambda assignment: purchase_and_time(assignment, settlement),
+                        stats=stats
                     )
+            finally:
+                # Commit whatever is still buffered, even if the cycle was interrupted.
+                # Settled users' activity is written too, so later stages skip them.
+                with metrics.timer('cycle_stage_seconds', stage='settlement'):
+                    await settlement.flush()
+                    # Refund users reserved for but never dispatched (e.g. the cursor failed mid-stage).
+                    await purchase_journal.release_unhandled(issued)
+                    # Settled users were touched; writing that now moves their timestamps past cycle_started_at.
+                    await activity.flush()
+            logging.info(f"process_gift_purchases: Stage '{stage_name}' done: {stats.summary()}")
+
+        if stats.purchased > 0:
+            logging.info(f"process_gift_purchases: Finished processing. Successfully purchased gifts for {stats.purchased} user(s).")
+        else:
+            logging.info("process_gift_purchases: Finished processing. No gifts were purchased in this cycle.")
+        logging.info(f"process_gift_purchases: Cycle stats: {stats.summary()}")
+        await queue_stats.record_cycle(stats, worker=WORKER_ID if leases is not None else None)
+        logging.info(f"process_gift_purchases: Telegram gateway: {gateway.stats()}")
+        logging.info(f"process_gift_purchases: User cache: {repo.user_cache.stats()}")
 
-                    logging.info(f"process_gift_purchases: Attempting to purchase gift ID {selected_gift_details['id']} for user {user_id} for {selected_gift_details['stars']} Stars.")
+    except Exception as e:
+        logging.error(f"process_gift_purchases: An overall error occurred: {e}", exc_info=True)
+    finally:
+        metrics.observe('cycle_seconds', time.monotonic() - cycle_clock)
+        logging.info(f"process_gift_purchases: Cycle timings: {metrics.summary(metrics_before)}")
 
-                    # Make the purchase
-                    purchase_result = await client(purchase_request)
+async def purchase_gift_for_user(assignment: Assignment, settlement: Settlement) -> bool:
+    """
+    Purchases the gift the allocation engine assigned to a single queued user.
+    The assignment's Stars must already be reserved (see PurchaseJournal.reserve); they are refunded
+    unless the purchase goes through. Returns True if a gift was bought; the commit is handed to `settlement`.
+    """
+    user_id = assignment.user_id
+    selected_gift_details = assignment.gift
+    purchase_reason = assignment.reason
+
+    if leases is not None and not leases.owns(user_id):
+        logging.warning(f"process_gift_purchases: Skipping user {user_id}, this worker does not hold their shard.")
+        await release_reservation(assignment)
+        return False
+    if user_id in purchases_in_flight:
+        logging.info(f"process_gift_purchases: Skipping user {user_id}, a purchase for them is already in progress.")
+        await release_reservation(assignment)
+        return False
+    purchases_in_flight.add(user_id)
+    purchased = False
+    settled_later = False
+
+    # Attempt Purchase
+    try:
+        # Address the user from the stored access_hash; only unknown users cost a resolution RPC.
+        if assignment.access_hash is not None:
+            entity_cache.remember(user_id, assignment.access_hash)
+            target_input_user = InputUser(user_id=user_id, access_hash=assignment.access_hash)
+        else:
+            target_input_user = entity_cache.input_user(user_id)
+        if target_input_user is None:
+            target_input_user = await gateway.call('ResolveEntity', PRIORITY_PURCHASE, client.get_input_entity, user_id)
+            if entity_cache.remember(user_id, getattr(target_input_user, 'access_hash', None)):
+                await repo.set_access_hash(user_id, target_input_user.access_hash)
+
+        # Construct the purpose object for the purchase request
+        # The 'amount' here is the cost in the smallest unit of the currency (e.g., cents for USD).
+        # For Stars (XTR), it's directly the number of stars.
+        payment_purpose = InputStorePaymentPremiumGiftCode(
+            users=[target_input_user], # The user(s) to receive the gift
+            currency='XTR',
+            amount=selected_gift_details.stars
+            # gift_option_id=selected_gift_details.id # Not a direct param here, seems implied by amount or needs other method
+        )
 
-                    logging.info(f"process_gift_purchases: Purchase API call for user {user_id}, gift ID {selected_gift_details['id']} result: {purchase_result}")
+        # The `user_id` in PurchasePremiumGiftCodeRequest is the buyer (the bot itself)
+        # The `gift_id` parameter in PurchasePremiumGiftCodeRequest is the ID of the PremiumGiftOption
+        purchase_request = PurchasePremiumGiftCodeRequest(
+            user_id=InputPeerSelf(), # Bot buys for the user
+            gift_id=selected_gift_details.id, # The specific gift option ID
+            purpose=payment_purpose
+        )
 
-                    # Assuming success if no RPCError is raised.
-                    # purchase_result is often an Updates object. We should inspect its contents if specific confirmation is needed.
-                    # For example, it might contain information about the gifted subscriptions or codes.
+        logging.info(f"process_gift_purchases: Attempting to purchase gift ID {selected_gift_details.id} for user {user_id} for {selected_gift_details.stars} Stars.")
 
-                    # Deduct stars and update timestamp
-                    new_balance_after_purchase = current_star_balance - selected_gift_details['stars']
-                    db_update_result = await db.users.update_one(
-                        {'user_id': user_id},
-                        {
-                            '$inc': {'star_balance': -selected_gift_details['stars']},
-                            '$set': {'last_activity_timestamp': datetime.utcnow()}
-                            # Optionally, remove user from queue or mark gift as processed for this cycle
-                            # '$set': {'in_gift_queue': False} # Or some other status
-                        }
-                    )
+        # Make the purchase
+        purchase_result = await gateway.request(purchase_request, PRIORITY_PURCHASE)
+        purchased = True
+        metrics.inc('purchases_total', result='purchased')
 
-                    if db_update_result.modified_count > 0:
-                        logging.info(f"process_gift_purchases: Successfully updated user {user_id}'s star balance to {new_balance_after_purchase}.")
-                        try:
-                            await client.send_message(
-                                user_id,
-                                f"Congratulations! We've successfully acquired {purchase_reason}: '{selected_gift_details.get('description', 'a gift')}' "
-                                f"for {selected_gift_details['stars']} Stars on your behalf.\n"
-                                f"Your new star balance is {new_balance_after_purchase}.\n"
-                                "You should receive a confirmation from Telegram shortly with the gift details."
-                            )
-                        except Exception as e_notify:
-                            logging.error(f"process_gift_purchases: Failed to send success notification to user {user_id}: {e_notify}", exc_info=True)
-
-                        users_processed_count += 1
-                        # Decide if we break after one successful purchase globally per run, or per user.
-                        # For now, let's allow processing multiple users, but one gift per user per cycle.
-                        # If we want only one gift purchase in total per `process_gift_purchases` call:
-                        # logging.info("process_gift_purchases: One gift processed successfully. Ending current cycle.")
-                        # return # This would exit after the first successful purchase in the entire run.
-                    else:
-                        logging.error(f"process_gift_purchases: Failed to update star balance for user {user_id} after successful purchase. Manual check needed.")
-                        # Potentially try to refund or hold, this is a critical error state.
-
-                except RPCError as e:
-                    logging.error(f"process_gift_purchases: Telegram API RPCError during purchase for user {user_id}, gift ID {selected_gift_details['id']}: {e.code} - {e.message}", exc_info=True)
-                    # Notify user if it was a preferred gift attempt?
-                    if purchase_reason == "your preferred gift":
-                        try:
-                            await client.send_message(user_id, f"We tried to get your preferred gift '{selected_gift_details.get('description', 'ID ' + str(selected_gift_details['id']))}' but encountered an issue: {e.message}. Please try again later or contact support.")
-                        except Exception as e_notify_fail:
-                            logging.error(f"process_gift_purchases: Failed to send purchase failure notification to user {user_id}: {e_notify_fail}", exc_info=True)
-                except Exception as e:
-                    logging.error(f"process_gift_purchases: An unexpected error occurred during purchase for user {user_id}, gift ID {selected_gift_details['id']}: {e}", exc_info=True)
-
-            elif gift_to_purchase is None and selected_gift_details is None:
-                 logging.info(f"process_gift_purchases: User {user_id} (balance: {current_star_balance}) - no affordable gift found (neither preferred nor fallback).")
-
-
-        if users_processed_count > 0:
-            logging.info(f"process_gift_purchases: Finished processing. Successfully purchased gifts for {users_processed_count} user(s).")
-        else:
-            logging.info("process_gift_purchases: Finished processing. No gifts were purchased in this cycle.")
+        logging.info(f"process_gift_purchases: Purchase API call for user {user_id}, gift ID {selected_gift_details.id} result: {purchase_result}")
+
+        # Assuming success if no RPCError is raised.
+        # purchase_result is often an Updates object. We should inspect its contents if specific confirmation is needed.
+        # For example, it might contain information about the gifted subscriptions or codes.
+
+        # From here on the reservation must be kept, even if the process dies before it is committed.
+        reservation_id = assignment.reservation_id
+        try:
+            await purchase_journal.mark_purchased(assignment)
+        except Exception as e_mark:
+            logging.error(f"process_gift_purchases: Could not mark reservation of user {user_id} as purchased: {e_mark}", exc_info=True)
+
+        # Commit the reserved Stars and update timestamp, batched with the cycle's other
+        # purchases; notify_settled_purchase reports the outcome.
+        await settlement.add(PendingDebit(user_id, selected_gift_details.stars, selected_gift_details, purchase_reason,
+                                          reservation_id))
+        # The user stays in purchases_in_flight until notify_settled_purchase runs.
+        settled_later = True
 
+        # One gift per user per cycle.
+        return True
+
+    except RPCError as e:
+        metrics.inc('purchases_total', result='rpc_error')
+        logging.error(f"process_gift_purchases: Telegram API RPCError during purchase for user {user_id}, gift ID {selected_gift_details.id}: {e.code} - {e.message}", exc_info=True)
+        # Notify user if it was a preferred gift attempt?
+        if purchase_reason == REASON_PREFERRED:
+            try:
+                await outbox.enqueue(user_id, f"We tried to get your preferred gift '{selected_gift_details.description or 'ID ' + str(selected_gift_details.id)}' but encountered an issue: {e.message}. Please try again later or contact support.")
+            except Exception as e_notify_fail:
+                logging.error(f"process_gift_purchases: Failed to send purchase failure notification to user {user_id}: {e_notify_fail}", exc_info=True)
     except Exception as e:
-        logging.error(f"process_gift_purchases: An overall error occurred: {e}", exc_info=True)
+        if not purchased:
+            metrics.inc('purchases_total', result='error')
+        logging.error(f"process_gift_purchases: An unexpected error occurred during purchase for user {user_id}, gift ID {selected_gift_details.id}: {e}", exc_info=True)
+    finally:
+        if not purchased:
+            await release_reservation(assignment)
+        if not settled_later:
+            purchases_in_flight.discard(user_id)
+
+    return False
+
+async def release_reservation(assignment: Assignment):
+    """Refunds the Stars reserved for a purchase that did not happen."""
+    try:
+        await purchase_journal.release(assignment)
+    except Exception as e:
+        # The reservation stays in the journal and is refunded by recovery on the next start.
+        logging.error(f"process_gift_purchases: Could not release reservation of user {assignment.user_id}: {e}", exc_info=True)
+
+async def purchase_for_single_user(user_doc: dict, catalog: GiftCatalog) -> bool:
+    """
+    Buys a gift for one user right away, outside the polling cycle (see BalanceTrigger).
+    The Stars are reserved first and committed immediately after the purchase.
+    In cluster mode only the worker holding the user's shard buys; the others ignore the trigger.
+    """
+    if leases is not None and not leases.owns(user_doc['user_id']):
+        return False
+    assignments = await purchase_journal.reserve(catalog.allocate([user_doc]))
+    if not assignments:
+        return False
+    settlement = Settlement(repo, notify_settled_purchase, batch_size=1)
+    try:
+        return await purchase_gift_for_user(assignments[0], settlement)
+    finally:
+        await settlement.flush()
+
+
+async def notify_settled_purchase(debit: PendingDebit, new_balance):
+    """Tells the user about a settled purchase. `new_balance` is None if the commit could not be written."""
+    purchases_in_flight.discard(debit.user_id)
+    if new_balance is None:
+        # The Stars stay reserved and the journal entry is committed by recovery on the next start.
+        logging.error(f"process_gift_purchases: Failed to commit the reservation of user {debit.user_id} after successful purchase. Left for journal recovery.")
+        return
+
+    logging.info(f"process_gift_purchases: Successfully updated user {debit.user_id}'s star balance to {new_balance}.")
+    # A purchase counts as activity and moves the user to the back of the queue.
+    activity.touch(debit.user_id)
+    try:
+        await outbox.enqueue(
+            debit.user_id,
+            f"Congratulations! We've successfully acquired {debit.reason}: '{debit.gift.description or 'a gift'}' "
+            f"for {debit.stars} Stars on your behalf.\n"
+            f"Your new star balance is {new_balance}.\n"
+            "You should receive a confirmation from Telegram shortly with the gift details."
+        )
+    except Exception as e_notify:
+        logging.error(f"process_gift_purchases: Failed to send success notification to user {debit.user_id}: {e_notify}", exc_info=True)
 
 
 if __name__ == '__main__':
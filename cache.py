@@ -0,0 +1,63 @@
+import time
+from copy import deepcopy
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    Bounded in-process cache of user documents, keyed by user_id.
+    Entries expire after `ttl` seconds and the least recently used entry is evicted once
+    `capacity` is reached. Used read-through by Repository.get_user and kept current by the
+    repository's writes (put / patch / invalidate). hits and misses count lookups.
+    Documents are copied in and out, so callers may modify what they put or get.
+    """
+
+    def __init__(self, capacity: int = 10000, ttl: float = 60.0):
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self._entries = OrderedDict() # user_id -> (expires_at, user_doc)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: int):
+        """Returns the cached document, or None on a miss or expired entry."""
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        return deepcopy(entry[1])
+
+    def put(self, user_id: int, user_doc: dict):
+        """Caches a full user document (None is ignored)."""
+        if user_doc is None:
+            return
+        self._entries[user_id] = (time.monotonic() + self.ttl, deepcopy(user_doc))
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def patch(self, user_id: int, fields: dict):
+        """Applies changed fields to a cached document, if one is cached."""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry[1].update(deepcopy(fields))
+
+    def invalidate(self, user_id: int):
+        """Drops the cached document, if any."""
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import math
+import random
+import time
+
+# app_config keys of the lease documents
+LEADER_LEASE_KEY = "lease:leader"
+WORKER_LEASE_PREFIX = "lease:worker:"
+SHARD_LEASE_PREFIX = "lease:shard:"
+
+
+def shard_of(user_id: int, shard_count: int) -> int:
+    """The purchase shard a user belongs to."""
+    return user_id % shard_count
+
+
+class LeaseManager:
+    """
+    Coordinates several bot processes through lease documents in app_config.
+    Every `ttl / 3` seconds the manager renews this worker's heartbeat lease, tries to take or keep
+    the leader lease, and claims or releases shard leases so that each live worker holds about
+    shard_count / live_workers of the user-ID shards. Leases expire `ttl` seconds after their last
+    renewal (on the server clock), so the shards and leadership of a crashed worker fail over to the
+    others. Each shard lease also remembers the last purchase cycle run for it (see mark_done).
+    """
+
+    def __init__(self, repo, worker_id: str, shard_count: int = 16, ttl: float = 15.0):
+        self.repo = repo
+        self.worker_id = worker_id
+        self.shard_count = max(1, shard_count)
+        self.ttl = ttl
+        self._leader = False # Whether the last heartbeat took or kept the leader lease
+        self._shards = {} # shard -> cycle_id last run for it
+        self._valid_until = 0.0 # Local deadline for trusting the held leases
+        self._task = None
+
+    @property
+    def is_leader(self) -> bool:
+        """Whether this worker holds the leader lease right now (false once it may have expired)."""
+        return self._leader and self._valid()
+
+    @property
+    def shards(self) -> list:
+        """Shards currently held by this worker."""
+        return sorted(self._shards) if self._valid() else []
+
+    def owns(self, user_id: int) -> bool:
+        """Whether this worker may purchase for `user_id` right now."""
+        return self._valid() and shard_of(user_id, self.shard_count) in self._shards
+
+    def shards_behind(self, cycle_id: str) -> list:
+        """Held shards for which purchase cycle `cycle_id` has not been run yet."""
+        return [shard for shard in self.shards if self._shards[shard] != cycle_id]
+
+    async def live_workers(self) -> set:
+        """IDs of the workers whose heartbeat lease has not expired, this one included."""
+        return await self.repo.live_lease_owners(WORKER_LEASE_PREFIX) | {self.worker_id}
+
+    async def mark_done(self, shards: list, cycle_id: str):
+        """Records that `cycle_id` was run for `shards`, so a worker taking them over skips it."""
+        await self.repo.set_lease_cycle([f"{SHARD_LEASE_PREFIX}{s}" for s in shards], self.worker_id, cycle_id)
+        for shard in shards:
+            if shard in self._shards:
+                self._shards[shard] = cycle_id
+
+    def start(self):
+        """Starts the heartbeat task."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops heartbeating and releases every lease so other workers take over immediately."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        keys = [f"{SHARD_LEASE_PREFIX}{s}" for s in self._shards] + [LEADER_LEASE_KEY, f"{WORKER_LEASE_PREFIX}{self.worker_id}"]
+        self._shards.clear()
+        self._leader = False
+        for key in keys:
+            try:
+                await self.repo.release_lease(key, self.worker_id)
+            except Exception as e:
+                logging.warning(f"LeaseManager: Could not release {key}: {e}")
+
+    def _valid(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    async def _run(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logging.error(f"LeaseManager: Heartbeat failed: {e}", exc_info=True)
+            await asyncio.sleep(self.ttl / 3)
+
+    async def heartbeat(self):
+        """Renews, claims and releases leases once."""
+        # Leases are trusted locally for a little less than the TTL measured from before the renewal.
+        started = time.monotonic()
+        await self.repo.acquire_lease(f"{WORKER_LEASE_PREFIX}{self.worker_id}", self.worker_id, self.ttl)
+
+        leader = await self.repo.acquire_lease(LEADER_LEASE_KEY, self.worker_id, self.ttl) is not None
+        if leader != self._leader:
+            logging.info(f"LeaseManager: Worker {self.worker_id} {'is now' if leader else 'is no longer'} the leader.")
+        self._leader = leader
+
+        # Keep the shards still held.
+        for shard in list(self._shards):
+            if await self.repo.acquire_lease(f"{SHARD_LEASE_PREFIX}{shard}", self.worker_id, self.ttl) is None:
+                logging.warning(f"LeaseManager: Lost shard {shard}.")
+                del self._shards[shard]
+
+        live_workers = max(1, await self.repo.count_live_leases(WORKER_LEASE_PREFIX))
+        target = math.ceil(self.shard_count / live_workers)
+        if len(self._shards) > target:
+            # Hand surplus shards back so new workers can claim them.
+            for shard in sorted(self._shards)[target:]:
+                await self.repo.release_lease(f"{SHARD_LEASE_PREFIX}{shard}", self.worker_id)
+                del self._shards[shard]
+                logging.info(f"LeaseManager: Released shard {shard} ({live_workers} live workers).")
+        elif len(self._shards) < target:
+            free = [s for s in range(self.shard_count) if s not in self._shards]
+            random.shuffle(free)
+            for shard in free:
+                if len(self._shards) >= target:
+                    break
+                lease = await self.repo.acquire_lease(f"{SHARD_LEASE_PREFIX}{shard}", self.worker_id, self.ttl)
+                if lease is not None:
+                    self._shards[shard] = lease.get('cycle_id')
+                    logging.info(f"LeaseManager: Claimed shard {shard}.")
+
+        self._valid_until = started + self.ttl * 0.8
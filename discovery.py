@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+
+# PremiumGiftCodeOption flag bits
+LIMITED_FLAG = 1 << 0 # Bit 0 (0x1) seems to be 'limited'
+SOLD_OUT_FLAG = 1 << 1 # Bit 1 (0x2) seems to be 'sold_out'
+
+
+def is_live_limited(flags: int) -> bool:
+    """True for options that are limited AND NOT sold_out."""
+    return bool(flags & LIMITED_FLAG) and not flags & SOLD_OUT_FLAG
+
+
+def fingerprint_options(options) -> str:
+    """Stable hash of the fields that matter for purchasing (id, flags, stars) of every option."""
+    digest = hashlib.sha1()
+    for option_id, flags, stars in sorted((o.id, o.flags, o.stars) for o in options):
+        digest.update(f"{option_id}:{flags}:{stars};".encode())
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True, slots=True)
+class GiftOption:
+    """
+    The fields of a PremiumGiftCodeOption the bot uses. Immutable, so one instance per poll is
+    shared by the catalog, every purchase task and the notifications without copying.
+    """
+    id: int
+    stars: int
+    months: int
+    currency: str
+    amount: int
+    flags: int
+    description: str = None # Shown in notifications; may be generic
+
+    @classmethod
+    def from_option(cls, option) -> 'GiftOption':
+        return cls(option.id, option.stars, option.months, option.currency, option.amount, option.flags,
+                   getattr(option, 'description', None))
+
+
+@dataclass
+class OptionsChange:
+    """What changed between two consecutive option lists."""
+    changed: bool
+    new_limited_ids: set = field(default_factory=set) # Live limited gifts that were not live before
+    sold_out_flipped_ids: set = field(default_factory=set) # Options whose sold_out bit changed
+    limited_live: bool = False # Whether any limited gift is currently on offer
+
+
+class DiscoveryScheduler:
+    """
+    Decides when to poll GetPremiumGiftCodeOptionsRequest and when a purchase cycle is worth running.
+    Each poll's option list is fingerprinted; a purchase cycle is due only when the fingerprint
+    changes (new limited IDs, sold_out bits flipping, price changes), or when limited stock is live
+    and `max_cycle_interval` has passed since the last cycle, so users who topped up meanwhile are
+    still served. Polling is fast while limited stock is live. When nothing is on offer, each poll
+    that finds the options unchanged doubles the delay, from `fast_interval` up to `slow_interval`,
+    and a change starts over at `fast_interval`. Errors back off the same way. Every delay gets
+    +/- `jitter` randomization.
+    """
+
+    def __init__(self, fast_interval: float, slow_interval: float, max_cycle_interval: float, jitter: float = 0.2):
+        self.fast_interval = fast_interval
+        self.slow_interval = max(slow_interval, fast_interval)
+        self.max_cycle_interval = max_cycle_interval
+        self.jitter = jitter
+        self.fingerprint = None
+        self._flags_by_id = {}
+        self._limited_live = False
+        self._consecutive_errors = 0
+        self._unchanged_polls = 0
+        self._last_cycle_at = None
+
+    # --- persistence (stored in app_config by the caller) ---
+
+    def state(self) -> dict:
+        """Serializable snapshot of the last observed option list."""
+        return {'fingerprint': self.fingerprint, 'flags': [[gift_id, flags] for gift_id, flags in self._flags_by_id.items()]}
+
+    def restore(self, state: dict):
+        """Restores a snapshot produced by state(), e.g. after a restart."""
+        if not state:
+            return
+        self.fingerprint = state.get('fingerprint')
+        self._flags_by_id = {gift_id: flags for gift_id, flags in state.get('flags', [])}
+        self._limited_live = any(is_live_limited(flags) for flags in self._flags_by_id.values())
+
+    # --- observations ---
+
+    def observe(self, options) -> OptionsChange:
+        """Records a successful poll and diffs it against the previous one."""
+        self._consecutive_errors = 0
+        flags_by_id = {o.id: o.flags for o in options}
+        limited_live = any(is_live_limited(flags) for flags in flags_by_id.values())
+        new_fingerprint = fingerprint_options(options)
+
+        if new_fingerprint == self.fingerprint:
+            self._limited_live = limited_live
+            self._unchanged_polls += 1
+            return OptionsChange(changed=False, limited_live=limited_live)
+
+        new_limited_ids = {
+            gift_id for gift_id, flags in flags_by_id.items()
+            if is_live_limited(flags) and not is_live_limited(self._flags_by_id.get(gift_id, 0))
+        }
+        sold_out_flipped_ids = {
+            gift_id for gift_id, flags in flags_by_id.items()
+            if gift_id in self._flags_by_id and (flags ^ self._flags_by_id[gift_id]) & SOLD_OUT_FLAG
+        }
+        logging.info(f"DiscoveryScheduler: Gift options changed (new limited: {sorted(new_limited_ids)}, sold_out flipped: {sorted(sold_out_flipped_ids)}).")
+
+        self.fingerprint = new_fingerprint
+        self._flags_by_id = flags_by_id
+        self._limited_live = limited_live
+        self._unchanged_polls = 0
+        return OptionsChange(True, new_limited_ids, sold_out_flipped_ids, limited_live)
+
+    def record_error(self):
+        """Records a failed poll; the next delay backs off."""
+        self._consecutive_errors += 1
+
+    def record_cycle(self):
+        """Records that a purchase cycle ran."""
+        self._last_cycle_at = time.monotonic()
+
+    # --- decisions ---
+
+    def cycle_due(self, change: OptionsChange) -> bool:
+        """Whether a purchase cycle should run after observing `change`."""
+        if not change.limited_live:
+            return False
+        if change.changed or self._last_cycle_at is None:
+            return True
+        return time.monotonic() - self._last_cycle_at >= self.max_cycle_interval
+
+    def _backoff(self, steps: int) -> float:
+        # The exponent is capped so that a long quiet period cannot overflow the float.
+        return min(self.fast_interval * (2 ** min(steps, 32)), self.slow_interval)
+
+    def next_delay(self) -> float:
+        """Seconds to wait before the next poll."""
+        if self._consecutive_errors:
+            base = self._backoff(self._consecutive_errors)
+        elif self._limited_live:
+            base = self.fast_interval
+        else:
+            base = self._backoff(self._unchanged_polls)
+        return max(0.0, base * random.uniform(1 - self.jitter, 1 + self.jitter))
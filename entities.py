@@ -0,0 +1,64 @@
+import logging
+from collections import OrderedDict
+
+from telethon.tl.types import InputPeerUser, InputUser
+
+
+class EntityCache:
+    """
+    In-memory LRU of user_id -> access_hash.
+    Lets purchases and notifications build InputUser / InputPeerUser objects directly instead of
+    asking Telegram to resolve each user. Access hashes are captured when users message the bot,
+    persisted on their user document, and loaded back with warm() at startup.
+    """
+
+    def __init__(self, capacity: int = 100000):
+        self.capacity = max(1, capacity)
+        self._hashes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def remember(self, user_id: int, access_hash: int) -> bool:
+        """Caches a user's access_hash. Returns True if it was not already cached with this value."""
+        if access_hash is None:
+            return False
+        known = self._hashes.get(user_id)
+        self._hashes[user_id] = access_hash
+        self._hashes.move_to_end(user_id)
+        if len(self._hashes) > self.capacity:
+            self._hashes.popitem(last=False)
+        return known != access_hash
+
+    def get(self, user_id: int):
+        """Returns the cached access_hash, or None."""
+        access_hash = self._hashes.get(user_id)
+        if access_hash is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._hashes.move_to_end(user_id)
+        return access_hash
+
+    def input_user(self, user_id: int):
+        """Returns an InputUser for `user_id`, or None if its access_hash is unknown."""
+        access_hash = self.get(user_id)
+        return InputUser(user_id=user_id, access_hash=access_hash) if access_hash is not None else None
+
+    def input_peer(self, user_id: int):
+        """Returns an InputPeerUser for `user_id`, or the bare ID for Telethon to resolve."""
+        access_hash = self.get(user_id)
+        return InputPeerUser(user_id=user_id, access_hash=access_hash) if access_hash is not None else user_id
+
+    async def warm(self, repo):
+        """Loads stored access hashes of the most recently active users, up to capacity."""
+        loaded = 0
+        async for user_doc in repo.find_access_hashes(limit=self.capacity):
+            # Most recent first; inserting oldest-last keeps recent users at the LRU's hot end.
+            self._hashes[user_doc['user_id']] = user_doc['access_hash']
+            self._hashes.move_to_end(user_doc['user_id'], last=False)
+            loaded += 1
+        logging.info(f"EntityCache: Warmed with {loaded} access hash(es).")
+        return loaded
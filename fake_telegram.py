@@ -0,0 +1,129 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from telethon.errors import BadRequestError, FloodWaitError
+from telethon.tl.types import InputPeerUser, MessageActionPaymentSentMe, MessageService, PaymentCharge, PeerUser
+
+from discovery import LIMITED_FLAG, SOLD_OUT_FLAG
+
+
+def fake_option(gift_id: int, stars: int, limited: bool = True, sold_out: bool = False, months: int = 3):
+    """A stand-in for a PremiumGiftCodeOption with the fields the bot reads."""
+    flags = (LIMITED_FLAG if limited else 0) | (SOLD_OUT_FLAG if sold_out else 0)
+    return SimpleNamespace(id=gift_id, stars=stars, months=months, currency='XTR', amount=stars, flags=flags,
+                           store_product=None, description=f"Gift {gift_id}")
+
+
+def fake_access_hash(user_id: int) -> int:
+    """Deterministic access_hash, so seeded users and resolved entities agree."""
+    return (user_id * 2654435761) % (1 << 62)
+
+
+class FakeTelegramClient:
+    """
+    Offline stand-in for the TelegramClient calls the bot makes: GetPremiumGiftCodeOptionsRequest
+    and PurchasePremiumGiftCodeRequest (as raw requests), get_input_entity and send_message.
+    Every call sleeps `latency` seconds (+/- `jitter` as a fraction). A share of calls fails with
+    a FloodWait (`flood_wait_rate`, of `flood_wait_seconds`). Purchases draw from a per-gift
+    `stock`; once it runs out, or for a `sold_out_race_rate` share of purchases, the call fails
+    like a sold-out gift and the option is flagged sold out for the next discovery poll.
+    Purchases are recorded with their completion time for throughput measurements.
+    """
+
+    def __init__(self, options: list = (), latency: float = 0.05, jitter: float = 0.5,
+                 flood_wait_rate: float = 0.0, flood_wait_seconds: int = 1,
+                 sold_out_race_rate: float = 0.0, stock: dict = None, seed: int = None):
+        self.options = list(options)
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_wait_rate = flood_wait_rate
+        self.flood_wait_seconds = flood_wait_seconds
+        self.sold_out_race_rate = sold_out_race_rate
+        self.stock = dict(stock or {}) # gift_id -> purchases left; unlisted gifts are unlimited
+        self.flood_sleep_threshold = 0 # Set by TelegramGateway
+        self._random = random.Random(seed)
+        self.calls = Counter()
+        self.flood_waits = 0
+        self.sold_out = 0
+        self.purchases = [] # (monotonic time, gift_id)
+        self.messages_sent = 0
+
+    def set_options(self, options: list):
+        """Replaces the option list returned by the next discovery poll, e.g. to simulate a drop."""
+        self.options = list(options)
+
+    async def _call(self, method: str, request=None):
+        self.calls[method] += 1
+        delay = self.latency * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.flood_wait_rate and self._random.random() < self.flood_wait_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=request, capture=self.flood_wait_seconds)
+
+    async def __call__(self, request):
+        method = type(request).__name__
+        await self._call(method, request)
+        if method == 'GetPremiumGiftCodeOptionsRequest':
+            return SimpleNamespace(options=list(self.options))
+        if method == 'PurchasePremiumGiftCodeRequest':
+            return self._purchase(request)
+        raise NotImplementedError(f"FakeTelegramClient does not implement {method}")
+
+    def _purchase(self, request):
+        gift_id = request.gift_id
+        left = self.stock.get(gift_id)
+        raced = self.sold_out_race_rate and self._random.random() < self.sold_out_race_rate
+        if raced or left == 0:
+            self.sold_out += 1
+            for option in self.options:
+                if option.id == gift_id:
+                    option.flags |= SOLD_OUT_FLAG
+            raise BadRequestError(request, 'PREMIUM_GIFT_SOLD_OUT', code=400)
+        if left is not None:
+            self.stock[gift_id] = left - 1
+        self.purchases.append((time.monotonic(), gift_id))
+        return SimpleNamespace(updates=[], users=[], chats=[])
+
+    async def get_input_entity(self, peer):
+        await self._call('ResolveEntity')
+        return InputPeerUser(user_id=peer, access_hash=fake_access_hash(peer))
+
+    async def send_message(self, entity, text):
+        await self._call('SendMessage')
+        self.messages_sent += 1
+        return SimpleNamespace(id=self.messages_sent, message=text)
+
+
+class FakeEvent:
+    """
+    Stand-in for a Telethon NewMessage event, enough for the router and handlers: text messages
+    carry `text`; service messages (e.g. Star payments, see payment_action) a TL `action` and are
+    real MessageService objects, so they are routed by action type like live updates.
+    """
+
+    def __init__(self, client: FakeTelegramClient, user_id: int, text: str = None, action=None, message_id: int = 1,
+                 access_hash: int = None):
+        self._client = client
+        self.sender_id = user_id
+        self.chat_id = user_id
+        self.input_sender = InputPeerUser(user_id=user_id, access_hash=access_hash if access_hash is not None else fake_access_hash(user_id))
+        if action is not None:
+            self.message = MessageService(id=message_id, peer_id=PeerUser(user_id), action=action)
+        else:
+            self.message = SimpleNamespace(id=message_id, message=text, action=None, peer_id=PeerUser(user_id))
+
+    async def reply(self, text):
+        return await self._client.send_message(self.sender_id, text)
+
+    async def respond(self, text):
+        return await self._client.send_message(self.sender_id, text)
+
+
+def payment_action(amount: int, charge_id: str, currency: str = 'XTR', provider_charge_id: str = ''):
+    """A MessageActionPaymentSentMe for a Star payment with the given charge."""
+    return MessageActionPaymentSentMe(currency=currency, total_amount=amount, payload=b'',
+                                      charge=PaymentCharge(id=charge_id, provider_charge_id=provider_charge_id))
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telethon.errors import FloodWaitError
+
+# Priority classes, lowest value is served first.
+PRIORITY_PURCHASE = 0
+PRIORITY_DISCOVERY = 1
+PRIORITY_REPLY = 2 # Direct answers to user commands
+PRIORITY_NOTIFICATION = 3
+PRIORITY_NAMES = {
+    PRIORITY_PURCHASE: 'purchase',
+    PRIORITY_DISCOVERY: 'discovery',
+    PRIORITY_REPLY: 'reply',
+    PRIORITY_NOTIFICATION: 'notification',
+}
+
+
+def parse_rate_limits(spec: str) -> dict:
+    """
+    Parses "Method=rate/burst,Other=rate" into {method: (rate, burst)}.
+    `rate` is calls per second; `burst` defaults to max(1, rate).
+    Raises ValueError for a malformed entry or a rate that is not positive.
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        method, _, value = item.partition('=')
+        rate, _, burst = value.partition('/')
+        try:
+            rate = float(rate)
+            burst = float(burst) if burst else max(1.0, rate)
+        except ValueError:
+            raise ValueError(f"Invalid rate limit {item!r}: expected Method=rate or Method=rate/burst") from None
+        if not method.strip() or rate <= 0:
+            raise ValueError(f"Invalid rate limit {item!r}: the rate must be a positive number of calls per second")
+        limits[method.strip()] = (rate, burst)
+    return limits
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class TelegramGateway:
+    """
+    Single pacing point for every outbound Telegram call.
+    Each call names its method (the TL request class name, or e.g. 'SendMessage') and a priority
+    class. A call is admitted when both its method bucket and the global bucket have a token;
+    waiting calls are admitted in priority order (purchase > discovery > reply > notification) and
+    FIFO within a class. A FloodWaitError blocks the offending method for the requested time and
+    the call is transparently re-queued, up to `max_flood_wait` seconds; longer waits are raised.
+    stats() exposes queue depth, admission wait times and FloodWait counts. With `metrics`
+    (metrics.Metrics), every call's duration, admission wait and FloodWait is recorded per method.
+    """
+
+    def __init__(self, client, global_rate: float = 30.0, default_rate: float = 20.0,
+                 method_rates: dict = None, max_flood_wait: float = 300.0, metrics=None):
+        self.client = client
+        self.metrics = metrics
+        # FloodWaits are handled here, for all callers of the method, rather than slept on inside one call.
+        client.flood_sleep_threshold = 0
+        if default_rate <= 0:
+            raise ValueError(f"Default method rate must be positive, got {default_rate}")
+        self._global = TokenBucket(global_rate, global_rate)
+        self._default_rate = default_rate
+        self._method_rates = method_rates or {}
+        self._buckets = {}
+        self._blocked_until = {} # method -> monotonic time a FloodWait expires
+        self._waiting = {} # (priority, method) -> deque of (future, enqueued_at)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self.max_flood_wait = max_flood_wait
+        self.admitted = 0
+        self.flood_waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    # --- public API ---
+
+    async def request(self, tl_request, priority: int):
+        """Sends a raw TL request, e.g. GetPremiumGiftCodeOptionsRequest."""
+        return await self.call(type(tl_request).__name__, priority, self.client, tl_request)
+
+    async def call(self, method: str, priority: int, func, *args, **kwargs):
+        """Awaits `func(*args, **kwargs)` once `method` may be called, retrying after FloodWaits."""
+        while True:
+            await self._acquire(method, priority)
+            started = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.flood_waits += 1
+                if self.metrics is not None:
+                    self.metrics.inc('telegram_flood_waits_total', method=method)
+                self._blocked_until[method] = max(self._blocked_until.get(method, 0), time.monotonic() + e.seconds)
+                self._wakeup.set()
+                if e.seconds > self.max_flood_wait:
+                    logging.error(f"TelegramGateway: FloodWait of {e.seconds}s on {method} exceeds {self.max_flood_wait}s. Giving up.")
+                    raise
+                logging.warning(f"TelegramGateway: FloodWait of {e.seconds}s on {method}. Deferring {PRIORITY_NAMES.get(priority, priority)} call.")
+            finally:
+                if self.metrics is not None:
+                    self.metrics.observe('telegram_call_seconds', time.monotonic() - started, method=method)
+
+    def queue_depth(self) -> dict:
+        """Number of calls waiting for admission, per priority class."""
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for (priority, _), waiters in self._waiting.items():
+            depth[PRIORITY_NAMES.get(priority, str(priority))] += len(waiters)
+        return depth
+
+    def stats(self) -> dict:
+        """Snapshot of queue depth, admission waits and FloodWaits."""
+        now = time.monotonic()
+        return {
+            'queue_depth': self.queue_depth(),
+            'admitted': self.admitted,
+            'avg_wait_seconds': self.total_wait / self.admitted if self.admitted else 0.0,
+            'max_wait_seconds': self.max_wait,
+            'flood_waits': self.flood_waits,
+            'blocked_methods': {m: round(until - now, 1) for m, until in self._blocked_until.items() if until > now},
+        }
+
+    # --- admission ---
+
+    def _bucket(self, method: str) -> TokenBucket:
+        bucket = self._buckets.get(method)
+        if bucket is None:
+            rate, burst = self._method_rates.get(method, (self._default_rate, self._default_rate))
+            bucket = self._buckets[method] = TokenBucket(rate, burst)
+        return bucket
+
+    async def _acquire(self, method: str, priority: int):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault((priority, method), deque()).append((future, time.monotonic()))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            next_delay = None
+            for key in sorted(self._waiting):
+                waiters = self._waiting[key]
+                method = key[1]
+                bucket = self._bucket(method)
+                while waiters:
+                    future, enqueued_at = waiters[0]
+                    if future.done(): # Caller was cancelled
+                        waiters.popleft()
+                        continue
+                    delay = max(self._global.delay(now), bucket.delay(now), self._blocked_until.get(method, 0) - now)
+                    if delay > 0:
+                        next_delay = delay if next_delay is None else min(next_delay, delay)
+                        break
+                    waiters.popleft()
+                    bucket.consume()
+                    self._global.consume()
+                    waited = now - enqueued_at
+                    self.admitted += 1
+                    self.total_wait += waited
+                    self.max_wait = max(self.max_wait, waited)
+                    if self.metrics is not None:
+                        self.metrics.observe('telegram_admission_wait_seconds', waited, method=method)
+                    future.set_result(None)
+                if not waiters:
+                    del self._waiting[key]
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), next_delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+
+from pymongo import IndexModel
+
+# Query plan stages that mean a hot query is not served by an index:
+# a full collection scan, or a blocking in-memory sort (bounded by the server's sort memory limit).
+BAD_PLAN_STAGES = {'COLLSCAN', 'SORT'}
+
+# Gift IDs for explaining the drop query. A drop usually brings several gifts, and a multi-value $in
+# is planned differently from a single value (one index scan per gift, merged in FIFO order).
+PLAN_CHECK_GIFT_IDS = (1, 2, 3, 4, 5)
+
+# Hot queries that must be served by a specific index, not just by some index
+EXPECTED_INDEXES = {
+    'new gift preferences': 'queue_preferences',
+    'new gift preferences (sharded)': 'queue_preferences',
+}
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    """One declared index. `required` indexes back correctness (uniqueness) and are built before the bot serves."""
+    collection: str
+    keys: tuple
+    name: str
+    unique: bool = False
+    partial: dict = None
+    required: bool = False
+    expire_after: int = None # TTL in seconds
+
+    def model(self) -> IndexModel:
+        options = {'name': self.name}
+        if self.unique:
+            options['unique'] = True
+        if self.partial:
+            options['partialFilterExpression'] = self.partial
+        if self.expire_after is not None:
+            options['expireAfterSeconds'] = self.expire_after
+        return IndexModel(list(self.keys), **options)
+
+
+INDEXES = [
+    # User lookups by Telegram ID; one record per user
+    IndexSpec('users', (('user_id', 1),), 'user_id_1', unique=True, required=True),
+    # Purchase queue (Repository.find_queued_users): only queued users are indexed; the FIFO sort is
+    # read from the index and the balance filter is applied to index keys, before any document is fetched.
+    IndexSpec('users', (('last_activity_timestamp', 1), ('star_balance', 1)), 'queue_fifo',
+              partial={'in_gift_queue': True}),
+    # Queued users who want a given gift, already in FIFO order per gift (multikey)
+    IndexSpec('users', (('preferred_gift_ids', 1), ('last_activity_timestamp', 1)), 'queue_preferences',
+              partial={'in_gift_queue': True}),
+    # EntityCache warm-up: most recently active users with a stored access_hash
+    IndexSpec('users', (('last_activity_timestamp', -1),), 'access_hash_recent',
+              partial={'access_hash': {'$exists': True}}),
+    # One ledger entry per Telegram charge; redelivered payments are rejected by the server
+    IndexSpec('payments', (('charge_id', 1),), 'charge_id_1', unique=True, required=True),
+    # Payment recovery: only payments not yet applied to a balance are indexed
+    IndexSpec('payments', (('created_at', 1),), 'payments_unapplied', partial={'applied': False}),
+    # Purchase journal recovery reads open reservations by state
+    IndexSpec('purchase_journal', (('state', 1), ('owner', 1)), 'state_1_owner_1'),
+    # Outbox replay reads pending messages in creation order
+    IndexSpec('outbox', (('state', 1), ('created_at', 1)), 'state_1_created_at_1'),
+    # Cluster mode: claims on incoming updates are only needed while every worker may still see them
+    IndexSpec('update_claims', (('created_at', 1),), 'claims_ttl', expire_after=86400),
+    # Configuration keys and leases are unique
+    IndexSpec('app_config', (('key', 1),), 'key_1', unique=True, required=True),
+]
+
+def hot_queries(repo, shard_count: int = None) -> dict:
+    """The queries that must be index-backed, built through the Repository exactly as the bot issues them."""
+    now = datetime.utcnow()
+    queries = {
+        'queue': repo.find_queued_users(min_balance=1, active_before=now),
+        'new gift preferences': repo.find_queued_users(min_balance=1, active_before=now, preferred_gift_ids=list(PLAN_CHECK_GIFT_IDS)),
+        'access hash warm-up': repo.find_access_hashes(limit=1000),
+        'pending outbox': repo.find_pending_outbox(),
+        'unapplied payments': repo.find_unapplied_payments(),
+        'open reservations': repo.find_open_reservations(),
+    }
+    if shard_count:
+        queries['queue (sharded)'] = repo.find_queued_users(min_balance=1, active_before=now, shards=[0], shard_count=shard_count)
+        queries['new gift preferences (sharded)'] = repo.find_queued_users(
+            min_balance=1, active_before=now, preferred_gift_ids=list(PLAN_CHECK_GIFT_IDS), shards=[0], shard_count=shard_count)
+    return queries
+
+
+async def create_indexes(repo, specs: list):
+    """Creates `specs` with one createIndexes command per collection. Existing identical indexes are left as they are."""
+    by_collection = {}
+    for spec in specs:
+        by_collection.setdefault(spec.collection, []).append(spec.model())
+    for collection, models in by_collection.items():
+        await repo.db[collection].create_indexes(models)
+
+
+def _plan_stages(plan, field: str = 'stage') -> list:
+    """All stage names (or other `field` values, e.g. indexName) in an explain() plan tree (classic and slot-based engine layouts)."""
+    stages = []
+    if isinstance(plan, dict):
+        if field in plan:
+            stages.append(plan[field])
+        for value in plan.values():
+            stages.extend(_plan_stages(value, field))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item, field))
+    return stages
+
+
+async def verify_query_plans(repo, shard_count: int = None) -> list:
+    """
+    Explains every hot query. Returns one message per query whose winning plan scans the collection
+    or sorts in memory. A query not using the index EXPECTED_INDEXES names for it is only logged: which
+    of several usable indexes wins depends on the data (on an empty collection, any of them can).
+    """
+    problems = []
+    for name, cursor in hot_queries(repo, shard_count).items():
+        explanation = await cursor.explain()
+        winning_plan = explanation.get('queryPlanner', {}).get('winningPlan', {})
+        stages = _plan_stages(winning_plan)
+        bad = sorted(BAD_PLAN_STAGES.intersection(stages))
+        expected_index = EXPECTED_INDEXES.get(name)
+        if bad:
+            problems.append(f"query '{name}' uses {', '.join(bad)} (plan: {' > '.join(stages)})")
+        elif expected_index and expected_index not in _plan_stages(winning_plan, 'indexName'):
+            logging.warning(f"Indexes: Hot query '{name}' does not use index {expected_index} "
+                            f"(plan: {' > '.join(stages)}, indexes: {', '.join(sorted(set(_plan_stages(winning_plan, 'indexName'))))}).")
+        else:
+            logging.debug(f"Indexes: Query '{name}' plan: {' > '.join(stages)}")
+    return problems
+
+
+async def build_and_verify(repo, plan_check: str = "warn", shard_count: int = None):
+    """Builds the non-required indexes and checks the hot query plans."""
+    await create_indexes(repo, [spec for spec in INDEXES if not spec.required])
+    if plan_check == "off":
+        return
+    problems = await verify_query_plans(repo, shard_count)
+    for problem in problems:
+        logging.warning(f"Indexes: Hot {problem}.")
+    if problems and plan_check == "fail":
+        raise RuntimeError(f"{len(problems)} hot query plan(s) are not index-backed: {'; '.join(problems)}")
+    if not problems:
+        logging.info("Indexes: All hot queries are index-backed.")
+
+
+async def ensure_indexes(repo, plan_check: str = "warn", shard_count: int = None):
+    """
+    Creates the declared indexes. Safe to call on every startup.
+    Required (unique) indexes are built before returning. The others are built in a background task
+    followed by an explain() check of every hot query, which logs a warning for each COLLSCAN or
+    in-memory SORT. With plan_check="fail" the build and check are awaited instead, and a bad plan
+    raises RuntimeError so the bot does not start; plan_check="off" skips the check.
+    Returns the background task, or None.
+    """
+    await create_indexes(repo, [spec for spec in INDEXES if spec.required])
+    if plan_check == "fail":
+        await build_and_verify(repo, plan_check, shard_count)
+        return None
+
+    async def build_in_background():
+        try:
+            await build_and_verify(repo, plan_check, shard_count)
+        except Exception as e:
+            logging.error(f"Indexes: Background index build failed: {e}", exc_info=True)
+
+    return asyncio.create_task(build_in_background())
@@ -0,0 +1,116 @@
+import logging
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+
+class PurchaseJournal:
+    """
+    Two-phase bookkeeping for gift purchases, kept in the `purchase_journal` collection.
+    1. reserve(): before any Telegram call, the gift's Stars are taken from the user's balance and
+       held by a journal entry ('reserved'). Users who can no longer afford the gift are dropped
+       here, so a gift is never bought without the Stars to pay for it.
+    2. mark_purchased(): once the purchase call succeeded, the entry becomes 'purchased'.
+    3. The entry is then committed (purchasing.Settlement, in bulk) or, if the purchase did not
+       happen, released with release(), which refunds the Stars.
+    Entries only exist while a purchase is open. recover() settles whatever a crash left behind,
+    in bulk: 'purchased' entries are committed and 'reserved' ones refunded, since the purchase
+    call is not known to have gone through. Every step is idempotent.
+    In cluster mode each worker recovers its own entries at startup, and the leader periodically
+    settles those of workers that are gone (recover_orphans).
+    """
+
+    def __init__(self, repo, owner: str = None):
+        self.repo = repo
+        self.owner = owner
+
+    async def reserve(self, assignments: list) -> list:
+        """Holds Stars for `assignments` in one bulk write. Returns those reserved, with reservation_id set."""
+        if not assignments:
+            return []
+        entries = []
+        for assignment in assignments:
+            entry = {'_id': ObjectId(), 'user_id': assignment.user_id, 'stars': assignment.gift.stars, 'gift_id': assignment.gift.id}
+            if self.owner is not None:
+                entry['owner'] = self.owner
+            entries.append(entry)
+        reserved_ids = await self.repo.reserve_stars(entries)
+        reserved = []
+        for assignment, entry in zip(assignments, entries):
+            if entry['_id'] in reserved_ids:
+                assignment.reservation_id = entry['_id']
+                reserved.append(assignment)
+            else:
+                logging.info(f"PurchaseJournal: User {assignment.user_id} can no longer afford {assignment.gift.stars} Stars. Skipping.")
+        return reserved
+
+    async def reserve_stream(self, assignment_batches, issued: list = None):
+        """
+        Reserves each batch from an async iterable of Assignment lists and yields the reserved Assignments.
+        Reserved Assignments are also collected in `issued`, so the caller can release_unhandled() whatever
+        an interrupted run never got to.
+        """
+        async for assignments in assignment_batches:
+            reserved = await self.reserve(assignments)
+            if issued is not None:
+                # Keep only reservations still open, so the list stays about one batch long.
+                issued[:] = [a for a in issued if a.reservation_id is not None] + reserved
+            for assignment in reserved:
+                yield assignment
+
+    async def release_unhandled(self, assignments: list):
+        """Refunds, in one bulk write, the reservations in `assignments` that were neither purchased nor released."""
+        open_assignments = [a for a in assignments if a.reservation_id is not None]
+        if not open_assignments:
+            return
+        await self.repo.release_reservations([
+            {'_id': a.reservation_id, 'user_id': a.user_id, 'stars': a.gift.stars} for a in open_assignments
+        ])
+        for assignment in open_assignments:
+            assignment.reservation_id = None
+        logging.info(f"PurchaseJournal: Released {len(open_assignments)} reservation(s) left unprocessed.")
+
+    async def mark_purchased(self, assignment):
+        """
+        Records that the purchase went through; from here on the reservation is committed, never refunded.
+        The reservation is handed to the caller's settlement, so the assignment no longer holds it.
+        """
+        reservation_id, assignment.reservation_id = assignment.reservation_id, None
+        await self.repo.mark_reservation_purchased(reservation_id)
+        return reservation_id
+
+    async def release(self, assignment):
+        """Refunds the Stars held for an assignment whose purchase did not happen."""
+        if assignment.reservation_id is None:
+            return
+        await self.repo.release_reservations([{
+            '_id': assignment.reservation_id, 'user_id': assignment.user_id, 'stars': assignment.gift.stars
+        }])
+        assignment.reservation_id = None
+
+    async def recover(self) -> int:
+        """Commits or refunds every entry left open by a previous run. Returns their count."""
+        return await self._settle_open(self.repo.find_open_reservations(self.owner), "the last run")
+
+    async def recover_orphans(self, live_owners: set, grace: float = 600.0) -> int:
+        """
+        Commits or refunds the open entries of workers not in `live_owners` (e.g. scaled down, or
+        restarted under another WORKER_ID). Only entries older than `grace` seconds are touched, so a
+        worker whose lease lapsed briefly can still finish the purchases it had in flight. Returns their count.
+        """
+        created_before = datetime.utcnow() - timedelta(seconds=grace)
+        return await self._settle_open(self.repo.find_orphaned_reservations(live_owners, created_before), "stopped workers")
+
+    async def _settle_open(self, entries, left_by: str) -> int:
+        purchased, reserved = [], []
+        async for entry in entries:
+            (purchased if entry['state'] == 'purchased' else reserved).append(entry)
+        if purchased:
+            await self.repo.commit_reservations(purchased)
+            logging.warning(f"PurchaseJournal: Committed {len(purchased)} purchase(s) left open by {left_by}.")
+        if reserved:
+            # The purchase call may or may not have reached Telegram; refund and leave a trail for review.
+            await self.repo.release_reservations(reserved)
+            logging.warning(f"PurchaseJournal: Refunded {len(reserved)} reservation(s) left by {left_by} whose purchase outcome is unknown: "
+                            f"{[(e['user_id'], e['gift_id'], e['stars']) for e in reserved]}")
+        return len(purchased) + len(reserved)
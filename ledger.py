@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import uuid
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+
+
+@dataclass
+class Payment:
+    """A Star payment received by the bot."""
+    charge_id: str # Telegram charge ID, unique per payment
+    user_id: int
+    amount: int
+    currency: str = 'XTR'
+    provider_charge_id: str = None
+
+
+class PaymentLedger:
+    """
+    Idempotent, batched crediting of Star payments.
+    record() buffers a payment and waits for its batch. A batch is written once `batch_size`
+    payments are pending or `max_delay` seconds after its first payment, as:
+    one bulk upsert into the `payments` ledger (the unique charge_id index rejects redelivered
+    payments on the server), one bulk $inc of the new payments' amounts into the users'
+    balances, a read of the credited users, and finally marking the batch applied.
+    A batch interrupted between the ledger write and the `applied` mark is re-applied by
+    recover() at startup; the balance update is guarded per batch, so nothing is credited twice.
+    A batch that fails while the process keeps running is re-applied the same way in the
+    background, retried with exponential backoff from `retry_delay` seconds until it succeeds.
+    """
+
+    def __init__(self, repo, batch_size: int = 100, max_delay: float = 0.05, retry_delay: float = 1.0):
+        self.repo = repo
+        self.batch_size = max(1, batch_size)
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self._pending = [] # (payment, future)
+        self._lock = asyncio.Lock()
+        self._timer = None
+        self._recovery = None
+        self._tasks = set() # Background flushes and recoveries, referenced until they finish
+        self.recorded = 0
+        self.duplicates = 0
+
+    async def record(self, payment: Payment):
+        """
+        Credits `payment` and returns the payer's updated user document, or None if the charge
+        was already in the ledger. Raises if the batch could not be written.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((payment, future))
+        if len(self._pending) >= self.batch_size:
+            self._spawn(self.flush())
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self._flush_later())
+        return await future
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        await self.flush()
+
+    async def flush(self):
+        """Writes all buffered payments, `batch_size` at a time, and resolves their record() calls."""
+        while self._pending:
+            await self._write_batch()
+
+    async def _write_batch(self):
+        async with self._lock:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            if not batch:
+                return
+            batch_id = uuid.uuid4().hex
+            # A charge redelivered while its first copy is still buffered counts once.
+            first = {}
+            for payment, _ in batch:
+                first.setdefault(payment.charge_id, payment)
+            try:
+                new_charge_ids = set(await self.repo.record_payments([asdict(p) for p in first.values()], batch_id))
+                credits = defaultdict(int)
+                for charge_id in new_charge_ids:
+                    credits[first[charge_id].user_id] += first[charge_id].amount
+                user_docs = {}
+                if credits:
+                    user_docs = await self.repo.apply_payment_credits(dict(credits), batch_id)
+                    await self.repo.mark_payments_applied(batch_id)
+            except Exception as e:
+                # Whatever reached the ledger is re-applied in the background; a redelivered copy
+                # of these payments counts as a duplicate, so it must not wait for the next start.
+                logging.error(f"PaymentLedger: Batch {batch_id} of {len(batch)} payment(s) failed: {e}", exc_info=True)
+                if self._recovery is None or self._recovery.done():
+                    self._recovery = self._spawn(self._recover_until_done())
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            self.recorded += len(new_charge_ids)
+            self.duplicates += len(batch) - len(new_charge_ids)
+            logging.info(f"PaymentLedger: Credited {len(new_charge_ids)}/{len(batch)} payment(s) to {len(credits)} user(s) in batch {batch_id}.")
+
+        for payment, future in batch:
+            if future.done(): # Caller was cancelled
+                continue
+            if payment.charge_id in new_charge_ids and first[payment.charge_id] is payment:
+                future.set_result(user_docs.get(payment.user_id))
+            else:
+                future.set_result(None)
+
+    async def _recover_until_done(self):
+        delay = self.retry_delay
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.recover()
+                return
+            except Exception as e:
+                delay = min(delay * 2, 60.0)
+                logging.error(f"PaymentLedger: Recovery of unapplied payments failed, retrying in {delay:.0f}s: {e}")
+
+    async def recover(self) -> int:
+        """Re-applies payments that were recorded but never marked applied. Returns their count."""
+        batches = defaultdict(lambda: defaultdict(int)) # batch_id -> user_id -> stars
+        count = 0
+        async for payment in self.repo.find_unapplied_payments():
+            batches[payment['batch_id']][payment['user_id']] += payment['amount']
+            count += 1
+        for batch_id, credits in batches.items():
+            await self.repo.apply_payment_credits(dict(credits), batch_id)
+            await self.repo.mark_payments_applied(batch_id)
+        if count:
+            logging.warning(f"PaymentLedger: Recovered {count} unapplied payment(s) from {len(batches)} batch(es).")
+        return count
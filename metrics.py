@@ -0,0 +1,232 @@
+import asyncio
+import functools
+import logging
+import math
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value) -> str:
+    """A sample value in full precision; `:g` would round counters past 999999."""
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(value)
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed bucket bounds."""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    In-process counters and latency histograms, keyed by metric name and labels.
+    Recording is a dict update, cheap enough for every handler, Telegram call and DB command.
+    Counters the components already keep (cache hits, ledger totals, ...) are read at scrape
+    time through collect() rather than duplicated. render() produces the Prometheus text format
+    (see MetricsServer); snapshot() and summary() report what happened between two points, e.g.
+    over one purchase cycle.
+    """
+
+    def __init__(self, prefix: str = "giftbot_"):
+        self.prefix = prefix
+        self._counters = {} # name -> labels key -> value
+        self._histograms = {} # name -> labels key -> Histogram
+        self._collected = {} # name -> (kind, labels key -> callable)
+
+    # --- recording ---
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = _labels_key(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = _labels_key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observes the duration of the `with` block, including when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator observing the duration of every call of a coroutine function."""
+        def decorate(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def collect(self, name: str, func, kind: str = "counter", **labels):
+        """Exposes the value returned by `func()` at scrape time as `name` (counter or gauge)."""
+        self._collected.setdefault(name, (kind, {}))[1][_labels_key(labels)] = func
+
+    # --- reporting ---
+
+    def snapshot(self) -> dict:
+        """Current counter values and histogram (count, sum) per series."""
+        snapshot = {}
+        for name, series in self._counters.items():
+            for key, value in series.items():
+                snapshot[(name, key)] = value
+        for name, series in self._histograms.items():
+            for key, histogram in series.items():
+                snapshot[(name, key)] = (histogram.count, histogram.sum)
+        return snapshot
+
+    def summary(self, since: dict) -> str:
+        """
+        What was recorded after snapshot `since`: timings sorted by total time spent, then counters.
+        Everything recorded by the process in that window is included, not only the caller's work.
+        """
+        timings, counts = [], []
+        for (name, key), value in self.snapshot().items():
+            before = since.get((name, key))
+            if isinstance(value, tuple):
+                count = value[0] - (before[0] if before else 0)
+                total = value[1] - (before[1] if before else 0.0)
+                if count:
+                    timings.append((total, f"{name}{_format_labels(key)} n={count} total={total:.3f}s avg={total / count * 1000:.1f}ms"))
+            elif value - (before or 0):
+                counts.append(f"{name}{_format_labels(key)} +{value - (before or 0):.0f}")
+        timings.sort(reverse=True)
+        return '; '.join([line for _, line in timings] + sorted(counts)) or "nothing recorded"
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, series in sorted(self._counters.items()):
+            lines.append(f"# TYPE {self.prefix}{name} counter")
+            for key, value in series.items():
+                lines.append(f"{self.prefix}{name}{_format_labels(key)} {_format_value(value)}")
+        for name, (kind, funcs) in sorted(self._collected.items()):
+            lines.append(f"# TYPE {self.prefix}{name} {kind}")
+            for key, func in funcs.items():
+                try:
+                    value = func()
+                except Exception as e:
+                    logging.warning(f"Metrics: Could not collect {name}: {e}")
+                    continue
+                lines.append(f"{self.prefix}{name}{_format_labels(key)} {_format_value(value)}")
+        for name, series in sorted(self._histograms.items()):
+            lines.append(f"# TYPE {self.prefix}{name} histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                    lines.append(f"{self.prefix}{name}_bucket{_format_labels(key, (('le', le),))} {cumulative}")
+                lines.append(f"{self.prefix}{name}_sum{_format_labels(key)} {_format_value(histogram.sum)}")
+                lines.append(f"{self.prefix}{name}_count{_format_labels(key)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    pymongo command listener timing every database round trip, by command and collection.
+    Pass it to the client's `event_listeners` (see storage.Repository.connect).
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self._collections = {} # (connection_id, request_id) -> collection
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get('collection', '')
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def _finished(self, event, failed: bool):
+        collection = self._collections.pop((event.connection_id, event.request_id), '')
+        self.metrics.observe('mongo_command_seconds', event.duration_micros / 1e6,
+                             command=event.command_name, collection=collection)
+        if failed:
+            self.metrics.inc('mongo_command_failures_total', command=event.command_name, collection=collection)
+
+    def succeeded(self, event):
+        self._finished(event, failed=False)
+
+    def failed(self, event):
+        self._finished(event, failed=True)
+
+
+class MetricsServer:
+    """Minimal HTTP endpoint serving Metrics.render() on GET /metrics, meant for a local Prometheus scraper."""
+
+    def __init__(self, metrics: Metrics, host: str = "127.0.0.1", port: int = 9464):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logging.info(f"MetricsServer: Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the request headers.
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?', 1)[0] == '/metrics':
+                status, body = '200 OK', self.metrics.render().encode()
+            else:
+                status, body = '404 Not Found', b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e:
+            logging.debug(f"MetricsServer: Request failed: {e}")
+        finally:
+            writer.close()
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from telethon.errors import RPCError
+
+# Telegram rejects longer messages; coalesced text is split at this size.
+MAX_MESSAGE_LENGTH = 4096
+
+
+class NotificationOutbox:
+    """
+    Durable, asynchronous delivery of user notifications.
+    enqueue() stores the message in the `outbox` collection and hands the user to an in-process
+    asyncio.Queue; it never waits on Telegram. A pool of workers drains the queue, joining all
+    pending messages for the same user into one send, and retries failures with exponential
+    backoff. Messages are deleted once delivered, so whatever is left in the collection after
+    a crash or restart is replayed by start().
+    `send(user_id, text)` performs the actual delivery. When several processes share the
+    collection, each passes its own `owner` and only stores and replays its own messages;
+    adopt_orphans() takes over those of workers that are gone.
+    """
+
+    def __init__(self, repo, send, workers: int = 4, max_attempts: int = 5, retry_delay: float = 5.0, owner: str = None):
+        self.repo = repo
+        self.owner = owner
+        self._send = send
+        self._worker_count = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self._queue = asyncio.Queue()
+        self._pending = {} # user_id -> list of (message_id, text, attempts), in enqueue order
+        self._sending = set() # Users a worker is delivering to right now
+        self._workers = []
+        self.delivered = 0
+        self.failed = 0
+
+    def depth(self) -> int:
+        """Number of messages waiting for delivery."""
+        return sum(len(messages) for messages in self._pending.values())
+
+    async def start(self):
+        """Replays undelivered messages from the collection and starts the workers."""
+        replayed = 0
+        async for doc in self.repo.find_pending_outbox(self.owner):
+            self._add(doc['user_id'], doc['_id'], doc['text'], doc.get('attempts', 0))
+            replayed += 1
+        if replayed:
+            logging.info(f"NotificationOutbox: Replaying {replayed} undelivered message(s).")
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._worker_count)]
+
+    async def adopt_orphans(self, live_owners: set) -> int:
+        """Takes over and delivers the undelivered messages of owners not in `live_owners`. Returns their count."""
+        docs = await self.repo.adopt_outbox_messages(set(live_owners) | {self.owner}, self.owner)
+        for doc in docs:
+            self._add(doc['user_id'], doc['_id'], doc['text'], doc.get('attempts', 0))
+        if docs:
+            logging.warning(f"NotificationOutbox: Adopted {len(docs)} undelivered message(s) of stopped workers.")
+        return len(docs)
+
+    async def enqueue(self, user_id: int, text: str):
+        """Durably records a message for `user_id` and schedules its delivery."""
+        message_id = await self.repo.insert_outbox_message(user_id, text, self.owner)
+        self._add(user_id, message_id, text, 0)
+
+    def _add(self, user_id: int, message_id, text: str, attempts: int):
+        messages = self._pending.get(user_id)
+        if messages is None:
+            # Only the first pending message puts the user in the queue; later ones are coalesced.
+            # Users being delivered to are re-queued by their worker, keeping per-user order.
+            self._pending[user_id] = [(message_id, text, attempts)]
+            if user_id not in self._sending:
+                self._queue.put_nowait(user_id)
+        else:
+            messages.append((message_id, text, attempts))
+
+    def _take_batch(self, user_id: int):
+        """Removes as many of the user's pending messages as fit in one Telegram message."""
+        messages = self._pending.pop(user_id, [])
+        batch, length = [], 0
+        for index, message in enumerate(messages):
+            added = len(message[1]) + (2 if batch else 0)
+            if batch and length + added > MAX_MESSAGE_LENGTH:
+                self._pending[user_id] = messages[index:]
+                break
+            batch.append(message)
+            length += added
+        return batch
+
+    async def _worker(self):
+        while True:
+            user_id = await self._queue.get()
+            self._sending.add(user_id)
+            try:
+                batch = self._take_batch(user_id)
+                if batch:
+                    await self._deliver(user_id, batch)
+            except Exception as e:
+                logging.error(f"NotificationOutbox: Worker error for user {user_id}: {e}", exc_info=True)
+            finally:
+                self._sending.discard(user_id)
+                if user_id in self._pending:
+                    self._queue.put_nowait(user_id)
+                self._queue.task_done()
+
+    def _requeue(self, user_id: int, batch: list, attempts: int):
+        for message_id, text, _ in batch:
+            self._add(user_id, message_id, text, attempts)
+
+    async def _deliver(self, user_id: int, batch: list):
+        message_ids = [message_id for message_id, _, _ in batch]
+        try:
+            await self._send(user_id, "\n\n".join(text for _, text, _ in batch))
+        except Exception as e:
+            attempts = max(a for _, _, a in batch) + 1
+            # Telegram 4xx errors (user blocked the bot, deactivated, ...) will not succeed on retry.
+            permanent = isinstance(e, RPCError) and e.code in (400, 403)
+            if permanent or attempts >= self.max_attempts:
+                self.failed += len(batch)
+                logging.error(f"NotificationOutbox: Giving up on {len(batch)} message(s) for user {user_id} after {attempts} attempt(s): {e}")
+                await self.repo.mark_outbox_failed(message_ids, str(e))
+                return
+            delay = self.retry_delay * (2 ** (attempts - 1))
+            logging.warning(f"NotificationOutbox: Delivery to user {user_id} failed (attempt {attempts}), retrying in {delay:.0f}s: {e}")
+            await self.repo.record_outbox_attempt(message_ids, str(e))
+            asyncio.get_running_loop().call_later(delay, self._requeue, user_id, batch, attempts)
+            return
+
+        self.delivered += len(batch)
+        await self.repo.delete_outbox_messages(message_ids)
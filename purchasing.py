@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+from discovery import GiftOption
+
+
+@dataclass
+class CycleStats:
+    """Per-cycle counters reported by PurchaseExecutor."""
+    dispatched: int = 0 # Users handed to a worker
+    purchased: int = 0 # Users for whom a gift was bought
+    failed: int = 0 # Users whose handler raised
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def purchases_per_second(self) -> float:
+        return self.purchased / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (f"dispatched={self.dispatched}, purchased={self.purchased}, failed={self.failed}, "
+                f"elapsed={self.elapsed:.2f}s, throughput={self.purchases_per_second:.2f} purchases/s")
+
+
+class PurchaseExecutor:
+    """
+    Runs a per-user purchase handler with at most `concurrency` users in flight.
+    Users are handed to workers strictly in the order the source yields them, so the
+    FIFO priority of the queue query is kept: a user never starts before someone ahead
+    of them in the queue has started.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+
+    async def run(self, users, handler, stats: CycleStats = None) -> CycleStats:
+        """
+        Feeds `users` (an iterable or async iterable) to `handler(user)`.
+        `handler` returns True when it bought a gift. Returns the cycle's stats; pass `stats`
+        to keep accumulating into the same counters across several runs of one cycle.
+        If `users` raises, the users already handed out are still handled before the error is re-raised.
+        """
+        stats = stats if stats is not None else CycleStats()
+        # Bounded hand-off queue: the producer never runs far ahead of the workers,
+        # so a large queue is streamed rather than materialized.
+        work_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                user = await work_queue.get()
+                try:
+                    if user is None:
+                        return
+                    if await handler(user):
+                        stats.purchased += 1
+                except Exception as e:
+                    stats.failed += 1
+                    logging.error(f"PurchaseExecutor: Handler failed for {user!r}: {e}", exc_info=True)
+                finally:
+                    work_queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        source_error = None
+        try:
+            try:
+                if hasattr(users, '__aiter__'):
+                    async for user in users:
+                        await work_queue.put(user)
+                        stats.dispatched += 1
+                else:
+                    for user in users:
+                        await work_queue.put(user)
+                        stats.dispatched += 1
+            except Exception as e:
+                # Stop feeding but let the workers drain: a handler cancelled after its purchase
+                # went through would have the purchase refunded.
+                source_error = e
+            for _ in workers:
+                await work_queue.put(None)
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            # Only the caller's own cancellation interrupts handlers in flight.
+            for task in workers:
+                task.cancel()
+            raise
+        finally:
+            stats.finished_at = time.monotonic()
+        if source_error is not None:
+            raise source_error
+        return stats
+
+
+@dataclass
+class PendingDebit:
+    """A purchase that went through on Telegram and whose reserved Stars still have to be committed."""
+    user_id: int
+    stars: int
+    gift: GiftOption
+    reason: str
+    reservation_id: object = None # purchase_journal entry holding the Stars
+
+
+class Settlement:
+    """
+    Commits the Star reservations of successful purchases (see journal.PurchaseJournal).
+    Purchases are buffered and flushed once `batch_size` are pending (or when flush() is called at
+    the end of a cycle). Each flush is one bulk commit of the reservations followed by a single
+    read of the resulting balances. The Stars were already taken from the balance when they were
+    reserved, so committing cannot fail for lack of funds.
+    `on_settled(debit, new_balance)` is awaited for each purchase; `new_balance` is None when the
+    commit could not be written (the reservation stays in the journal for recovery).
+    """
+
+    def __init__(self, repo, on_settled, batch_size: int = 100):
+        self.repo = repo
+        self.on_settled = on_settled
+        self.batch_size = max(1, batch_size)
+        self._pending = []
+        self._lock = asyncio.Lock()
+
+    async def add(self, debit: PendingDebit):
+        """Queues a purchase, flushing if the batch is full."""
+        self._pending.append(debit)
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Commits all pending purchases and reports each outcome to `on_settled`."""
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+
+            try:
+                await self.repo.commit_reservations([{'_id': d.reservation_id, 'user_id': d.user_id} for d in batch])
+                balances = await self.repo.get_balances([d.user_id for d in batch])
+                outcomes = [(d, balances.get(d.user_id)) for d in batch]
+            except Exception as e:
+                # The reservations are still in the journal and are committed by recovery on the next start.
+                logging.error(f"Settlement: Commit failed for users {[d.user_id for d in batch]}: {e}", exc_info=True)
+                outcomes = [(d, None) for d in batch]
+            logging.info(f"Settlement: Committed {sum(1 for _, b in outcomes if b is not None)}/{len(batch)} purchase(s) in one write.")
+
+        for debit, new_balance in outcomes:
+            try:
+                await self.on_settled(debit, new_balance)
+            except Exception as e:
+                logging.error(f"Settlement: on_settled failed for user {debit.user_id}: {e}", exc_info=True)
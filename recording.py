@@ -0,0 +1,95 @@
+import gzip
+import json
+import logging
+import time
+from dataclasses import asdict
+
+from telethon.tl.types import (InputPeerUser, MessageActionEmpty, MessageActionPaymentSent, MessageActionPaymentSentMe,
+                               MessageService, PaymentCharge)
+
+from discovery import GiftOption
+
+
+class UpdateRecorder:
+    """
+    Records the bot's input traffic for later replay (see replay.py): every incoming update and
+    every gift option poll is appended to a gzip-compressed JSONL file, one entry per line, with
+    its wall-clock time in `ts`. Entries are {'kind': 'update', ...} (see update_entry) or
+    {'kind': 'options', 'options': [...]}, where `options` is None for a failed poll.
+    The file is flushed every `flush_every` entries, so a crash loses at most that many.
+    Recordings contain user IDs and message texts; treat them like the database.
+    """
+
+    def __init__(self, path: str, flush_every: int = 100):
+        self.path = path
+        self.flush_every = max(1, flush_every)
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self.recorded = 0
+
+    def record_update(self, event):
+        try:
+            self._write(update_entry(event))
+        except Exception as e:
+            logging.warning(f"UpdateRecorder: Could not record update: {e}")
+
+    def record_options(self, options):
+        """Records a discovery poll; `options` is the raw option list, or None if the poll failed."""
+        try:
+            self._write({'kind': 'options',
+                         'options': None if options is None else [asdict(GiftOption.from_option(o)) for o in options]})
+        except Exception as e:
+            logging.warning(f"UpdateRecorder: Could not record gift options: {e}")
+
+    def _write(self, entry: dict):
+        entry['ts'] = time.time()
+        self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.recorded += 1
+        if self.recorded % self.flush_every == 0:
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+        logging.info(f"UpdateRecorder: Recorded {self.recorded} entries to {self.path}.")
+
+
+def update_entry(event) -> dict:
+    """The replayable fields of a NewMessage event: sender, message ID and either its text or its service action."""
+    message = event.message
+    entry = {'kind': 'update', 'sender_id': event.sender_id, 'chat_id': event.chat_id, 'message_id': message.id}
+    if isinstance(event.input_sender, InputPeerUser):
+        entry['access_hash'] = event.input_sender.access_hash
+    if isinstance(message, MessageService):
+        action = message.action
+        entry['action'] = {'type': type(action).__name__,
+                           'currency': getattr(action, 'currency', None),
+                           'total_amount': getattr(action, 'total_amount', None)}
+        charge = getattr(action, 'charge', None)
+        if charge is not None:
+            entry['action']['charge_id'] = charge.id
+            entry['action']['provider_charge_id'] = charge.provider_charge_id
+    else:
+        entry['text'] = message.message
+    return entry
+
+
+def action_from_entry(action: dict):
+    """Rebuilds the TL action of a recorded service message. Actions the bot does not handle become MessageActionEmpty."""
+    if action['type'] == 'MessageActionPaymentSentMe':
+        return MessageActionPaymentSentMe(currency=action['currency'], total_amount=action['total_amount'], payload=b'',
+                                          charge=PaymentCharge(id=action['charge_id'], provider_charge_id=action.get('provider_charge_id') or ''))
+    if action['type'] == 'MessageActionPaymentSent':
+        return MessageActionPaymentSent(currency=action['currency'], total_amount=action['total_amount'])
+    return MessageActionEmpty()
+
+
+def read_recording(path: str):
+    """Yields the entries of a recording in order. A last line cut off by a crash is skipped."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"read_recording: Skipping a truncated entry in {path}.")
+        except EOFError:
+            logging.warning(f"read_recording: {path} ends without a complete gzip trailer (recorder did not close).")
@@ -0,0 +1,172 @@
+"""
+Replays a recording made with RECORD_UPDATES_PATH (see recording.UpdateRecorder) against local stand-ins.
+
+Recorded updates are fed through the bot's dispatch_update (router and handlers) and recorded
+gift option polls through poll_once (the body of polling_loop, including purchase cycles), with
+a local mongod and fake_telegram.FakeTelegramClient in place of Telegram. Timing is kept at
+--speed 1 (as recorded), compressed (--speed 10) or dropped (--speed max), so a real gift drop
+can be replayed as a burst to measure queueing delay and plan capacity.
+
+    python replay.py drop.jsonl.gz --speed 10
+    python replay.py drop.jsonl.gz --speed max --latency 0.1
+
+Reported per update kind: the delay from an update's (scaled) arrival to the start of its handling
+and to its completion, p50/p99/max; the duration of every poll; Telegram gateway statistics and
+the bot's metrics summary for the run.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from types import SimpleNamespace
+
+from pymongo import MongoClient
+
+from benchmark import import_bot, latency_summary, use_client
+from fake_telegram import FakeEvent, FakeTelegramClient
+from recording import action_from_entry, read_recording
+
+
+def event_from_entry(fake: FakeTelegramClient, entry: dict) -> FakeEvent:
+    action = action_from_entry(entry['action']) if entry.get('action') else None
+    return FakeEvent(fake, entry['sender_id'], text=entry.get('text'), action=action,
+                     message_id=entry['message_id'], access_hash=entry.get('access_hash'))
+
+
+def update_kind(entry: dict) -> str:
+    if entry.get('action'):
+        return entry['action']['type']
+    text = entry.get('text') or ''
+    return text.split(None, 1)[0].split('@', 1)[0] if text.startswith('/') else 'text'
+
+
+async def replay(bot, fake: FakeTelegramClient, entries, speed: float = None) -> dict:
+    """
+    Feeds `entries` to the bot, `speed` times faster than recorded (None: as fast as possible).
+    Updates are handled concurrently, as Telethon does; polls never overlap, as in polling_loop.
+    """
+    scheduler = bot.discovery_scheduler()
+    waits, latencies, polls = {}, {}, []
+    tasks = set()
+    poll_task = None
+    skipped_polls = 0
+    first_ts = None
+    started = time.monotonic()
+
+    async def handle(event, kind: str, due: float):
+        waits.setdefault(kind, []).append(time.monotonic() - due)
+        try:
+            await bot.dispatch_update(event)
+        except Exception as e:
+            logging.error(f"replay: Update {kind} failed: {e}", exc_info=True)
+        latencies.setdefault(kind, []).append(time.monotonic() - due)
+
+    async def poll():
+        poll_started = time.monotonic()
+        try:
+            await bot.poll_once(scheduler)
+        except Exception as e:
+            logging.error(f"replay: Poll failed: {e}", exc_info=True)
+        polls.append(time.monotonic() - poll_started)
+
+    for entry in entries:
+        if first_ts is None:
+            first_ts = entry['ts']
+        due = time.monotonic()
+        if speed:
+            due = started + (entry['ts'] - first_ts) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0) # Let handlers start between entries
+
+        if entry['kind'] == 'update':
+            task = asyncio.create_task(handle(event_from_entry(fake, entry), update_kind(entry), due))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif entry['kind'] == 'options':
+            if entry['options'] is None:
+                skipped_polls += 1 # The recorded poll failed
+                continue
+            fake.set_options([SimpleNamespace(**option) for option in entry['options']])
+            if poll_task is not None:
+                await poll_task
+            poll_task = asyncio.create_task(poll())
+
+    if poll_task is not None:
+        await poll_task
+    if tasks:
+        await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+
+    updates = sum(len(samples) for samples in latencies.values())
+    return {
+        'elapsed_seconds': elapsed,
+        'updates': updates,
+        'updates_per_second': updates / elapsed if elapsed > 0 else 0.0,
+        'queueing_delay': {kind: latency_summary(samples) | {'max_ms': max(samples) * 1000} for kind, samples in sorted(waits.items())},
+        'handling_latency': {kind: latency_summary(samples) | {'max_ms': max(samples) * 1000} for kind, samples in sorted(latencies.items())},
+        'polls': latency_summary(polls),
+        'failed_polls_skipped': skipped_polls,
+        'purchases': len(fake.purchases),
+        'gateway': bot.gateway.stats(),
+    }
+
+
+def parse_speed(value: str):
+    if value == 'max':
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded updates and gift option polls against a local mongod and a fake Telegram client.")
+    parser.add_argument('recording', help="A .jsonl.gz file written with RECORD_UPDATES_PATH")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help="Replay speed factor (1, 10, ...) or 'max' (default: 1)")
+    parser.add_argument('--latency', type=float, default=0.05, help="Fake Telegram call latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.5, help="+/- fraction applied to the latency")
+    parser.add_argument('--flood-wait-rate', type=float, default=0.0, help="Share of Telegram calls failing with a FloodWait")
+    parser.add_argument('--mongo', default=os.getenv('BENCHMARK_MONGO_URL', 'mongodb://localhost:27017'))
+    parser.add_argument('--database', default='giftbot_replay')
+    parser.add_argument('--fresh', action='store_true', help="Drop --database before replaying")
+    parser.add_argument('--balance-trigger', choices=('off', 'event'), default='event', help="BALANCE_TRIGGER_MODE during the replay")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    if args.database == os.getenv('MONGO_DATABASE_NAME', 'telegram_gift_bot'):
+        parser.error(f"--database {args.database} is the bot's own database; replaying writes to it.")
+    return args
+
+
+async def run(args) -> dict:
+    if args.fresh:
+        client = MongoClient(args.mongo)
+        client.drop_database(args.database)
+        client.close()
+    bot = import_bot(args.mongo, args.database, args.log_level, balance_trigger_mode=args.balance_trigger)
+    fake = FakeTelegramClient(latency=args.latency, jitter=args.jitter, flood_wait_rate=args.flood_wait_rate, seed=args.seed)
+    use_client(bot, fake)
+    await bot.start_services()
+    metrics_before = bot.metrics.snapshot()
+    try:
+        results = await replay(bot, fake, read_recording(args.recording), args.speed)
+    finally:
+        await bot.stop_services()
+    results['metrics'] = bot.metrics.summary(metrics_before)
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    print(json.dumps(asyncio.run(run(args)), indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
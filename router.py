@@ -0,0 +1,75 @@
+import logging
+from contextlib import nullcontext
+
+from telethon.tl.types import MessageService
+
+
+class CommandRouter:
+    """
+    Single entry point for incoming messages.
+    The command token of a text message is parsed once and looked up in a dict, so the cost per
+    update does not grow with the number of commands; commands match exactly ("/start" does not
+    match "/startle"), with an optional "@botname" suffix; once `username` is set, commands addressed
+    to another bot are ignored. Service messages are dispatched on the
+    type of their action (e.g. MessageActionPaymentSent) without looking at any text.
+    Command handlers are called as handler(event, args); action handlers as handler(event).
+    With `metrics` (metrics.Metrics), the duration of every handler call is recorded.
+    """
+
+    def __init__(self, metrics=None, username: str = None):
+        self._commands = {}
+        self._actions = {}
+        self.metrics = metrics
+        self.username = username # This bot's username, known once the client has started
+
+    def command(self, name: str):
+        """Decorator registering a handler for `/name`."""
+        def register(handler):
+            self._commands[name] = handler
+            return handler
+        return register
+
+    def action(self, action_type):
+        """Decorator registering a handler for service messages whose action is `action_type`."""
+        def register(handler):
+            self._actions[action_type] = handler
+            return handler
+        return register
+
+    @staticmethod
+    def parse(text: str, username: str = None):
+        """
+        Splits "/cmd@bot args" into ("/cmd", "args"). Returns (None, None) for non-commands, and
+        for commands addressed to a bot other than `username` (if given).
+        """
+        if not text or text[0] != '/':
+            return None, None
+        parts = text.split(None, 1)
+        command, _, addressee = parts[0].partition('@')
+        if addressee and username and addressee.lower() != username.lower():
+            return None, None
+        return command, parts[1].strip() if len(parts) > 1 else ''
+
+    def _timer(self, handler_name: str):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.timer('handler_seconds', handler=handler_name)
+
+    async def dispatch(self, event):
+        message = event.message
+        if message is None:
+            return
+        if isinstance(message, MessageService):
+            handler = self._actions.get(type(message.action))
+            if handler:
+                with self._timer(type(message.action).__name__):
+                    await handler(event)
+            return
+
+        command, args = self.parse(message.message, self.username)
+        handler = self._commands.get(command) if command else None
+        if handler:
+            with self._timer(command):
+                await handler(event, args)
+        elif command:
+            logging.debug(f"CommandRouter: Ignoring unknown command {command!r}.")
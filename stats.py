@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from storage import STATS_KEY
+
+
+class QueueStats:
+    """
+    Queue and balance statistics for the admin /stats command, pre-computed in one app_config
+    document (storage.STATS_KEY) so reading them costs a single find_one whatever the number of users.
+    The Repository's user mutations keep the counters current with $inc (see Repository.inc_stats):
+    joining and leaving the queue, preferences, payment credits, reservations and refunds, and
+    committed purchases. Every purchase cycle appends its summary (record_cycle).
+    Because a counter update is a separate write from its mutation, a crash in between or a
+    recovery re-run can leave them slightly off; reconcile(), run every `interval` seconds (and
+    once at start), recomputes them with an aggregation over `users`. `is_active()` lets only one
+    worker of a cluster run the reconcile.
+    """
+
+    def __init__(self, repo, interval: float = 3600.0, cycle_history: int = 20, is_active=None):
+        self.repo = repo
+        self.interval = interval
+        self.cycle_history = cycle_history
+        self._is_active = is_active or (lambda: True)
+        self._task = None
+
+    def start(self):
+        """Starts the periodic reconcile task; a non-positive interval disables it."""
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if self._is_active():
+                try:
+                    await self.reconcile()
+                except Exception as e:
+                    logging.error(f"QueueStats: Reconcile failed: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    async def reconcile(self) -> dict:
+        """Overwrites the counters with values aggregated from `users`. Returns them."""
+        values = await self.repo.aggregate_stats()
+        values['reconciled_at'] = datetime.utcnow()
+        before = await self.read()
+        await self.repo.set_stats(values)
+        drift = {name: values[name] - before.get(name, 0) for name in ('users', 'queued_users', 'outstanding_stars')
+                 if values[name] != before.get(name, 0)}
+        if drift:
+            logging.info(f"QueueStats: Reconciled statistics; corrected drift {drift}.")
+        return values
+
+    async def read(self) -> dict:
+        """The current statistics document's value (empty before the first update)."""
+        return await self.repo.get_config(STATS_KEY, {}) or {}
+
+    async def record_cycle(self, stats, worker: str = None):
+        """Appends a finished purchase cycle (purchasing.CycleStats) to the recent cycle history."""
+        cycle = {
+            'finished_at': datetime.utcnow(),
+            'dispatched': stats.dispatched,
+            'purchased': stats.purchased,
+            'failed': stats.failed,
+            'elapsed_seconds': round(stats.elapsed, 3),
+        }
+        if worker is not None:
+            cycle['worker'] = worker
+        try:
+            await self.repo.push_cycle_stats(cycle, self.cycle_history)
+        except Exception as e:
+            logging.warning(f"QueueStats: Could not record cycle statistics: {e}")
+
+
+def format_stats(stats: dict, top_gifts: int = 10, cycles: int = 5) -> str:
+    """Renders the statistics document for the /stats reply."""
+    if not stats:
+        return "No statistics recorded yet."
+    lines = [
+        f"Users: {stats.get('users', 0)}",
+        f"In gift queue: {stats.get('queued_users', 0)}",
+        f"Outstanding Stars: {stats.get('outstanding_stars', 0)}",
+        f"Gifts purchased: {stats.get('purchases', 0)}",
+    ]
+    preferences = sorted(((count, gift_id) for gift_id, count in (stats.get('preferences') or {}).items() if count > 0), reverse=True)
+    if preferences:
+        lines.append("Most preferred gifts:")
+        lines.extend(f"- {gift_id}: {count} user(s)" for count, gift_id in preferences[:top_gifts])
+    recent = (stats.get('cycles') or [])[-cycles:]
+    if recent:
+        lines.append("Recent purchase cycles:")
+        for cycle in reversed(recent):
+            finished = cycle['finished_at'].strftime('%Y-%m-%d %H:%M:%S') if cycle.get('finished_at') else '?'
+            worker = f" [{cycle['worker']}]" if cycle.get('worker') else ''
+            lines.append(f"- {finished}{worker}: {cycle.get('purchased', 0)} purchased, {cycle.get('failed', 0)} failed "
+                         f"of {cycle.get('dispatched', 0)} in {cycle.get('elapsed_seconds', 0):.1f}s")
+    if stats.get('reconciled_at'):
+        lines.append(f"Last reconciled: {stats['reconciled_at'].strftime('%Y-%m-%d %H:%M:%S')} UTC")
+    return "\n".join(lines)
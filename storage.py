@@ -0,0 +1,719 @@
+import logging
+import re
+from datetime import datetime
+
+from pymongo import AsyncMongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# Server error code for a unique index violation
+DUPLICATE_KEY_ERROR = 11000
+
+# Collections conceptual definition:
+# users: {
+# 'user_id': int, # Telegram User ID, Primary Key
+# 'star_balance': int, # Current number of stars the user has
+# 'last_activity_timestamp': datetime, # Timestamp of the last user activity
+# 'preferred_gift_ids': list, # List of gift IDs the user prefers
+# 'in_gift_queue': bool, # Whether the user is currently in the gift queue
+# 'reservations': list, # IDs of purchase_journal entries whose Stars are held (see Repository.reserve_stars)
+# 'last_credit_at': datetime, # When Stars were last credited (see Repository.watch_balance_credits)
+# 'payment_batches': list, # Most recent payment batches that credited the user (see Repository.apply_payment_credits)
+# 'access_hash': int # Telegram access_hash of the user for this bot (see entities.EntityCache)
+# }
+# payments: {
+# 'charge_id': str, # Telegram charge ID (unique), the idempotency key of a payment
+# 'provider_charge_id': str,
+# 'user_id': int, # Payer
+# 'amount': int, # Stars received
+# 'currency': str, # 'XTR'
+# 'batch_id': str, # Ledger batch that recorded the payment
+# 'applied': bool, # Whether the amount has been added to the user's star_balance
+# 'created_at': datetime
+# }
+# purchase_journal: {
+# '_id': ObjectId, # Reservation ID, also pushed to the user's `reservations`
+# 'user_id': int,
+# 'stars': int, # Stars held for the purchase
+# 'gift_id': int,
+# 'state': str, # 'reserved' until the purchase call succeeded, then 'purchased'; deleted once committed or released
+# 'owner': str, # Worker that made the reservation (cluster mode only)
+# 'created_at': datetime
+# }
+# outbox: {
+# 'user_id': int, # Recipient
+# 'text': str, # Message body
+# 'state': str, # 'pending' until delivered (then deleted) or 'failed'
+# 'attempts': int, # Delivery attempts so far
+# 'created_at': datetime,
+# 'last_error': str,
+# 'owner': str # Worker that delivers the message (cluster mode only, see cluster.LeaseManager)
+# }
+# update_claims: {
+# '_id': str, # "chat_id:message_id" of an incoming message (cluster mode only, see Repository.claim_update)
+# 'owner': str, # Worker that handles it
+# 'created_at': datetime # Claims expire after a day (TTL index)
+# }
+# app_config: {
+# 'key': str, # Configuration key, e.g., "last_checked_gift_timestamp"
+# 'value': any # Configuration value
+# }
+# Leases (see cluster.LeaseManager) are app_config documents whose value is
+# {'owner': str, 'expires_at': datetime, 'cycle_id': str}.
+# The STATS_KEY document (see stats.QueueStats) holds pre-computed statistics:
+# {'users': int, 'queued_users': int, 'outstanding_stars': int, # Sum of star_balance
+#  'preferences': {str(gift_id): int}, # Users listing each gift
+#  'purchases': int, 'cycles': list, # Recent purchase cycles, newest last
+#  'reconciled_at': datetime}
+
+# app_config key of the statistics document
+STATS_KEY = "stats"
+
+
+class Repository:
+    """
+    Async data layer for the bot's MongoDB collections.
+    Every read and write of `users` and `app_config` goes through this class so that
+    database round trips are awaited on pymongo's native asyncio client and never block
+    the Telethon event loop.
+    If a `user_cache` (cache.UserCache) is given, get_user reads through it and every user
+    write updates or invalidates the cached document.
+    """
+
+    def __init__(self, mongo_client, database_name: str, user_cache=None):
+        self.client = mongo_client
+        self.user_cache = user_cache
+        self.db = mongo_client[database_name]
+        self.users = self.db.users
+        self.app_config = self.db.app_config
+        self.outbox = self.db.outbox
+        self.payments = self.db.payments
+        self.purchase_journal = self.db.purchase_journal
+        self.update_claims = self.db.update_claims
+
+    @classmethod
+    def connect(cls, connection_string: str, database_name: str, *, max_pool_size: int = 100,
+                min_pool_size: int = 0, server_selection_timeout_ms: int = 5000,
+                connect_timeout_ms: int = 10000, socket_timeout_ms: int = 20000,
+                wait_queue_timeout_ms: int = 10000, user_cache=None, event_listeners: list = None):
+        """
+        Creates a pooled AsyncMongoClient and returns a Repository bound to the given database.
+        `event_listeners` are pymongo monitoring listeners, e.g. metrics.MongoCommandMetrics.
+        """
+        mongo_client = AsyncMongoClient(
+            connection_string,
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            serverSelectionTimeoutMS=server_selection_timeout_ms,
+            connectTimeoutMS=connect_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms,
+            waitQueueTimeoutMS=wait_queue_timeout_ms,
+            event_listeners=event_listeners or [],
+        )
+        logging.info(f"Repository: Mongo pool configured (maxPoolSize={max_pool_size}, minPoolSize={min_pool_size}).")
+        return cls(mongo_client, database_name, user_cache=user_cache)
+
+    async def close(self):
+        """Closes the underlying client and its connection pool."""
+        await self.client.close()
+
+    # --- users ---
+
+    def _patch_cached(self, user_id: int, fields: dict):
+        if self.user_cache is not None:
+            self.user_cache.patch(user_id, fields)
+
+    def _invalidate_cached(self, user_id: int):
+        if self.user_cache is not None:
+            self.user_cache.invalidate(user_id)
+
+    async def get_user(self, user_id: int):
+        """Returns the user document, or None if the user has no record."""
+        if self.user_cache is not None:
+            user_doc = self.user_cache.get(user_id)
+            if user_doc is not None:
+                return user_doc
+        user_doc = await self.users.find_one({'user_id': user_id})
+        if self.user_cache is not None:
+            self.user_cache.put(user_id, user_doc)
+        return user_doc
+
+    # The fields a user mutation needs from the previous document to update the statistics
+    STATS_PROJECTION = {'_id': 0, 'in_gift_queue': 1, 'preferred_gift_ids': 1}
+
+    async def join_queue(self, user_id: int, access_hash: int = None):
+        """
+        Puts the user in the gift queue, creating their record if needed. A given `access_hash` is stored in the same write.
+        Returns the user's previous document (queue and preference fields only), or None if the record was created.
+        """
+        fields = {'in_gift_queue': True}
+        if access_hash is not None:
+            fields['access_hash'] = access_hash
+        previous = await self.users.find_one_and_update(
+            {'user_id': user_id},
+            {
+                '$set': fields,
+                '$setOnInsert': {'star_balance': 0, 'preferred_gift_ids': [], 'user_id': user_id,
+                                 'last_activity_timestamp': datetime.utcnow()}
+            },
+            projection=self.STATS_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        self._patch_cached(user_id, fields)
+        if previous is None:
+            await self.inc_stats({'users': 1, 'queued_users': 1})
+        elif not previous.get('in_gift_queue'):
+            await self.inc_stats({'queued_users': 1})
+        return previous
+
+    async def leave_queue(self, user_id: int, access_hash: int = None):
+        """
+        Removes the user from the gift queue. Does not create a record. A given `access_hash` is stored in the same write.
+        Returns the user's previous document (queue and preference fields only), or None if there is no record.
+        """
+        fields = {'in_gift_queue': False}
+        if access_hash is not None:
+            fields['access_hash'] = access_hash
+        previous = await self.users.find_one_and_update(
+            {'user_id': user_id},
+            {'$set': fields},
+            projection=self.STATS_PROJECTION,
+            upsert=False, # Do not create a user if they don't exist
+            return_document=ReturnDocument.BEFORE
+        )
+        self._patch_cached(user_id, fields)
+        if previous is not None and previous.get('in_gift_queue'):
+            await self.inc_stats({'queued_users': -1})
+        return previous
+
+    async def add_preferred_gift(self, user_id: int, gift_id: int, access_hash: int = None):
+        """
+        Adds a gift ID to the user's preferences, creating their record if needed. A given `access_hash` is stored in the same write.
+        Returns the user's previous document (queue and preference fields only), or None if the record was created.
+        """
+        update = {
+            '$addToSet': {'preferred_gift_ids': gift_id},
+            '$setOnInsert': {
+                'star_balance': 0,
+                'in_gift_queue': True,
+                'user_id': user_id, # Ensure user_id is set on insert
+                'last_activity_timestamp': datetime.utcnow(),
+                # preferred_gift_ids will be handled by $addToSet
+            }
+        }
+        if access_hash is not None:
+            update['$set'] = {'access_hash': access_hash}
+        previous = await self.users.find_one_and_update(
+            {'user_id': user_id},
+            update,
+            projection=self.STATS_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        self._invalidate_cached(user_id)
+        if previous is None:
+            await self.inc_stats({'users': 1, 'queued_users': 1}, preferences={gift_id: 1})
+        elif gift_id not in (previous.get('preferred_gift_ids') or ()):
+            await self.inc_stats({}, preferences={gift_id: 1})
+        return previous
+
+    async def clear_preferences(self, user_id: int, access_hash: int = None):
+        """
+        Clears the user's gift preferences. Does not create a record. A given `access_hash` is stored in the same write.
+        Returns the user's previous document (queue and preference fields only), or None if there is no record.
+        """
+        fields = {'preferred_gift_ids': []}
+        if access_hash is not None:
+            fields['access_hash'] = access_hash
+        previous = await self.users.find_one_and_update(
+            {'user_id': user_id},
+            {'$set': fields},
+            # No upsert needed; if the user doesn't exist, there's nothing to clear.
+            projection=self.STATS_PROJECTION,
+            return_document=ReturnDocument.BEFORE
+        )
+        self._patch_cached(user_id, fields)
+        if previous and previous.get('preferred_gift_ids'):
+            await self.inc_stats({}, preferences={gift_id: -1 for gift_id in set(previous['preferred_gift_ids'])})
+        return previous
+
+    async def set_access_hash(self, user_id: int, access_hash: int):
+        """Stores the user's access_hash. Does not create a record."""
+        result = await self.users.update_one({'user_id': user_id}, {'$set': {'access_hash': access_hash}})
+        self._patch_cached(user_id, {'access_hash': access_hash})
+        return result
+
+    async def touch_activity(self, touches: dict):
+        """
+        Writes buffered activity times ({user_id: datetime}, see activity.ActivityBuffer) in one
+        unordered bulk_write. $max never moves a timestamp backwards, so a late flush cannot undo a
+        newer touch written elsewhere (e.g. by another worker). Does not create records.
+        """
+        operations = [
+            UpdateOne({'user_id': user_id}, {'$max': {'last_activity_timestamp': at}})
+            for user_id, at in touches.items()
+        ]
+        result = await self.users.bulk_write(operations, ordered=False)
+        for user_id, at in touches.items():
+            self._patch_cached(user_id, {'last_activity_timestamp': at})
+        return result
+
+    def find_access_hashes(self, limit: int):
+        """Returns a cursor over stored access hashes, most recently active users first."""
+        return self.users.find(
+            {'access_hash': {'$exists': True}},
+            projection={'_id': 0, 'user_id': 1, 'access_hash': 1},
+            batch_size=5000
+        ).sort('last_activity_timestamp', -1).limit(limit)
+
+    async def get_balances(self, user_ids: list) -> dict:
+        """Returns {user_id: star_balance} for the given users, in one query."""
+        cursor = self.users.find({'user_id': {'$in': user_ids}}, projection={'_id': 0, 'user_id': 1, 'star_balance': 1})
+        return {doc['user_id']: doc.get('star_balance', 0) async for doc in cursor}
+
+    # Fields the purchase cycle needs from each queued user.
+    QUEUED_USER_PROJECTION = {'_id': 0, 'user_id': 1, 'star_balance': 1, 'preferred_gift_ids': 1, 'access_hash': 1}
+
+    def find_queued_users(self, min_balance: int = 1, batch_size: int = 500, active_before: datetime = None,
+                          preferred_gift_ids: list = None, shards: list = None, shard_count: int = None):
+        """
+        Returns a streaming cursor over queued users who can afford at least `min_balance` Stars,
+        ordered by last_activity_timestamp ascending (FIFO).
+        Eligibility is checked by the server and only QUEUED_USER_PROJECTION is returned,
+        fetched `batch_size` documents per round trip.
+        If `active_before` is given, users touched at or after that time are left for the next cycle;
+        this keeps a user whose timestamp moves during the cycle from being streamed twice.
+        If `preferred_gift_ids` is given, only users who prefer at least one of those gifts are returned,
+        served by the multikey index on preferred_gift_ids.
+        If `shards` is given, only users with user_id % shard_count in `shards` are returned
+        (see cluster.shard_of); FIFO order holds across those shards.
+        """
+        query = {
+            'star_balance': {'$gte': max(1, min_balance)},
+            'in_gift_queue': True
+        }
+        if active_before is not None:
+            query['last_activity_timestamp'] = {'$not': {'$gte': active_before}}
+        if preferred_gift_ids:
+            query['preferred_gift_ids'] = {'$in': list(preferred_gift_ids)}
+        if shards is not None:
+            # A non-indexable $expr keeps the planner on the FIFO index, filtering shards on fetched documents.
+            query['$expr'] = {'$in': [{'$mod': ['$user_id', shard_count]}, list(shards)]}
+        return self.users.find(
+            query,
+            projection=self.QUEUED_USER_PROJECTION,
+            batch_size=batch_size
+        ).sort('last_activity_timestamp', 1) # 1 for ascending
+
+    async def watch_balance_credits(self, resume_after=None):
+        """
+        Opens a change stream of balance credits (and new users) on the users collection.
+        Debits are not reported. Each change's `fullDocument` carries user_id, star_balance,
+        preferred_gift_ids, in_gift_queue and access_hash. Requires a replica set or sharded cluster.
+        """
+        pipeline = [
+            {'$match': {'$or': [
+                {'operationType': 'insert'},
+                {'operationType': 'update', 'updateDescription.updatedFields.last_credit_at': {'$exists': True}},
+            ]}},
+            {'$project': {
+                'fullDocument.user_id': 1,
+                'fullDocument.star_balance': 1,
+                'fullDocument.preferred_gift_ids': 1,
+                'fullDocument.in_gift_queue': 1,
+                'fullDocument.access_hash': 1,
+            }},
+        ]
+        return await self.users.watch(pipeline, full_document='updateLookup', resume_after=resume_after)
+
+    # --- payments ---
+
+    async def record_payments(self, payments: list, batch_id: str) -> list:
+        """
+        Adds payment documents (each with a unique `charge_id`) to the ledger in one unordered
+        bulk_write, tagged with `batch_id` and not yet applied. Charges already in the ledger are
+        left untouched. Returns the charge IDs that were newly recorded.
+        """
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {'charge_id': payment['charge_id']},
+                {'$setOnInsert': {**payment, 'batch_id': batch_id, 'applied': False, 'created_at': now}},
+                upsert=True
+            )
+            for payment in payments
+        ]
+        try:
+            upserted = (await self.payments.bulk_write(operations, ordered=False)).upserted_ids
+        except BulkWriteError as e:
+            # Two upserts of the same charge can race; the loser is a duplicate, not a failure.
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details.get('writeErrors', [])):
+                raise
+            upserted = {item['index']: item['_id'] for item in e.details.get('upserted', [])}
+        return [payments[index]['charge_id'] for index in upserted]
+
+    # Payment batches remembered per user for apply_payment_credits' duplicate guard.
+    PAYMENT_BATCH_HISTORY = 20
+
+    def _credit_update(self, amount: int, batch_id: str, now: datetime) -> dict:
+        return {
+            '$inc': {'star_balance': amount},
+            '$set': {'last_credit_at': now},
+            '$push': {'payment_batches': {'$each': [batch_id], '$slice': -self.PAYMENT_BATCH_HISTORY}},
+        }
+
+    async def apply_payment_credits(self, credits: dict, batch_id: str) -> dict:
+        """
+        Adds {user_id: stars} from payment batch `batch_id` to the users' balances in one unordered
+        bulk_write, creating records if needed, and returns {user_id: updated user document}.
+        Each update is skipped for users whose recent `payment_batches` already include `batch_id`,
+        so re-applying a batch after a crash (see find_unapplied_payments) does not credit anyone twice.
+        Raises RuntimeError if a user's record does not show the batch afterwards, so the caller
+        does not mark the batch applied.
+        """
+        now = datetime.utcnow()
+        user_ids = list(credits)
+        operations = [
+            UpdateOne(
+                {'user_id': user_id, 'payment_batches': {'$ne': batch_id}},
+                {**self._credit_update(amount, batch_id, now), '$setOnInsert': {'preferred_gift_ids': [], 'in_gift_queue': True, 'last_activity_timestamp': now}},
+                upsert=True
+            )
+            for user_id, amount in credits.items()
+        ]
+        try:
+            result = await self.users.bulk_write(operations, ordered=False)
+            applied, created = result.modified_count + result.upserted_count, result.upserted_count
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            applied, created = e.details.get('nModified', 0) + e.details.get('nUpserted', 0), e.details.get('nUpserted', 0)
+            # The filter is not equality-only, so the server does not retry a duplicate-key upsert: either
+            # the batch was already applied to that user, or their record was inserted concurrently (a
+            # command or another worker's batch). The user exists now, so the credit is retried as an update.
+            for error in errors:
+                user_id = user_ids[error['index']]
+                result = await self.users.update_one({'user_id': user_id, 'payment_batches': {'$ne': batch_id}},
+                                                     self._credit_update(credits[user_id], batch_id, now))
+                applied += result.modified_count
+        if applied == len(operations):
+            await self.inc_stats({'users': created, 'queued_users': created, 'outstanding_stars': sum(credits.values())})
+        # Otherwise the batch was partly applied before (recovery); which users got it is unknown, so the
+        # balance total is left to the next stats reconcile.
+        user_docs = {doc['user_id']: doc async for doc in self.users.find({'user_id': {'$in': user_ids}})}
+        missing = [user_id for user_id in user_ids if batch_id not in user_docs.get(user_id, {}).get('payment_batches', [])]
+        for user_doc in user_docs.values():
+            user_doc.pop('payment_batches', None)
+        if self.user_cache is not None:
+            for user_id, user_doc in user_docs.items():
+                self.user_cache.put(user_id, user_doc)
+        if missing:
+            raise RuntimeError(f"Batch {batch_id} was not applied to user(s) {missing}")
+        return user_docs
+
+    async def mark_payments_applied(self, batch_id: str):
+        """Marks every payment of `batch_id` as applied to the users' balances."""
+        return await self.payments.update_many({'batch_id': batch_id, 'applied': False}, {'$set': {'applied': True}})
+
+    def find_unapplied_payments(self):
+        """Returns a cursor over recorded payments whose credit was never confirmed, oldest first."""
+        return self.payments.find({'applied': False}, batch_size=1000).sort('created_at', 1)
+
+    # --- purchase journal (see journal.PurchaseJournal) ---
+
+    async def reserve_stars(self, reservations: list) -> set:
+        """
+        Holds Stars for several purchases before they are made.
+        `reservations` are journal documents (_id, user_id, stars, gift_id and optionally owner). All of
+        them are written to the journal as 'reserved', then each user's balance is debited in one unordered
+        bulk_write guarded by star_balance >= stars, pushing the reservation's _id to `reservations`.
+        Entries whose guard failed are removed again. Returns the _ids that were reserved.
+        """
+        now = datetime.utcnow()
+        await self.purchase_journal.insert_many(
+            [{**reservation, 'state': 'reserved', 'created_at': now} for reservation in reservations], ordered=False
+        )
+        operations = [
+            UpdateOne(
+                {'user_id': r['user_id'], 'star_balance': {'$gte': r['stars']}, 'reservations': {'$ne': r['_id']}},
+                {'$inc': {'star_balance': -r['stars']}, '$push': {'reservations': r['_id']}}
+            )
+            for r in reservations
+        ]
+        result = await self.users.bulk_write(operations, ordered=False)
+        ids = [r['_id'] for r in reservations]
+        if result.modified_count == len(reservations):
+            reserved = set(ids)
+        else:
+            # Some guards failed; find out which reservations made it onto a user.
+            cursor = self.users.find(
+                {'user_id': {'$in': [r['user_id'] for r in reservations]}, 'reservations': {'$in': ids}},
+                projection={'_id': 0, 'reservations': 1}
+            )
+            held = {reservation_id async for doc in cursor for reservation_id in doc['reservations']}
+            reserved = held.intersection(ids)
+            await self.purchase_journal.delete_many({'_id': {'$in': [i for i in ids if i not in reserved]}})
+        for r in reservations:
+            self._invalidate_cached(r['user_id'])
+        if reserved:
+            await self.inc_stats({'outstanding_stars': -sum(r['stars'] for r in reservations if r['_id'] in reserved)})
+        return reserved
+
+    async def mark_reservation_purchased(self, reservation_id):
+        """Records that the purchase for a reservation went through, so recovery commits rather than refunds it."""
+        return await self.purchase_journal.update_one({'_id': reservation_id}, {'$set': {'state': 'purchased'}})
+
+    async def commit_reservations(self, reservations: list):
+        """
+        Finalizes purchased reservations (journal documents with _id and user_id): the held Stars stay
+        debited, the reservation is dropped from the user and the journal. Safe to repeat.
+        """
+        operations = [
+            UpdateOne(
+                {'user_id': r['user_id'], 'reservations': r['_id']},
+                {'$pull': {'reservations': r['_id']}}
+            )
+            for r in reservations
+        ]
+        result = await self.users.bulk_write(operations, ordered=False)
+        await self.purchase_journal.delete_many({'_id': {'$in': [r['_id'] for r in reservations]}})
+        for r in reservations:
+            self._invalidate_cached(r['user_id'])
+        # Repeated commits match nothing, so only first commits count as purchases.
+        if result.modified_count:
+            await self.inc_stats({'purchases': result.modified_count})
+
+    async def release_reservations(self, reservations: list):
+        """
+        Cancels reservations (journal documents with _id, user_id and stars) whose purchase did not
+        happen: the held Stars are refunded and the reservation is dropped. Safe to repeat.
+        """
+        operations = [
+            UpdateOne(
+                {'user_id': r['user_id'], 'reservations': r['_id']},
+                {'$inc': {'star_balance': r['stars']}, '$pull': {'reservations': r['_id']}}
+            )
+            for r in reservations
+        ]
+        result = await self.users.bulk_write(operations, ordered=False)
+        await self.purchase_journal.delete_many({'_id': {'$in': [r['_id'] for r in reservations]}})
+        for r in reservations:
+            self._invalidate_cached(r['user_id'])
+        if result.modified_count == len(reservations):
+            await self.inc_stats({'outstanding_stars': sum(r['stars'] for r in reservations)})
+        # Otherwise some were refunded before (repeated release); the next stats reconcile corrects the total.
+
+    def find_open_reservations(self, owner: str = None):
+        """Returns a cursor over journal entries left open (of `owner`, if given)."""
+        query = {'state': {'$in': ['reserved', 'purchased']}}
+        if owner is not None:
+            query['owner'] = owner
+        return self.purchase_journal.find(query, batch_size=1000)
+
+    def find_orphaned_reservations(self, live_owners: set, created_before: datetime):
+        """Returns a cursor over open journal entries created before `created_before` by owners not in `live_owners`."""
+        return self.purchase_journal.find({
+            'state': {'$in': ['reserved', 'purchased']},
+            'owner': {'$nin': list(live_owners)},
+            'created_at': {'$lt': created_before},
+        }, batch_size=1000)
+
+    # --- outbox ---
+
+    async def insert_outbox_message(self, user_id: int, text: str, owner: str = None):
+        """Stores a pending notification, optionally tagged with the worker delivering it. Returns its _id."""
+        message = {
+            'user_id': user_id,
+            'text': text,
+            'state': 'pending',
+            'attempts': 0,
+            'created_at': datetime.utcnow()
+        }
+        if owner is not None:
+            message['owner'] = owner
+        result = await self.outbox.insert_one(message)
+        return result.inserted_id
+
+    def find_pending_outbox(self, owner: str = None):
+        """Returns a cursor over undelivered notifications (of `owner`, if given), oldest first."""
+        query = {'state': 'pending'}
+        if owner is not None:
+            query['owner'] = owner
+        return self.outbox.find(query, batch_size=1000).sort('created_at', 1)
+
+    async def adopt_outbox_messages(self, live_owners: set, owner: str) -> list:
+        """
+        Hands the undelivered notifications of owners not in `live_owners` to `owner`.
+        Returns the adopted messages, oldest first.
+        """
+        query = {'state': 'pending', 'owner': {'$nin': list(live_owners)}}
+        ids = [doc['_id'] async for doc in self.outbox.find(query, projection={'_id': 1})]
+        if not ids:
+            return []
+        # Re-check the owner, so a worker that came back meanwhile keeps its messages.
+        await self.outbox.update_many({**query, '_id': {'$in': ids}}, {'$set': {'owner': owner}})
+        return await self.outbox.find({'_id': {'$in': ids}, 'owner': owner}).sort('created_at', 1).to_list(None)
+
+    async def delete_outbox_messages(self, message_ids: list):
+        """Removes delivered notifications."""
+        return await self.outbox.delete_many({'_id': {'$in': message_ids}})
+
+    async def record_outbox_attempt(self, message_ids: list, error: str):
+        """Counts a failed delivery attempt; the messages stay pending."""
+        return await self.outbox.update_many(
+            {'_id': {'$in': message_ids}},
+            {'$inc': {'attempts': 1}, '$set': {'last_error': error}}
+        )
+
+    async def mark_outbox_failed(self, message_ids: list, error: str):
+        """Marks notifications as permanently undeliverable; they are no longer replayed."""
+        return await self.outbox.update_many(
+            {'_id': {'$in': message_ids}},
+            {'$inc': {'attempts': 1}, '$set': {'state': 'failed', 'last_error': error}}
+        )
+
+    # --- app_config ---
+
+    async def get_config(self, key: str, default=None):
+        """Returns the value stored under `key` in app_config, or `default`."""
+        doc = await self.app_config.find_one({'key': key})
+        return doc['value'] if doc else default
+
+    async def set_config(self, key: str, value):
+        """Stores `value` under `key` in app_config."""
+        return await self.app_config.update_one(
+            {'key': key},
+            {'$set': {'value': value}},
+            upsert=True
+        )
+
+    # --- statistics (see stats.QueueStats) ---
+
+    async def inc_stats(self, counters: dict, preferences: dict = None):
+        """
+        Applies counter deltas (e.g. {'queued_users': 1}) and per-gift preference deltas to the
+        statistics document in one $inc. Failures are logged, not raised: the mutation that caused
+        the change already happened, and the next reconcile corrects the counters.
+        """
+        increments = {f"value.{name}": delta for name, delta in counters.items() if delta}
+        for gift_id, delta in (preferences or {}).items():
+            if delta:
+                increments[f"value.preferences.{gift_id}"] = delta
+        if not increments:
+            return
+        try:
+            await self.app_config.update_one({'key': STATS_KEY}, {'$inc': increments}, upsert=True)
+        except Exception as e:
+            logging.warning(f"Repository: Could not update statistics {increments}: {e}")
+
+    async def push_cycle_stats(self, cycle: dict, history: int):
+        """Appends a purchase cycle summary to the statistics document, keeping the last `history`."""
+        return await self.app_config.update_one(
+            {'key': STATS_KEY},
+            {'$push': {'value.cycles': {'$each': [cycle], '$slice': -history}}},
+            upsert=True
+        )
+
+    async def aggregate_stats(self) -> dict:
+        """
+        Computes the counters from scratch with one aggregation over `users` (a full scan; see
+        stats.QueueStats.reconcile): users, queued users, the sum of balances and preference counts.
+        """
+        pipeline = [{'$facet': {
+            'totals': [{'$group': {
+                '_id': None,
+                'users': {'$sum': 1},
+                'queued_users': {'$sum': {'$cond': [{'$eq': ['$in_gift_queue', True]}, 1, 0]}},
+                'outstanding_stars': {'$sum': '$star_balance'},
+            }}],
+            'preferences': [
+                {'$unwind': '$preferred_gift_ids'},
+                {'$group': {'_id': '$preferred_gift_ids', 'users': {'$sum': 1}}},
+            ],
+        }}]
+        result = await (await self.users.aggregate(pipeline)).to_list(1)
+        facets = result[0] if result else {'totals': [], 'preferences': []}
+        totals = facets['totals'][0] if facets['totals'] else {}
+        return {
+            'users': totals.get('users', 0),
+            'queued_users': totals.get('queued_users', 0),
+            'outstanding_stars': totals.get('outstanding_stars', 0),
+            'preferences': {str(p['_id']): p['users'] for p in facets['preferences']},
+        }
+
+    async def set_stats(self, values: dict):
+        """Overwrites the given statistics fields, leaving the others (purchases, cycles) as they are."""
+        return await self.app_config.update_one(
+            {'key': STATS_KEY},
+            {'$set': {f"value.{name}": value for name, value in values.items()}},
+            upsert=True
+        )
+
+    # --- leases (see cluster.LeaseManager) ---
+
+    async def claim_update(self, update_key: str, owner: str) -> bool:
+        """Claims an incoming update for `owner`. Returns False if another worker claimed it first."""
+        try:
+            await self.update_claims.insert_one({'_id': update_key, 'owner': owner, 'created_at': datetime.utcnow()})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def acquire_lease(self, key: str, owner: str, ttl: float):
+        """
+        Takes or renews the lease stored under `key` in app_config for `ttl` seconds.
+        Succeeds if the lease is free, expired or already held by `owner`; expiry is measured on the
+        server clock, so workers on different machines agree on it. Returns the lease value
+        (owner, expires_at and anything stored with it), or None if another owner holds it.
+        """
+        doc = await self._take_lease(key, owner, ttl)
+        if doc is None:
+            # Either someone else holds the lease or it does not exist yet. The filter's $expr is not
+            # allowed in an upsert, so a missing lease is created already expired and then taken like any other.
+            try:
+                await self.app_config.insert_one({'key': key, 'value': {'owner': None, 'expires_at': datetime(1970, 1, 1)}})
+            except DuplicateKeyError:
+                pass # It exists (or another worker just created it)
+            doc = await self._take_lease(key, owner, ttl)
+        return doc['value'] if doc is not None else None
+
+    async def _take_lease(self, key: str, owner: str, ttl: float):
+        """Extends the lease under `key` to `owner` if it holds it or the lease has expired. Returns the document or None."""
+        return await self.app_config.find_one_and_update(
+            {'key': key, '$or': [
+                {'value.owner': owner},
+                {'$expr': {'$lt': ['$value.expires_at', '$$NOW']}},
+            ]},
+            [{'$set': {'value.owner': owner, 'value.expires_at': {'$add': ['$$NOW', int(ttl * 1000)]}}}],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def release_lease(self, key: str, owner: str):
+        """Expires the lease under `key` if `owner` holds it."""
+        return await self.app_config.update_one(
+            {'key': key, 'value.owner': owner},
+            {'$set': {'value.expires_at': datetime(1970, 1, 1)}}
+        )
+
+    async def set_lease_cycle(self, keys: list, owner: str, cycle_id: str):
+        """Stores the last purchase cycle run on the leases in `keys` held by `owner`."""
+        return await self.app_config.update_many(
+            {'key': {'$in': keys}, 'value.owner': owner},
+            {'$set': {'value.cycle_id': cycle_id}}
+        )
+
+    async def live_lease_owners(self, prefix: str) -> set:
+        """Owners of the unexpired leases whose key starts with `prefix`."""
+        cursor = self.app_config.find({
+            'key': {'$regex': f"^{re.escape(prefix)}"},
+            '$expr': {'$gt': ['$value.expires_at', '$$NOW']}
+        }, projection={'_id': 0, 'value.owner': 1})
+        return {doc['value']['owner'] async for doc in cursor}
+
+    async def count_live_leases(self, prefix: str) -> int:
+        """Number of unexpired leases whose key starts with `prefix`."""
+        return await self.app_config.count_documents({
+            'key': {'$regex': f"^{re.escape(prefix)}"},
+            '$expr': {'$gt': ['$value.expires_at', '$$NOW']}
+        })
@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+from activity import ActivityBuffer
+
+
+def buffered_repo(side_effect=None):
+    repo = MagicMock()
+    repo.touch_activity = AsyncMock(side_effect=side_effect)
+    return repo
+
+
+def test_repeated_touches_merge_into_one_write_per_user():
+    repo = buffered_repo()
+    start = datetime(2026, 1, 1)
+
+    async def run():
+        activity = ActivityBuffer(repo)
+        activity.touch(1, start)
+        activity.touch(1, start + timedelta(seconds=5))
+        activity.touch(1, start + timedelta(seconds=2)) # Older than what is buffered
+        activity.touch(2, start)
+        activity.touch(None)
+        assert len(activity) == 2
+        assert await activity.flush() == 2
+        assert await activity.flush() == 0 # Nothing left
+        return activity
+
+    activity = asyncio.run(run())
+    repo.touch_activity.assert_awaited_once_with({1: start + timedelta(seconds=5), 2: start})
+    assert activity.touches == 4 and activity.written == 2
+
+
+def test_flush_runs_on_the_interval_and_at_shutdown():
+    repo = buffered_repo()
+
+    async def run():
+        activity = ActivityBuffer(repo, flush_interval=0.05)
+        activity.start()
+        activity.touch(1)
+        await asyncio.sleep(0.08)
+        assert repo.touch_activity.await_count == 1 # Written by the periodic flush
+        activity.touch(2)
+        await activity.stop()
+        assert activity._task is None
+
+    asyncio.run(run())
+    assert [set(call.args[0]) for call in repo.touch_activity.await_args_list] == [{1}, {2}]
+
+
+def test_flush_starts_early_once_max_pending_users_wait():
+    repo = buffered_repo()
+
+    async def run():
+        activity = ActivityBuffer(repo, flush_interval=60, max_pending=3)
+        for user_id in (1, 2, 3):
+            activity.touch(user_id)
+        await asyncio.wait_for(activity._size_flush, 1)
+        return activity
+
+    activity = asyncio.run(run())
+    repo.touch_activity.assert_awaited_once()
+    assert len(activity) == 0
+
+
+def test_failed_flush_keeps_the_touches_for_the_next_one():
+    repo = buffered_repo(side_effect=[ConnectionError("down"), None])
+    start = datetime(2026, 1, 1)
+
+    async def run():
+        activity = ActivityBuffer(repo)
+        activity.touch(1, start)
+        assert await activity.flush() == 0
+        activity.touch(1, start + timedelta(seconds=1)) # Newer touch while the write was failing
+        assert await activity.flush() == 1
+
+    asyncio.run(run())
+    assert repo.touch_activity.await_args.args[0] == {1: start + timedelta(seconds=1)}
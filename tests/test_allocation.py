@@ -0,0 +1,25 @@
+from allocation import REASON_FALLBACK, REASON_PREFERRED, GiftCatalog
+from discovery import GiftOption
+
+
+def gift(gift_id: int, stars: int) -> GiftOption:
+    return GiftOption(id=gift_id, stars=stars, months=3, currency='XTR', amount=stars, flags=0, description=None)
+
+
+def test_cheapest_affordable():
+    catalog = GiftCatalog([gift(1, 500), gift(2, 100), gift(3, 100)])
+    assert catalog.cheapest_price == 100
+    assert catalog.cheapest_affordable(99) is None
+    assert catalog.cheapest_affordable(100).id == 2 # Equal prices keep discovery order
+    assert catalog.cheapest_affordable(1000).id == 2
+    assert GiftCatalog([]).cheapest_affordable(1000) is None
+
+
+def test_allocate_prefers_affordable_preferences():
+    catalog = GiftCatalog([gift(1, 500), gift(2, 100)])
+    assignments = catalog.allocate([
+        {'user_id': 10, 'star_balance': 600, 'preferred_gift_ids': [9, 1]},
+        {'user_id': 11, 'star_balance': 300, 'preferred_gift_ids': [1]},
+        {'user_id': 12, 'star_balance': 50},
+    ])
+    assert [(a.user_id, a.gift.id, a.reason) for a in assignments] == [(10, 1, REASON_PREFERRED), (11, 2, REASON_FALLBACK)]
@@ -0,0 +1,59 @@
+from unittest.mock import patch
+
+from cache import UserCache
+
+
+def test_entries_expire_after_the_ttl():
+    cache = UserCache(ttl=60)
+    with patch('cache.time.monotonic', return_value=1000.0):
+        cache.put(1, {'user_id': 1})
+    with patch('cache.time.monotonic', return_value=1060.0):
+        assert cache.get(1) == {'user_id': 1}
+    with patch('cache.time.monotonic', return_value=1060.1):
+        assert cache.get(1) is None
+    assert len(cache) == 0
+    assert cache.stats() == {'size': 0, 'hits': 1, 'misses': 1, 'hit_ratio': 0.5}
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = UserCache(capacity=2)
+    cache.put(1, {'user_id': 1})
+    cache.put(2, {'user_id': 2})
+    cache.get(1) # 2 is now the least recently used
+    cache.put(3, {'user_id': 3})
+    assert cache.get(2) is None
+    assert cache.get(1) == {'user_id': 1} and cache.get(3) == {'user_id': 3}
+
+
+def test_patch_and_invalidate():
+    cache = UserCache()
+    cache.put(1, {'user_id': 1, 'star_balance': 10})
+    cache.patch(1, {'star_balance': 20})
+    cache.patch(2, {'star_balance': 20}) # Not cached: nothing to patch
+    assert cache.get(1) == {'user_id': 1, 'star_balance': 20}
+    assert cache.get(2) is None
+    cache.invalidate(1)
+    cache.invalidate(1)
+    assert cache.get(1) is None
+
+
+def test_put_ignores_missing_documents():
+    cache = UserCache()
+    cache.put(1, None)
+    assert len(cache) == 0
+
+
+def test_callers_cannot_change_cached_documents():
+    cache = UserCache()
+    user_doc = {'user_id': 1, 'preferred_gift_ids': [5]}
+    cache.put(1, user_doc)
+    user_doc['preferred_gift_ids'].append(6)
+
+    cached = cache.get(1)
+    cached['star_balance'] = 1000
+    cached['preferred_gift_ids'].append(7)
+
+    fields = {'preferred_gift_ids': [8]}
+    cache.patch(1, fields)
+    fields['preferred_gift_ids'].append(9)
+    assert cache.get(1) == {'user_id': 1, 'preferred_gift_ids': [8]}
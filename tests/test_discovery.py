@@ -0,0 +1,102 @@
+from unittest.mock import patch
+
+import pytest
+
+from discovery import LIMITED_FLAG, SOLD_OUT_FLAG, DiscoveryScheduler, GiftOption, fingerprint_options
+
+
+def option(gift_id: int, flags: int = 0, stars: int = 100) -> GiftOption:
+    return GiftOption(id=gift_id, stars=stars, months=3, currency='XTR', amount=stars, flags=flags)
+
+
+def scheduler(**kwargs) -> DiscoveryScheduler:
+    return DiscoveryScheduler(**{'fast_interval': 10, 'slow_interval': 300, 'max_cycle_interval': 60, 'jitter': 0, **kwargs})
+
+
+def test_fingerprint_ignores_order_and_sees_flags_and_prices():
+    options = [option(1), option(2, LIMITED_FLAG)]
+    assert fingerprint_options(options) == fingerprint_options(reversed(options))
+    assert fingerprint_options(options) != fingerprint_options([option(1), option(2, LIMITED_FLAG | SOLD_OUT_FLAG)])
+    assert fingerprint_options(options) != fingerprint_options([option(1, stars=150), option(2, LIMITED_FLAG)])
+
+
+def test_unchanged_polls_back_off_to_the_slow_interval():
+    discovery = scheduler()
+    assert discovery.observe([option(1)]).changed
+    assert discovery.next_delay() == 10
+    delays = []
+    for _ in range(7):
+        assert not discovery.observe([option(1)]).changed
+        delays.append(discovery.next_delay())
+    assert delays == [20, 40, 80, 160, 300, 300, 300]
+
+    for _ in range(2000): # A long quiet period stays at the slow interval
+        discovery.observe([option(1)])
+    assert discovery.next_delay() == 300
+
+
+def test_a_change_resets_the_backoff():
+    discovery = scheduler()
+    discovery.observe([option(1)])
+    for _ in range(5):
+        discovery.observe([option(1)])
+    assert discovery.next_delay() == 300
+
+    change = discovery.observe([option(1), option(2, LIMITED_FLAG)])
+    assert change.changed and change.new_limited_ids == {2} and change.limited_live
+    assert discovery.next_delay() == 10
+
+    # Live stock keeps polling fast, however long the options stay the same.
+    for _ in range(10):
+        discovery.observe([option(1), option(2, LIMITED_FLAG)])
+    assert discovery.next_delay() == 10
+
+    change = discovery.observe([option(1), option(2, LIMITED_FLAG | SOLD_OUT_FLAG)])
+    assert change.sold_out_flipped_ids == {2} and not change.limited_live
+    assert discovery.next_delay() == 10
+
+
+def test_errors_back_off_and_a_poll_resets_them():
+    discovery = scheduler()
+    discovery.observe([option(1, LIMITED_FLAG)])
+    discovery.record_error()
+    discovery.record_error()
+    assert discovery.next_delay() == 40
+    discovery.observe([option(1, LIMITED_FLAG)])
+    assert discovery.next_delay() == 10
+
+
+def test_jitter_stays_within_bounds():
+    discovery = scheduler(jitter=0.2)
+    discovery.observe([option(1, LIMITED_FLAG)])
+    assert all(8 <= discovery.next_delay() <= 12 for _ in range(100))
+
+
+def test_cycle_due_on_change_and_after_the_max_interval():
+    discovery = scheduler()
+    live = [option(1, LIMITED_FLAG)]
+    assert not discovery.cycle_due(discovery.observe([option(1)])) # Nothing limited on offer
+
+    with patch('discovery.time.monotonic', return_value=1000.0):
+        change = discovery.observe(live)
+        assert discovery.cycle_due(change)
+        discovery.record_cycle()
+        assert not discovery.cycle_due(discovery.observe(live))
+    with patch('discovery.time.monotonic', return_value=1059.0):
+        assert not discovery.cycle_due(discovery.observe(live))
+    with patch('discovery.time.monotonic', return_value=1060.0):
+        assert discovery.cycle_due(discovery.observe(live))
+
+
+def test_unchanged_live_stock_is_due_when_no_cycle_ran_yet():
+    discovery = scheduler()
+    discovery.restore({'fingerprint': fingerprint_options([option(1, LIMITED_FLAG)]), 'flags': [[1, LIMITED_FLAG]]})
+    change = discovery.observe([option(1, LIMITED_FLAG)])
+    assert not change.changed and discovery.cycle_due(change)
+
+
+@pytest.mark.parametrize('state', [None, {}])
+def test_restore_ignores_missing_state(state):
+    discovery = scheduler()
+    discovery.restore(state)
+    assert discovery.fingerprint is None
@@ -0,0 +1,101 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+from telethon.errors import FloodWaitError
+
+from gateway import (PRIORITY_DISCOVERY, PRIORITY_NOTIFICATION, PRIORITY_PURCHASE, PRIORITY_REPLY, TelegramGateway,
+                     TokenBucket, parse_rate_limits)
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits("SendMessage=25/30, GetPremiumGiftCodeOptionsRequest=0.5") == {
+        'SendMessage': (25.0, 30.0),
+        'GetPremiumGiftCodeOptionsRequest': (0.5, 1.0),
+    }
+    assert parse_rate_limits("") == {}
+
+
+@pytest.mark.parametrize('spec', ["SendMessage=0", "SendMessage=-1/5", "SendMessage=fast", "SendMessage", "=5"])
+def test_parse_rate_limits_rejects_invalid_rates(spec):
+    with pytest.raises(ValueError, match="SendMessage|=5"):
+        parse_rate_limits(spec)
+
+
+def test_gateway_rejects_non_positive_rates():
+    with pytest.raises(ValueError):
+        TelegramGateway(MagicMock(), global_rate=0)
+    with pytest.raises(ValueError):
+        TelegramGateway(MagicMock(), default_rate=0)
+
+
+def test_token_bucket_refills_at_its_rate_up_to_the_burst():
+    bucket = TokenBucket(rate=2, burst=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.delay(now) == 0
+        bucket.consume()
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+    assert bucket.delay(now + 100) == 0 and bucket.tokens == 3
+
+
+def test_waiting_calls_are_admitted_in_priority_order():
+    order = []
+
+    async def record(name):
+        order.append(name)
+
+    async def run():
+        gateway = TelegramGateway(MagicMock(), global_rate=1000, default_rate=1000)
+        # Exhaust the global bucket so every call below has to wait for admission.
+        gateway._global.tokens = 0
+        calls = [
+            gateway.call('SendMessage', PRIORITY_NOTIFICATION, record, 'notification'),
+            gateway.call('SendMessage', PRIORITY_REPLY, record, 'reply'),
+            gateway.call('GetOptions', PRIORITY_DISCOVERY, record, 'discovery'),
+            gateway.call('Purchase', PRIORITY_PURCHASE, record, 'purchase 1'),
+            gateway.call('Purchase', PRIORITY_PURCHASE, record, 'purchase 2'),
+        ]
+        await asyncio.gather(*calls)
+        gateway._dispatcher.cancel()
+        return gateway
+
+    gateway = asyncio.run(run())
+    assert order == ['purchase 1', 'purchase 2', 'discovery', 'reply', 'notification']
+    assert gateway.admitted == 5 and gateway.queue_depth() == {'purchase': 0, 'discovery': 0, 'reply': 0, 'notification': 0}
+
+
+def test_flood_wait_blocks_the_method_and_requeues_the_call():
+    attempts = []
+
+    async def send(text):
+        attempts.append(text)
+        if len(attempts) == 1:
+            raise FloodWaitError(request=None, capture=0)
+        return text
+
+    async def run():
+        gateway = TelegramGateway(MagicMock())
+        result = await gateway.call('SendMessage', PRIORITY_REPLY, send, 'hi')
+        gateway._dispatcher.cancel()
+        return gateway, result
+
+    gateway, result = asyncio.run(run())
+    assert result == 'hi' and attempts == ['hi', 'hi']
+    assert gateway.flood_waits == 1 and 'SendMessage' in gateway._blocked_until
+
+
+def test_flood_wait_longer_than_the_limit_is_raised():
+    async def send():
+        raise FloodWaitError(request=None, capture=600)
+
+    async def run():
+        gateway = TelegramGateway(MagicMock(), max_flood_wait=300)
+        with pytest.raises(FloodWaitError):
+            await gateway.call('SendMessage', PRIORITY_REPLY, send)
+        # The method stays blocked for every other caller.
+        assert gateway.stats()['blocked_methods']['SendMessage'] > 500
+        gateway._dispatcher.cancel()
+
+    asyncio.run(run())
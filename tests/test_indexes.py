@@ -0,0 +1,38 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import indexes
+from indexes import PLAN_CHECK_GIFT_IDS, verify_query_plans
+from storage import Repository
+
+
+class ExplainedCursor:
+    def __init__(self, winning_plan):
+        self.winning_plan = winning_plan
+
+    async def explain(self):
+        return {'queryPlanner': {'winningPlan': self.winning_plan}}
+
+
+def test_drop_query_is_explained_with_several_gifts():
+    repo = Repository(MagicMock(), 'test')
+    repo.users = MagicMock()
+    indexes.hot_queries(repo)
+    filters = [call.args[0] for call in repo.users.find.call_args_list]
+    drop = [f for f in filters if 'preferred_gift_ids' in f]
+    assert len(drop) == 1
+    assert drop[0]['preferred_gift_ids'] == {'$in': list(PLAN_CHECK_GIFT_IDS)}
+    assert drop[0]['in_gift_queue'] is True and 'last_activity_timestamp' in drop[0]
+    assert len(PLAN_CHECK_GIFT_IDS) > 1
+
+
+def test_plan_check_flags_scans_and_sorts(monkeypatch):
+    merged = {'stage': 'PROJECTION_SIMPLE', 'inputStage': {'stage': 'FETCH', 'inputStage': {'stage': 'SORT_MERGE', 'inputStages': [
+        {'stage': 'IXSCAN', 'indexName': 'queue_preferences'} for _ in PLAN_CHECK_GIFT_IDS]}}}
+    plans = {
+        'new gift preferences': merged,
+        'queue': {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}},
+    }
+    monkeypatch.setattr(indexes, 'hot_queries', lambda repo, shard_count=None: {name: ExplainedCursor(plan) for name, plan in plans.items()})
+    problems = asyncio.run(verify_query_plans(None))
+    assert len(problems) == 1 and problems[0].startswith("query 'queue' uses COLLSCAN, SORT")
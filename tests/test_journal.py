@@ -0,0 +1,39 @@
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+from journal import PurchaseJournal
+
+
+async def entries(*docs):
+    for doc in docs:
+        yield doc
+
+
+def test_recover_orphans_commits_purchased_and_refunds_reserved():
+    purchased = {'_id': 1, 'user_id': 10, 'stars': 50, 'gift_id': 7, 'state': 'purchased', 'owner': 'gone'}
+    reserved = {'_id': 2, 'user_id': 11, 'stars': 50, 'gift_id': 7, 'state': 'reserved', 'owner': 'gone'}
+    repo = MagicMock()
+    repo.find_orphaned_reservations = MagicMock(return_value=entries(purchased, reserved))
+    repo.commit_reservations = AsyncMock()
+    repo.release_reservations = AsyncMock()
+
+    journal = PurchaseJournal(repo, owner='a')
+    assert asyncio.run(journal.recover_orphans({'a', 'b'}, grace=600)) == 2
+
+    live_owners, created_before = repo.find_orphaned_reservations.call_args.args
+    assert live_owners == {'a', 'b'}
+    assert abs(datetime.utcnow() - timedelta(seconds=600) - created_before) < timedelta(seconds=5)
+    repo.commit_reservations.assert_awaited_once_with([purchased])
+    repo.release_reservations.assert_awaited_once_with([reserved])
+
+
+def test_recover_orphans_without_entries_writes_nothing():
+    repo = MagicMock()
+    repo.find_orphaned_reservations = MagicMock(return_value=entries())
+    repo.commit_reservations = AsyncMock()
+    repo.release_reservations = AsyncMock()
+
+    assert asyncio.run(PurchaseJournal(repo, owner='a').recover_orphans({'a'})) == 0
+    repo.commit_reservations.assert_not_awaited()
+    repo.release_reservations.assert_not_awaited()
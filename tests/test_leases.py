@@ -0,0 +1,107 @@
+"""
+Lease acquisition (storage.Repository.acquire_lease) against a mocked collection, and acquire /
+renew / expire against a real mongod at TEST_MONGO_URL (skipped when none is reachable).
+"""
+import asyncio
+import os
+import uuid
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo import AsyncMongoClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from storage import Repository
+
+TEST_MONGO_URL = os.getenv('TEST_MONGO_URL', 'mongodb://localhost:27017')
+
+
+def mocked_repo(updates, insert_error=None):
+    repo = Repository(MagicMock(), 'test')
+    repo.app_config = MagicMock()
+    repo.app_config.find_one_and_update = AsyncMock(side_effect=updates)
+    repo.app_config.insert_one = AsyncMock(side_effect=insert_error)
+    return repo
+
+
+def test_acquire_lease_never_upserts():
+    repo = mocked_repo([{'value': {'owner': 'a'}}])
+    assert asyncio.run(repo.acquire_lease('lease:leader', 'a', 15)) == {'owner': 'a'}
+    # $expr in the filter is rejected in upserts, so the update must not be one.
+    assert not repo.app_config.find_one_and_update.call_args.kwargs.get('upsert')
+    repo.app_config.insert_one.assert_not_called()
+
+
+def test_acquire_lease_creates_a_missing_lease():
+    repo = mocked_repo([None, {'value': {'owner': 'a'}}])
+    assert asyncio.run(repo.acquire_lease('lease:leader', 'a', 15)) == {'owner': 'a'}
+    repo.app_config.insert_one.assert_awaited_once()
+    assert repo.app_config.find_one_and_update.await_count == 2
+
+
+def test_acquire_lease_held_by_another_owner():
+    repo = mocked_repo([None, None], insert_error=DuplicateKeyError('E11000'))
+    assert asyncio.run(repo.acquire_lease('lease:leader', 'b', 15)) is None
+
+
+async def with_server(test):
+    client = AsyncMongoClient(TEST_MONGO_URL, serverSelectionTimeoutMS=500)
+    try:
+        await client.admin.command('ping')
+    except PyMongoError:
+        await client.close()
+        pytest.skip(f"No mongod at {TEST_MONGO_URL}")
+    database = f"giftbot_test_{uuid.uuid4().hex[:8]}"
+    repo = Repository(client, database)
+    try:
+        await repo.app_config.create_index('key', unique=True)
+        await test(repo)
+    finally:
+        await client.drop_database(database)
+        await client.close()
+
+
+def test_acquire_renew_and_expire():
+    async def test(repo):
+        first = await repo.acquire_lease('lease:leader', 'a', 1)
+        assert first['owner'] == 'a'
+        assert await repo.acquire_lease('lease:leader', 'b', 1) is None
+
+        renewed = await repo.acquire_lease('lease:leader', 'a', 1)
+        assert renewed['owner'] == 'a' and renewed['expires_at'] >= first['expires_at']
+        assert await repo.count_live_leases('lease:') == 1
+
+        await asyncio.sleep(1.2)
+        assert await repo.count_live_leases('lease:') == 0
+        taken = await repo.acquire_lease('lease:leader', 'b', 1)
+        assert taken['owner'] == 'b'
+        assert await repo.acquire_lease('lease:leader', 'a', 1) is None
+
+    asyncio.run(with_server(test))
+
+
+def test_release_lets_another_owner_take_over():
+    async def test(repo):
+        await repo.set_lease_cycle(['lease:shard:0'], 'a', 'cycle') # No lease yet: matches nothing
+        assert (await repo.acquire_lease('lease:shard:0', 'a', 30))['owner'] == 'a'
+        await repo.set_lease_cycle(['lease:shard:0'], 'a', 'cycle')
+        await repo.release_lease('lease:shard:0', 'a')
+        taken = await repo.acquire_lease('lease:shard:0', 'b', 30)
+        assert taken['owner'] == 'b' and taken['cycle_id'] == 'cycle'
+
+    asyncio.run(with_server(test))
+
+
+def test_leadership_lapses_when_heartbeats_fail():
+    from cluster import LeaseManager
+
+    repo = MagicMock()
+    repo.acquire_lease = AsyncMock(return_value={'owner': 'a'})
+    repo.count_live_leases = AsyncMock(return_value=1)
+    leases = LeaseManager(repo, 'a', shard_count=2, ttl=0.1)
+    asyncio.run(leases.heartbeat())
+    assert leases.is_leader and leases.shards == [0, 1]
+
+    # No further heartbeat succeeds: the leases are no longer trusted once they may have expired.
+    asyncio.run(asyncio.sleep(0.1))
+    assert not leases.is_leader and leases.shards == []
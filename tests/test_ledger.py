@@ -0,0 +1,129 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from ledger import Payment, PaymentLedger
+from storage import DUPLICATE_KEY_ERROR, Repository
+
+
+def test_failed_batch_is_recovered_in_process():
+    ledger_entries = []
+
+    async def record_payments(payments, batch_id):
+        ledger_entries.extend({**p, 'batch_id': batch_id} for p in payments)
+        return [p['charge_id'] for p in payments]
+
+    async def unapplied():
+        for entry in ledger_entries:
+            yield entry
+
+    repo = MagicMock()
+    repo.record_payments = AsyncMock(side_effect=record_payments)
+    repo.apply_payment_credits = AsyncMock(side_effect=[ConnectionError("primary stepped down"), RuntimeError("still down"), {}])
+    repo.mark_payments_applied = AsyncMock()
+    repo.find_unapplied_payments = MagicMock(side_effect=lambda: unapplied())
+
+    async def run():
+        ledger = PaymentLedger(repo, batch_size=1, max_delay=0, retry_delay=0.01)
+        with pytest.raises(ConnectionError):
+            await ledger.record(Payment(charge_id='c1', user_id=10, amount=50))
+        await asyncio.sleep(0.1)
+        return ledger
+
+    ledger = asyncio.run(run())
+    # First recovery attempt failed too; the second applied the recorded payment.
+    assert repo.apply_payment_credits.await_count == 3
+    batch_id = ledger_entries[0]['batch_id']
+    repo.apply_payment_credits.assert_awaited_with({10: 50}, batch_id)
+    repo.mark_payments_applied.assert_awaited_once_with(batch_id)
+    assert not ledger._tasks
+
+
+def test_record_returns_none_for_duplicates():
+    repo = MagicMock()
+    repo.record_payments = AsyncMock(return_value=['c1'])
+    repo.apply_payment_credits = AsyncMock(return_value={10: {'user_id': 10, 'star_balance': 50}})
+    repo.mark_payments_applied = AsyncMock()
+
+    async def run():
+        ledger = PaymentLedger(repo, batch_size=2, max_delay=0.01)
+        return await asyncio.gather(
+            ledger.record(Payment(charge_id='c1', user_id=10, amount=50)),
+            ledger.record(Payment(charge_id='c1', user_id=10, amount=50)),
+        )
+
+    first, second = asyncio.run(run())
+    assert first == {'user_id': 10, 'star_balance': 50} and second is None
+
+
+class Cursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+
+def credited_repo(bulk_error, updated, docs):
+    repo = Repository(MagicMock(), 'test')
+    repo.users = MagicMock()
+    repo.users.bulk_write = AsyncMock(side_effect=bulk_error)
+    repo.users.update_one = AsyncMock(return_value=MagicMock(modified_count=updated))
+    repo.users.find = MagicMock(return_value=Cursor(docs))
+    repo.inc_stats = AsyncMock()
+    return repo
+
+
+def race():
+    # User 10's upsert lost the race against a concurrent insert of the same user (e.g. /join_queue);
+    # user 11 was created by the batch.
+    return BulkWriteError({
+        'writeErrors': [{'index': 0, 'code': DUPLICATE_KEY_ERROR, 'errmsg': 'E11000'}],
+        'nModified': 0, 'nUpserted': 1, 'upserted': [{'index': 1, '_id': 'x'}],
+    })
+
+
+def test_credit_lost_to_a_concurrent_insert_is_retried():
+    docs = [
+        {'user_id': 10, 'star_balance': 50, 'payment_batches': ['b1']},
+        {'user_id': 11, 'star_balance': 20, 'payment_batches': ['b1']},
+    ]
+    repo = credited_repo(race(), updated=1, docs=docs)
+
+    user_docs = asyncio.run(repo.apply_payment_credits({10: 50, 11: 20}, 'b1'))
+
+    repo.users.update_one.assert_awaited_once()
+    query, update = repo.users.update_one.call_args.args
+    assert query == {'user_id': 10, 'payment_batches': {'$ne': 'b1'}}
+    assert update['$inc'] == {'star_balance': 50} and '$setOnInsert' not in update
+    assert not repo.users.update_one.call_args.kwargs.get('upsert')
+    assert user_docs == {10: {'user_id': 10, 'star_balance': 50}, 11: {'user_id': 11, 'star_balance': 20}}
+    repo.inc_stats.assert_awaited_once_with({'users': 1, 'queued_users': 1, 'outstanding_stars': 70})
+
+
+def test_batch_missing_from_a_user_is_not_applied():
+    docs = [
+        {'user_id': 10, 'star_balance': 0, 'payment_batches': []},
+        {'user_id': 11, 'star_balance': 20, 'payment_batches': ['b1']},
+    ]
+    repo = credited_repo(race(), updated=0, docs=docs)
+    repo.mark_payments_applied = AsyncMock()
+    repo.record_payments = AsyncMock(return_value=['c1', 'c2'])
+
+    async def run():
+        ledger = PaymentLedger(repo, batch_size=2, max_delay=0, retry_delay=60)
+        results = await asyncio.gather(
+            ledger.record(Payment(charge_id='c1', user_id=10, amount=50)),
+            ledger.record(Payment(charge_id='c2', user_id=11, amount=20)),
+            return_exceptions=True,
+        )
+        for task in ledger._tasks:
+            task.cancel()
+        return results
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    repo.mark_payments_applied.assert_not_called()
@@ -0,0 +1,28 @@
+from metrics import Metrics
+
+
+def test_render_keeps_full_precision():
+    metrics = Metrics()
+    metrics.inc('purchases_total', 1234567, result='purchased')
+    metrics.collect('outbox_depth', lambda: 2500001, kind='gauge')
+    for _ in range(3):
+        metrics.observe('cycle_seconds', 400000.25)
+
+    lines = metrics.render().splitlines()
+    assert any(line.endswith('purchases_total{result="purchased"} 1234567.0') for line in lines)
+    assert any(line.endswith('outbox_depth 2500001.0') for line in lines)
+    assert any(line.endswith('cycle_seconds_sum 1200000.75') for line in lines)
+    assert any(line.endswith('cycle_seconds_bucket{le="+Inf"} 3') for line in lines)
+
+
+def test_summary_uses_fixed_formatting():
+    metrics = Metrics()
+    metrics.inc('purchases_total', 5)
+    since = metrics.snapshot()
+    metrics.inc('purchases_total', 1234567)
+    metrics.observe('cycle_seconds', 1500000.5)
+    metrics.observe('cycle_seconds', 0.25)
+
+    summary = metrics.summary(since)
+    assert summary == "cycle_seconds n=2 total=1500000.750s avg=750000375.0ms; purchases_total +1234567"
+    assert 'e+' not in summary
@@ -0,0 +1,46 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from outbox import NotificationOutbox
+
+
+async def no_messages():
+    return
+    yield
+
+
+def test_adopt_orphans_queues_messages_of_stopped_workers():
+    repo = MagicMock()
+    repo.adopt_outbox_messages = AsyncMock(return_value=[
+        {'_id': 1, 'user_id': 10, 'text': "first", 'attempts': 1},
+        {'_id': 2, 'user_id': 10, 'text': "second"},
+    ])
+    outbox = NotificationOutbox(repo, AsyncMock(), owner='a')
+
+    assert asyncio.run(outbox.adopt_orphans({'b'})) == 2
+    # This worker's own messages are never adopted from itself.
+    repo.adopt_outbox_messages.assert_awaited_once_with({'a', 'b'}, 'a')
+    assert outbox.depth() == 2
+
+
+def test_adopted_messages_are_delivered_together():
+    send = AsyncMock()
+    repo = MagicMock()
+    repo.adopt_outbox_messages = AsyncMock(return_value=[
+        {'_id': 1, 'user_id': 10, 'text': "first"},
+        {'_id': 2, 'user_id': 10, 'text': "second"},
+    ])
+    repo.find_pending_outbox = MagicMock(return_value=no_messages())
+    repo.delete_outbox_messages = AsyncMock()
+
+    async def run():
+        outbox = NotificationOutbox(repo, send, workers=1, owner='a')
+        await outbox.start()
+        await outbox.adopt_orphans(set())
+        await asyncio.sleep(0.05)
+        return outbox
+
+    outbox = asyncio.run(run())
+    send.assert_awaited_once_with(10, "first\n\nsecond")
+    repo.delete_outbox_messages.assert_awaited_once_with([1, 2])
+    assert outbox.delivered == 2
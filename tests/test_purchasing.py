@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from purchasing import PurchaseExecutor
+
+
+async def failing_source(count: int):
+    for user in range(count):
+        yield user
+    raise RuntimeError("cursor failed")
+
+
+def test_source_error_drains_handlers_in_flight():
+    finished = []
+
+    async def handler(user):
+        await asyncio.sleep(0.05)
+        finished.append(user)
+        return True
+
+    async def run():
+        return await PurchaseExecutor(3).run(failing_source(3), handler)
+
+    with pytest.raises(RuntimeError, match="cursor failed"):
+        asyncio.run(run())
+    assert sorted(finished) == [0, 1, 2]
+
+
+def test_cancellation_cancels_handlers_in_flight():
+    started, finished = [], []
+
+    async def handler(user):
+        started.append(user)
+        await asyncio.sleep(10)
+        finished.append(user)
+
+    async def run():
+        task = asyncio.create_task(PurchaseExecutor(2).run(range(2), handler))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert started == [0, 1] and finished == []
+
+
+def test_stats_count_purchases_and_failures():
+    async def handler(user):
+        if user == 2:
+            raise ValueError(user)
+        return user % 2 == 0
+
+    stats = asyncio.run(PurchaseExecutor(2).run(range(5), handler))
+    assert (stats.dispatched, stats.purchased, stats.failed) == (5, 2, 1)
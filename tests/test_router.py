@@ -0,0 +1,77 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from telethon.tl.types import MessageActionPaymentSentMe, MessageService, PaymentCharge, PeerUser
+
+from router import CommandRouter
+
+
+def text_event(text):
+    return SimpleNamespace(message=SimpleNamespace(message=text, action=None))
+
+
+def routed(username='GiftBot'):
+    router = CommandRouter(username=username)
+    handlers = {name: AsyncMock() for name in ('/start', '/set_preferred_gift')}
+    for name, handler in handlers.items():
+        router.command(name)(handler)
+    return router, handlers
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("/start", ("/start", "")),
+    ("/set_preferred_gift@GiftBot  42 ", ("/set_preferred_gift", "42")),
+    ("/set_preferred_gift@giftbot 42", ("/set_preferred_gift", "42")), # Usernames are case-insensitive
+    ("/start@OtherBot", (None, None)),
+    ("hello /start", (None, None)),
+    ("", (None, None)),
+    (None, (None, None)),
+])
+def test_parse(text, expected):
+    assert CommandRouter.parse(text, 'GiftBot') == expected
+
+
+def test_parse_accepts_any_addressee_before_the_username_is_known():
+    assert CommandRouter.parse("/start@OtherBot") == ("/start", "")
+
+
+def test_dispatch_passes_the_arguments():
+    router, handlers = routed()
+    event = text_event("/set_preferred_gift@GiftBot 42")
+    asyncio.run(router.dispatch(event))
+    handlers['/set_preferred_gift'].assert_awaited_once_with(event, "42")
+
+
+def test_dispatch_passes_an_empty_argument_string():
+    router, handlers = routed()
+    event = text_event("/set_preferred_gift")
+    asyncio.run(router.dispatch(event))
+    handlers['/set_preferred_gift'].assert_awaited_once_with(event, "")
+
+
+def test_dispatch_ignores_commands_for_another_bot():
+    router, handlers = routed()
+    asyncio.run(router.dispatch(text_event("/start@OtherBot")))
+    handlers['/start'].assert_not_called()
+
+
+def test_dispatch_ignores_unknown_and_partial_commands():
+    router, handlers = routed()
+    for text in ("/unknown", "/startle", "plain text"):
+        asyncio.run(router.dispatch(text_event(text)))
+    for handler in handlers.values():
+        handler.assert_not_called()
+
+
+def test_dispatch_routes_service_messages_by_action_type():
+    router = CommandRouter(metrics=MagicMock())
+    handler = AsyncMock()
+    router.action(MessageActionPaymentSentMe)(handler)
+    action = MessageActionPaymentSentMe(currency='XTR', total_amount=50, payload=b'',
+                                        charge=PaymentCharge(id='c1', provider_charge_id=''))
+    event = SimpleNamespace(message=MessageService(id=1, peer_id=PeerUser(1), action=action))
+    asyncio.run(router.dispatch(event))
+    handler.assert_awaited_once_with(event)
+    router.metrics.timer.assert_called_once_with('handler_seconds', handler='MessageActionPaymentSentMe')
@@ -0,0 +1,146 @@
+"""
+Statistics counters (storage.Repository.inc_stats, stats.QueueStats, stats.format_stats) against
+mocks, and increment / reconcile against a real mongod at TEST_MONGO_URL (skipped when none is reachable).
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo import AsyncMongoClient
+from pymongo.errors import PyMongoError
+
+from stats import QueueStats, format_stats
+from storage import STATS_KEY, Repository
+
+TEST_MONGO_URL = os.getenv('TEST_MONGO_URL', 'mongodb://localhost:27017')
+
+
+def mocked_repo(update_error=None):
+    repo = Repository(MagicMock(), 'test')
+    repo.app_config = MagicMock()
+    repo.app_config.update_one = AsyncMock(side_effect=update_error)
+    return repo
+
+
+def test_inc_stats_applies_all_deltas_in_one_update():
+    repo = mocked_repo()
+    asyncio.run(repo.inc_stats({'users': 1, 'queued_users': 0, 'outstanding_stars': -50}, preferences={7: 1, 8: 0}))
+    repo.app_config.update_one.assert_awaited_once_with(
+        {'key': STATS_KEY},
+        {'$inc': {'value.users': 1, 'value.outstanding_stars': -50, 'value.preferences.7': 1}},
+        upsert=True,
+    )
+
+
+def test_inc_stats_skips_empty_deltas_and_swallows_failures():
+    repo = mocked_repo(update_error=ConnectionError("down"))
+    asyncio.run(repo.inc_stats({'users': 0}, preferences={}))
+    repo.app_config.update_one.assert_not_called()
+    asyncio.run(repo.inc_stats({'users': 1})) # Logged, not raised
+    repo.app_config.update_one.assert_awaited_once()
+
+
+def test_reconcile_overwrites_drifted_counters():
+    repo = MagicMock()
+    repo.aggregate_stats = AsyncMock(return_value={'users': 10, 'queued_users': 4, 'outstanding_stars': 900, 'preferences': {'7': 2}})
+    repo.get_config = AsyncMock(return_value={'users': 10, 'queued_users': 5, 'outstanding_stars': 1000, 'purchases': 3})
+    repo.set_stats = AsyncMock()
+
+    values = asyncio.run(QueueStats(repo).reconcile())
+
+    written = repo.set_stats.await_args.args[0]
+    assert written is values and isinstance(written.pop('reconciled_at'), datetime)
+    assert written == {'users': 10, 'queued_users': 4, 'outstanding_stars': 900, 'preferences': {'7': 2}}
+
+
+def test_reconcile_runs_only_on_the_active_worker():
+    repo = MagicMock()
+    repo.aggregate_stats = AsyncMock()
+
+    async def run():
+        stats = QueueStats(repo, interval=60, is_active=lambda: False)
+        stats.start()
+        await asyncio.sleep(0)
+        await stats.stop()
+
+    asyncio.run(run())
+    repo.aggregate_stats.assert_not_called()
+
+
+def test_record_cycle_keeps_a_bounded_history():
+    repo = MagicMock()
+    repo.push_cycle_stats = AsyncMock()
+    cycle = SimpleNamespace(dispatched=10, purchased=7, failed=1, elapsed=1.23456)
+    asyncio.run(QueueStats(repo, cycle_history=5).record_cycle(cycle, worker='w1'))
+    pushed, history = repo.push_cycle_stats.await_args.args
+    assert history == 5
+    assert {k: v for k, v in pushed.items() if k != 'finished_at'} == {
+        'dispatched': 10, 'purchased': 7, 'failed': 1, 'elapsed_seconds': 1.235, 'worker': 'w1'}
+
+
+def test_format_stats():
+    stats = {
+        'users': 1200, 'queued_users': 800, 'outstanding_stars': 45000, 'purchases': 17,
+        'preferences': {'7': 5, '8': 0, '9': 12, '10': 5},
+        'cycles': [
+            {'finished_at': datetime(2026, 1, 1, 12, 0), 'dispatched': 3, 'purchased': 3, 'failed': 0, 'elapsed_seconds': 0.5},
+            {'finished_at': datetime(2026, 1, 1, 12, 5), 'dispatched': 10, 'purchased': 8, 'failed': 2,
+             'elapsed_seconds': 2.25, 'worker': 'w2'},
+        ],
+        'reconciled_at': datetime(2026, 1, 1, 11, 0),
+    }
+    assert format_stats(stats, top_gifts=2) == "\n".join([
+        "Users: 1200",
+        "In gift queue: 800",
+        "Outstanding Stars: 45000",
+        "Gifts purchased: 17",
+        "Most preferred gifts:",
+        "- 9: 12 user(s)",
+        "- 7: 5 user(s)",
+        "Recent purchase cycles:",
+        "- 2026-01-01 12:05:00 [w2]: 8 purchased, 2 failed of 10 in 2.2s",
+        "- 2026-01-01 12:00:00: 3 purchased, 0 failed of 3 in 0.5s",
+        "Last reconciled: 2026-01-01 11:00:00 UTC",
+    ])
+
+
+def test_format_stats_before_any_update():
+    assert format_stats({}) == "No statistics recorded yet."
+    assert format_stats({'users': 1}).splitlines() == ["Users: 1", "In gift queue: 0", "Outstanding Stars: 0", "Gifts purchased: 0"]
+
+
+def test_increments_and_reconcile_against_a_server():
+    async def test():
+        client = AsyncMongoClient(TEST_MONGO_URL, serverSelectionTimeoutMS=500)
+        try:
+            await client.admin.command('ping')
+        except PyMongoError:
+            await client.close()
+            pytest.skip(f"No mongod at {TEST_MONGO_URL}")
+        database = f"giftbot_test_{uuid.uuid4().hex[:8]}"
+        repo = Repository(client, database)
+        stats = QueueStats(repo)
+        try:
+            await repo.join_queue(1)
+            await repo.join_queue(2)
+            await repo.add_preferred_gift(2, 7)
+            await repo.leave_queue(1)
+            counters = await stats.read()
+            assert (counters['users'], counters['queued_users'], counters['preferences']) == (2, 1, {'7': 1})
+
+            # A counter write lost between a mutation and its $inc leaves the statistics off.
+            await repo.users.update_one({'user_id': 2}, {'$set': {'star_balance': 300}})
+            await repo.inc_stats({'users': 5})
+            values = await stats.reconcile()
+            assert (values['users'], values['queued_users'], values['outstanding_stars']) == (2, 1, 300)
+            counters = await stats.read()
+            assert (counters['users'], counters['outstanding_stars'], counters['preferences']) == (2, 300, {'7': 1})
+        finally:
+            await client.drop_database(database)
+            await client.close()
+
+    asyncio.run(test())
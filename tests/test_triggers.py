@@ -0,0 +1,155 @@
+"""
+BalanceTrigger notify() and watch() against a mocked change stream, and the change stream path
+against a replica-set mongod at TEST_MONGO_URL (skipped when none is reachable).
+"""
+import asyncio
+import os
+import uuid
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pymongo import AsyncMongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+from allocation import GiftCatalog
+from discovery import GiftOption
+from storage import Repository
+from triggers import BalanceTrigger
+
+TEST_MONGO_URL = os.getenv('TEST_MONGO_URL', 'mongodb://localhost:27017')
+
+
+def gift(gift_id: int, stars: int) -> GiftOption:
+    return GiftOption(id=gift_id, stars=stars, months=3, currency='XTR', amount=stars, flags=0, description=None)
+
+
+async def settle(trigger):
+    while trigger._tasks:
+        await asyncio.sleep(0)
+
+
+def test_notify_purchases_only_when_a_live_gift_is_affordable():
+    purchase = AsyncMock()
+
+    async def run():
+        trigger = BalanceTrigger(purchase)
+        trigger.notify({'user_id': 1, 'star_balance': 500}) # No catalog yet
+        catalog = GiftCatalog([gift(1, 100)])
+        trigger.update_catalog(catalog)
+        trigger.notify({'user_id': 2, 'star_balance': 99})
+        trigger.notify({'user_id': 3, 'star_balance': 500, 'in_gift_queue': False})
+        trigger.notify(None)
+        trigger.notify({'user_id': 4, 'star_balance': 100})
+        await settle(trigger)
+        return catalog
+
+    catalog = asyncio.run(run())
+    purchase.assert_awaited_once_with({'user_id': 4, 'star_balance': 100}, catalog)
+
+
+def test_notify_bounds_concurrent_purchases_and_survives_failures():
+    running = []
+    peak = []
+
+    async def purchase(user_doc, catalog):
+        running.append(user_doc['user_id'])
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(user_doc['user_id'])
+        if user_doc['user_id'] == 0:
+            raise RuntimeError("sold out")
+
+    async def run():
+        trigger = BalanceTrigger(purchase, max_concurrency=2)
+        trigger.update_catalog(GiftCatalog([gift(1, 100)]))
+        for user_id in range(5):
+            trigger.notify({'user_id': user_id, 'star_balance': 100})
+        await settle(trigger)
+
+    asyncio.run(run())
+    assert len(peak) == 5 and max(peak) == 2
+
+
+class Stream:
+    def __init__(self, changes, error=None):
+        self.changes = changes
+        self.error = error
+        self.resume_token = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        for index, change in enumerate(self.changes):
+            self.resume_token = {'_data': index}
+            yield change
+        if self.error:
+            raise self.error
+        await asyncio.Event().wait() # An open stream waits for more changes
+
+
+def test_watch_notifies_each_credit_and_resumes_after_failures():
+    streams = [
+        Stream([{'fullDocument': {'user_id': 1, 'star_balance': 100}}], error=ConnectionError("reset")),
+        Stream([{'fullDocument': {'user_id': 2, 'star_balance': 100}}], error=OperationFailure("resume point lost")),
+        Stream([{'fullDocument': {'user_id': 3, 'star_balance': 100}}]),
+    ]
+    repo = MagicMock()
+    repo.watch_balance_credits = AsyncMock(side_effect=streams)
+    notified = []
+
+    async def run():
+        trigger = BalanceTrigger(AsyncMock(), retry_delay=0)
+        trigger.notify = lambda user_doc: notified.append(user_doc['user_id'])
+        task = asyncio.create_task(trigger.watch(repo))
+        while len(notified) < 3:
+            await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert notified == [1, 2, 3]
+    resume_points = [call.kwargs['resume_after'] for call in repo.watch_balance_credits.call_args_list]
+    # A dropped connection resumes after the last change; a lost resume point starts fresh.
+    assert resume_points == [None, {'_data': 0}, None]
+
+
+def test_change_stream_triggers_a_purchase_on_credit():
+    async def test():
+        client = AsyncMongoClient(TEST_MONGO_URL, serverSelectionTimeoutMS=500)
+        try:
+            hello = await client.admin.command('hello')
+        except PyMongoError:
+            await client.close()
+            pytest.skip(f"No mongod at {TEST_MONGO_URL}")
+        if 'setName' not in hello:
+            await client.close()
+            pytest.skip(f"mongod at {TEST_MONGO_URL} is not a replica set")
+        database = f"giftbot_test_{uuid.uuid4().hex[:8]}"
+        repo = Repository(client, database)
+        purchased = asyncio.Queue()
+        trigger = BalanceTrigger(lambda user_doc, catalog: purchased.put(user_doc))
+        trigger.update_catalog(GiftCatalog([gift(1, 100)]))
+        watcher = asyncio.create_task(trigger.watch(repo))
+        try:
+            await repo.users.create_index('user_id', unique=True)
+            await repo.users.insert_one({'user_id': 7, 'star_balance': 0, 'in_gift_queue': True, 'preferred_gift_ids': []})
+            # The insert (balance 0) reaches the trigger once the stream is open; only the credit buys.
+            await asyncio.sleep(0.5)
+            await repo.apply_payment_credits({7: 150}, 'b1')
+            user_doc = await asyncio.wait_for(purchased.get(), timeout=10)
+            assert user_doc['user_id'] == 7 and user_doc['star_balance'] == 150
+            await repo.users.update_one({'user_id': 7}, {'$inc': {'star_balance': -100}}) # Debits are not reported
+            await asyncio.sleep(0.5)
+            assert purchased.empty()
+        finally:
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+            await client.drop_database(database)
+            await client.close()
+
+    asyncio.run(test())
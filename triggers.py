@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+from pymongo.errors import OperationFailure
+
+from allocation import GiftCatalog
+
+
+class BalanceTrigger:
+    """
+    Starts a purchase as soon as a queued user's balance covers a currently available limited gift,
+    instead of waiting for the next polling cycle.
+    Users are reported either in-process via notify() (e.g. from the payment handler) or by
+    watch(), which tails a MongoDB change stream of balance credits (requires a replica set).
+    Purchases run against the catalog from the last discovery poll, at most `max_concurrency` at a time.
+    `purchase(user_doc, catalog)` does the actual single-user purchase.
+    """
+
+    def __init__(self, purchase, max_concurrency: int = 4, retry_delay: float = 5.0):
+        self.catalog = GiftCatalog([])
+        self._purchase = purchase
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self._retry_delay = retry_delay
+        self._tasks = set()
+
+    def update_catalog(self, catalog: GiftCatalog):
+        """Replaces the cached catalog with the latest discovered one."""
+        self.catalog = catalog
+
+    def notify(self, user_doc: dict):
+        """
+        Reports a user whose balance was just credited. Returns immediately; if the user is queued
+        and can afford a live gift, a single-user purchase is scheduled in the background.
+        """
+        catalog = self.catalog
+        if not user_doc or not user_doc.get('in_gift_queue', True):
+            return
+        if catalog.cheapest_price is None or user_doc.get('star_balance', 0) < catalog.cheapest_price:
+            return
+        logging.info(f"BalanceTrigger: User {user_doc['user_id']} can afford a live gift (balance: {user_doc.get('star_balance', 0)}). Purchasing now.")
+        task = asyncio.create_task(self._run(user_doc, catalog))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, user_doc: dict, catalog: GiftCatalog):
+        async with self._semaphore:
+            try:
+                await self._purchase(user_doc, catalog)
+            except Exception as e:
+                logging.error(f"BalanceTrigger: Purchase for user {user_doc.get('user_id')} failed: {e}", exc_info=True)
+
+    async def watch(self, repo):
+        """Tails balance credits on the users collection and notify()s each one. Runs until cancelled."""
+        resume_token = None
+        while True:
+            try:
+                async with await repo.watch_balance_credits(resume_after=resume_token) as stream:
+                    logging.info("BalanceTrigger: Watching users change stream for balance credits.")
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        self.notify(change.get('fullDocument'))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"BalanceTrigger: Change stream failed, retrying in {self._retry_delay}s: {e}", exc_info=True)
+                if isinstance(e, OperationFailure):
+                    # e.g. the resume point fell off the oplog; start fresh; the polling cycle covers the gap.
+                    resume_token = None
+                await asyncio.sleep(self._retry_delay)